@@ -0,0 +1,261 @@
+# Benchmarks of the frame decoding and encoding
+#
+# NAT_FRAMEOFDATA packets are made for several NatNet versions (2.x, 3.x, 4.x) and frame shapes (number of
+# rigid bodies, labeled markers, skeletons, force plates and devices) with the FramePacker of the simulator,
+# then each packet is processed in a loop by:
+#   decode          NatNetClient with a filter on all the rigid bodies: selective decoding of the frame (MoCapData)
+#   decode_all      NatNetClient without filter: every section of the frame is decoded (MoCapData)
+#   process         decode followed by the conversion to the items sent to the websocket (makeDataReadyForWebsocket),
+#                   i.e. what the data thread does for each packet
+#   encode_json     JsonFrameEncoder on the output of process
+#   encode_binary   BinaryFrameEncoder on the output of process (with the copy made for the websocket clients)
+# For each case the speed (frames per second, best of --repeat runs of about --min-time seconds each), the
+# memory blocks per frame (blocks still allocated after the frame, i.e. the objects of the result) and the
+# peak of memory allocated while processing one frame (tracemalloc) are measured.
+# The results can be saved (--save) and compared to a saved baseline (--baseline): a case slower or allocating
+# more than the tolerance is reported as a regression and the exit status is 1.
+# The baselines depend on the computer: they are not part of the repository, save one on the deployment host.
+# The clients don't check the internet connection and don't write a log file, so the benchmarks run offline.
+#
+# Usage: python -m benchmarks.decoder_benchmark [--save baseline.json] [--baseline baseline.json]
+
+import argparse
+import datetime
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+
+import modules.MoCapData as MoCapData
+from modules.NatNetClient import NatNetClient
+from modules.NatNetServer import FramePacker, pack_server_info
+
+RESULTS_VERSION = 2
+LABEL_BASE = "RigidBody"
+CLOCK_FREQUENCY = 10000000
+
+VERSIONS = ("2.9", "3.1", "4.1")
+
+# Content of the frames (labeled_markers None: markers_per_rigid_body for each rigid body)
+Shape = namedtuple("Shape", ("rigid_bodies", "markers_per_rigid_body", "labeled_markers", "skeletons", "bones_per_skeleton", "force_plates", "devices"),
+                   defaults=(3, None, 0, 21, 0, 0))
+SHAPES = {
+    "rigid_bodies_1": Shape(1),
+    "rigid_bodies_50": Shape(50),
+    "rigid_bodies_500": Shape(500),
+    "labeled_markers_0": Shape(10, labeled_markers=0),
+    "labeled_markers_5000": Shape(10, labeled_markers=5000),
+    "skeletons": Shape(10, skeletons=4),
+    "full": Shape(50, labeled_markers=500, skeletons=2, force_plates=4, devices=4)
+}
+
+BENCHMARKS = ("decode", "decode_all", "process", "encode_json", "encode_binary")
+
+def generate_frame(shape):
+    """ MoCapData of a frame with the content of shape """
+    mocap_data = MoCapData.MoCapData()
+    mocap_data.set_prefix_data(MoCapData.generate_prefix_data(0))
+
+    # The objects are added directly to the lists (the add_* functions would deep copy them)
+    marker_set_data = MoCapData.MarkerSetData()
+    rigid_body_data = MoCapData.RigidBodyData()
+    for rigid_body_id in range(1, shape.rigid_bodies + 1):
+        marker_set_data.marker_data_list.append(MoCapData.generate_marker_data(LABEL_BASE, rigid_body_id, shape.markers_per_rigid_body))
+        rigid_body = MoCapData.generate_rigid_body(rigid_body_id, 0)
+        rigid_body.tracking_valid = True
+        rigid_body_data.rigid_body_list.append(rigid_body)
+
+    skeleton_data = MoCapData.SkeletonData()
+    for skeleton_num in range(shape.skeletons):
+        skeleton_data.skeleton_list.append(MoCapData.generate_skeleton(0, skeleton_num, shape.bones_per_skeleton))
+
+    labeled_marker_data = MoCapData.LabeledMarkerData()
+    labeled_marker_count = shape.labeled_markers
+    if labeled_marker_count is None:
+        labeled_marker_count = shape.rigid_bodies * shape.markers_per_rigid_body
+    for marker_num in range(labeled_marker_count):
+        labeled_marker = MoCapData.generate_labeled_marker(0, marker_num)
+        labeled_marker.id_num = ( ( marker_num // shape.markers_per_rigid_body + 1 ) << 16 ) | ( marker_num % shape.markers_per_rigid_body + 1 )
+        labeled_marker_data.labeled_marker_list.append(labeled_marker)
+
+    force_plate_data = MoCapData.ForcePlateData()
+    for force_plate_num in range(shape.force_plates):
+        force_plate_data.force_plate_list.append(MoCapData.generate_force_plate(0, force_plate_num, 6))
+    device_data = MoCapData.DeviceData()
+    for device_num in range(shape.devices):
+        device_data.device_list.append(MoCapData.generate_device(0, device_num))
+
+    mocap_data.set_marker_set_data(marker_set_data)
+    mocap_data.set_rigid_body_data(rigid_body_data)
+    mocap_data.set_skeleton_data(skeleton_data)
+    mocap_data.set_labeled_marker_data(labeled_marker_data)
+    mocap_data.set_force_plate_data(force_plate_data)
+    mocap_data.set_device_data(device_data)
+    mocap_data.set_suffix_data(MoCapData.generate_suffix_data(0))
+    return mocap_data
+
+def create_client(major, minor, rigid_body_filter):
+    """ Client configured for the NatNet version by a server info packet, as when it connects to Motive """
+    client = NatNetClient(verify_connection=False, log_path=None)
+    client.set_rigid_body_filter(rigid_body_filter)
+    client.process_packet(pack_server_info("Motive", (3, 1, 0, 0), (major, minor, 0, 0), CLOCK_FREQUENCY, 1511, None))
+    if (client.get_major(), client.get_minor()) != (major, minor):
+        raise RuntimeError("The client didn't switch to NatNet %d.%d" % (major, minor))
+    return client
+
+def time_function(function, iterations):
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            function()
+        return time.perf_counter() - start
+    finally:
+        gc.enable()
+
+def measure_speed(function, min_time, repeat):
+    """ Return the calls per second (best of repeat runs of about min_time seconds) """
+    iterations = 1
+    while True:
+        elapsed = time_function(function, iterations)
+        if elapsed >= min_time / 10:
+            break
+        iterations *= 4
+    iterations = max(1, int(iterations * min_time / elapsed))
+    best = min(time_function(function, iterations) for _ in range(repeat))
+    return iterations / best
+
+def measure_memory(function, iterations=100):
+    """ Return the memory blocks kept by each call (the objects of its result) and the peak of memory of one call (bytes) """
+    gc.collect()
+    gc.disable()
+    try:
+        results = [None] * iterations
+        start_blocks = sys.getallocatedblocks()
+        for i in range(iterations):
+            results[i] = function()
+        blocks = (sys.getallocatedblocks() - start_blocks) / iterations
+        del results
+    finally:
+        gc.enable()
+
+    tracemalloc.start()
+    try:
+        function()
+        tracemalloc.reset_peak()
+        start_size = tracemalloc.get_traced_memory()[0]
+        function()
+        peak = tracemalloc.get_traced_memory()[1] - start_size
+    finally:
+        tracemalloc.stop()
+    return blocks, peak
+
+def get_benchmark_functions(version, shape):
+    """ Return the packet of the frame and the function of each benchmark """
+    major, minor = [int(value) for value in version.split(".")]
+    packet = bytes(FramePacker(major, minor, max_packet_size=None).pack(generate_frame(shape)))
+
+    client = create_client(major, minor, [{"id_range": [1, shape.rigid_bodies]}, {"name_prefix": LABEL_BASE}])
+    full_client = create_client(major, minor, None)
+    processed_data = client.process_packet(packet)
+    frame_encoder = client.frame_encoder
+    binary_frame_encoder = client.binary_frame_encoder
+    return packet, {
+        "decode": lambda: client.decode_packet(packet),
+        "decode_all": lambda: full_client.decode_packet(packet),
+        "process": lambda: client.process_packet(packet),
+        "encode_json": lambda: frame_encoder.encode(processed_data),
+        "encode_binary": lambda: bytes(binary_frame_encoder.encode(processed_data))
+    }
+
+def run(versions, shapes, benchmarks, min_time, repeat):
+    results = {}
+    for version in versions:
+        for shape_name in shapes:
+            packet, functions = get_benchmark_functions(version, SHAPES[shape_name])
+            for benchmark in benchmarks:
+                function = functions[benchmark]
+                frames_per_second = measure_speed(function, min_time, repeat)
+                blocks, peak = measure_memory(function)
+                key = "%s/%s/%s" % (version, shape_name, benchmark)
+                results[key] = {
+                    "frames_per_second": frames_per_second,
+                    "us_per_frame": 1e6 / frames_per_second,
+                    "blocks_per_frame": blocks,
+                    "peak_bytes_per_frame": peak,
+                    "packet_size": len(packet)
+                }
+                print("%-42s %12.0f %10.2f %10.1f %12d %9d" % (key, frames_per_second, 1e6 / frames_per_second, blocks, peak, len(packet)))
+                sys.stdout.flush()
+    return results
+
+def compare(results, baseline, tolerance):
+    """ Return the regressions of results compared to baseline (list of messages) """
+    regressions = []
+    for key, result in results.items():
+        reference = baseline["results"].get(key)
+        if reference is None:
+            continue
+        change = result["frames_per_second"] / reference["frames_per_second"] - 1
+        if change < -tolerance:
+            regressions.append("%s: %.0f frames/s instead of %.0f (%+.0f%%)" % (key, result["frames_per_second"], reference["frames_per_second"], 100 * change))
+        # One block of margin: the blocks per frame are averages and can vary slightly between runs
+        if result["blocks_per_frame"] > reference["blocks_per_frame"] * (1 + tolerance) + 1:
+            regressions.append("%s: %.1f blocks per frame instead of %.1f" % (key, result["blocks_per_frame"], reference["blocks_per_frame"]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the frame decoding and encoding")
+    parser.add_argument("--versions", default=",".join(VERSIONS), help="NatNet versions (comma separated)")
+    parser.add_argument("--shapes", default=",".join(SHAPES), help="frame shapes (comma separated): " + ", ".join(SHAPES))
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS), help="benchmarks (comma separated): " + ", ".join(BENCHMARKS))
+    parser.add_argument("--min-time", type=float, default=0.2, help="duration (seconds) of each run")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark (the best is kept)")
+    parser.add_argument("--save", help="file where the results are saved (JSON)")
+    parser.add_argument("--baseline", help="results saved before, to which the results are compared")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="slowdown (fraction) above which a case is a regression")
+    args = parser.parse_args()
+
+    versions = args.versions.split(",")
+    shapes = args.shapes.split(",")
+    benchmarks = args.benchmarks.split(",")
+    for shape_name in shapes:
+        if shape_name not in SHAPES:
+            parser.error("unknown shape " + shape_name)
+    for benchmark in benchmarks:
+        if benchmark not in BENCHMARKS:
+            parser.error("unknown benchmark " + benchmark)
+
+    print("%-42s %12s %10s %10s %12s %9s" % ("case", "frames/s", "us/frame", "blocks", "peak bytes", "packet"))
+    results = run(versions, shapes, benchmarks, args.min_time, args.repeat)
+
+    if args.save is not None:
+        with open(args.save, "w") as results_file:
+            json.dump({
+                "version": RESULTS_VERSION,
+                "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": results
+            }, results_file, indent=4)
+        print("Results saved in " + args.save)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("version") != RESULTS_VERSION:
+            print("The baseline %s was saved by another version of the benchmarks (save a new one)" % args.baseline)
+            sys.exit(2)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions compared to %s:" % args.baseline)
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print("No regression compared to " + args.baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+# End-to-end load test of the bridge
+#
+# The harness runs the whole chain on the local computer:
+#   NatNetServer (simulator of Motive) -> bridge (NatNetClient.start()/run() in its own process) -> websocket sink
+# The simulator and the websocket sink (stand-in for the websocket server of the experiments) run in the
+# process of the harness, the bridge runs in a child process started with --bridge, so the three don't compete
+# for the same interpreter lock. The bridge uses the configuration of settings.py (websocket subscription,
+# frame buffer, compression, ...) except the addresses and the rigid body filter, which are set to match the
+# simulator. The simulator sends the frames in unicast to the data socket of the bridge.
+#
+# Each step streams frames at a given rate with a given number of rigid bodies. After a warm up, the frames sent
+# during --duration seconds are followed to the sink:
+#   throughput      frames received by the sink per second
+#   loss            fraction of the frames sent which never reached the sink
+#   latency         time from the transmission by the simulator to the reception by the sink (percentiles)
+# A step is sustained if the loss is at most --max-loss and the 99th percentile of the latency at most
+# --max-latency. For each number of rigid bodies the rate is increased (x --rate-step) until a step is not
+# sustained, then the saturation point is searched between the last sustained rate and the first failing one.
+# If the simulator itself can't keep up with the rate, the search stops there (the result is a lower bound).
+# The sink reads the frame number and the timestamp of the JSON messages (WEBSOCKET_BINARY_FORMAT must be off).
+#
+# Usage: python -m benchmarks.load_harness --rigid-bodies 10,100,300 [--save results.json]
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import websockets
+
+from modules.NatNetServer import FrameGenerator, NatNetServer
+
+LABEL_BASE = "RigidBody"
+FIRST_RIGID_BODY_ID = 1
+DATA_PORT_LINE = "DATA_PORT "
+
+# Beginning of the JSON messages of the bridge: {"type": "optitrack-data", "data": {"frame_number": 12, "timestamp": 0.05, ...
+FRAME_HEADER = re.compile(r'"frame_number": (\d+), "timestamp": ([-+.0-9eE]+)')
+
+def get_percentile(sorted_values, percentile):
+    if not sorted_values:
+        return None
+    last = len(sorted_values) - 1
+    return sorted_values[min(last, int(round(percentile / 100 * last)))]
+
+class WebsocketSink:
+    """ Websocket server receiving the frames of the bridge: reception time, frame number and timestamp of each frame """
+    def __init__(self, host="127.0.0.1", port=8765):
+        self.host = host
+        self.port = port
+        self.samples = []
+        self.messages = 0
+        self.connections = 0
+        self.__loop = None
+        self.__stop = None
+        self.__thread = None
+        self.__ready = threading.Event()
+
+    def start(self):
+        self.__thread = threading.Thread(target=lambda: asyncio.run(self.__serve()), name="WebsocketSink")
+        self.__thread.start()
+        if not self.__ready.wait(10):
+            raise RuntimeError("The websocket sink didn't start")
+
+    def stop(self):
+        if self.__loop is not None:
+            self.__loop.call_soon_threadsafe(self.__stop.set)
+        self.__thread.join()
+
+    def take_samples(self):
+        """ Return the samples received since the last call """
+        samples = self.samples
+        self.samples = []
+        return samples
+
+    async def __serve(self):
+        self.__loop = asyncio.get_running_loop()
+        self.__stop = asyncio.Event()
+        async with websockets.serve(self.__handle_connection, self.host, self.port, max_size=None):
+            self.__ready.set()
+            await self.__stop.wait()
+
+    async def __handle_connection(self, websocket, path=None):
+        self.connections += 1
+        try:
+            async for message in websocket:
+                receive_time = time.perf_counter()
+                self.messages += 1
+                if isinstance(message, bytes):
+                    continue
+                # A batch message has several frames
+                for match in FRAME_HEADER.finditer(message):
+                    self.samples.append((receive_time, int(match.group(1)), float(match.group(2))))
+        except websockets.ConnectionClosed:
+            pass
+
+class BridgeProcess:
+    """ Bridge running in a child process (python -m benchmarks.load_harness --bridge) """
+    def __init__(self, command_port, sink_port, max_rigid_bodies, log_path=None):
+        self.command = [sys.executable, "-m", "benchmarks.load_harness", "--bridge", "--command-port", str(command_port),
+                        "--sink-port", str(sink_port), "--max-rigid-bodies", str(max_rigid_bodies)]
+        self.log_path = log_path
+        self.process = None
+        self.data_port = None
+        self.__data_port_ready = threading.Event()
+
+    def start(self, timeout=30):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.process = subprocess.Popen(self.command, cwd=root, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        threading.Thread(target=self.__read_output, name="BridgeOutput", daemon=True).start()
+        if not self.__data_port_ready.wait(timeout):
+            self.stop()
+            raise RuntimeError("The bridge didn't start (see its output with --bridge-log)")
+
+    def __read_output(self):
+        log_file = open(self.log_path, "w") if self.log_path is not None else None
+        try:
+            for line in self.process.stdout:
+                if line.startswith(DATA_PORT_LINE):
+                    self.data_port = int(line[len(DATA_PORT_LINE):])
+                    self.__data_port_ready.set()
+                elif log_file is not None:
+                    log_file.write(line)
+        finally:
+            if log_file is not None:
+                log_file.close()
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            # The bridge stops like with Ctrl+C
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process = None
+
+class LoadHarness:
+    def __init__(self, version="4.1", markers_per_rigid_body=3, command_port=1510, sink_port=8765, warmup=1.0, duration=3.0,
+                 max_loss=0.01, max_latency=50.0, bridge_log=None):
+        self.major, self.minor = [int(value) for value in version.split(".")]
+        self.markers_per_rigid_body = markers_per_rigid_body
+        self.command_port = command_port
+        self.warmup = warmup
+        self.duration = duration
+        self.max_loss = max_loss
+        self.max_latency = max_latency
+        self.sink = WebsocketSink(port=sink_port)
+        self.bridge_log = bridge_log
+        self.bridge = None
+        self.server = None
+
+    def start(self, max_rigid_bodies):
+        self.sink.start()
+        # The bridge connects to the simulator when it starts: a first simulator answers its requests
+        self.__start_server(1, 1)
+        self.bridge = BridgeProcess(self.command_port, self.sink.port, max_rigid_bodies, self.bridge_log)
+        self.bridge.start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+        if self.bridge is not None:
+            self.bridge.stop()
+            self.bridge = None
+        self.sink.stop()
+
+    def __start_server(self, rate, rigid_body_count):
+        frame_generator = FrameGenerator(self.major, self.minor, rate=rate, rigid_body_count=rigid_body_count, markers_per_rigid_body=self.markers_per_rigid_body,
+                                         first_rigid_body_id=FIRST_RIGID_BODY_ID, label_base=LABEL_BASE)
+        data_addresses = []
+        if self.bridge is not None:
+            data_addresses.append(("127.0.0.1", self.bridge.data_port))
+        self.server = NatNetServer(frame_generator, command_port=self.command_port, use_multicast=False, data_addresses=data_addresses, send_to_clients=False)
+        self.server.start()
+
+    def run_step(self, rate, rigid_body_count):
+        """ Stream at rate with rigid_body_count rigid bodies and return the measures of the step """
+        if self.server is not None:
+            self.server.stop()
+        self.__start_server(rate, rigid_body_count)
+        server = self.server
+        try:
+            time.sleep(self.warmup)
+            self.sink.take_samples()
+            first_frame = server.frames_sent
+            first_late = server.frames_late
+            start = time.perf_counter()
+            time.sleep(self.duration)
+            last_frame = server.frames_sent
+            elapsed = time.perf_counter() - start
+            late = server.frames_late - first_late
+
+            # The frames still in the bridge arrive after the end of the window
+            time.sleep(min(1.0, self.duration / 2))
+            samples = self.sink.take_samples()
+        finally:
+            server.stop()
+            self.server = None
+
+        frame_numbers = set()
+        latencies = []
+        for receive_time, frame_number, timestamp in samples:
+            if first_frame <= frame_number < last_frame and frame_number not in frame_numbers:
+                frame_numbers.add(frame_number)
+                latencies.append(1000 * (receive_time - (server.start_time + timestamp)))
+        latencies.sort()
+        sent = last_frame - first_frame
+        step = {
+            "rate": rate,
+            "rigid_bodies": rigid_body_count,
+            "frames_sent": sent,
+            "frames_received": len(frame_numbers),
+            "send_rate": sent / elapsed,
+            "throughput": len(frame_numbers) / elapsed,
+            "loss": 1 - len(frame_numbers) / sent if sent > 0 else 0.0,
+            "latency_p50_ms": get_percentile(latencies, 50),
+            "latency_p95_ms": get_percentile(latencies, 95),
+            "latency_p99_ms": get_percentile(latencies, 99),
+            "packet_size": len(server.frame_generator.packets[0]),
+            # The simulator is the limit if it couldn't send the frames at the rate
+            "source_limited": late > 0.01 * sent or sent < 0.95 * rate * elapsed
+        }
+        step["sustained"] = step["loss"] <= self.max_loss and step["latency_p99_ms"] is not None and step["latency_p99_ms"] <= self.max_latency
+        if not self.bridge.is_running():
+            raise RuntimeError("The bridge stopped (see its output with --bridge-log)")
+        return step
+
+    def find_saturation(self, rigid_body_count, start_rate, max_rate, rate_step, refine_steps, on_step=None):
+        """ Return the highest sustained rate found for rigid_body_count rigid bodies and the steps run """
+        steps = []
+        def run(rate):
+            step = self.run_step(rate, rigid_body_count)
+            steps.append(step)
+            if on_step is not None:
+                on_step(step)
+            return step
+
+        # Ramp up until the first step which is not sustained
+        best = None
+        failed_rate = None
+        rate = start_rate
+        while rate <= max_rate:
+            step = run(rate)
+            if step["source_limited"] and step["sustained"]:
+                return {"rigid_bodies": rigid_body_count, "saturation_rate": None, "best": step, "source_limited": True}, steps
+            if not step["sustained"]:
+                failed_rate = rate
+                break
+            best = step
+            rate = round(rate * rate_step)
+        if failed_rate is None:
+            return {"rigid_bodies": rigid_body_count, "saturation_rate": None, "best": best, "source_limited": False}, steps
+
+        # Search between the last sustained rate and the first failing one
+        low = best["rate"] if best is not None else 0
+        high = failed_rate
+        for _ in range(refine_steps):
+            rate = round((low + high) / 2)
+            if rate <= low or rate >= high:
+                break
+            step = run(rate)
+            if step["sustained"]:
+                low = rate
+                best = step
+            else:
+                high = rate
+        return {"rigid_bodies": rigid_body_count, "saturation_rate": best["rate"] if best is not None else 0, "best": best, "source_limited": False}, steps
+
+def run_bridge(args):
+    """ Child process: run the bridge against the simulator and the sink of the harness """
+    from modules.NatNetClient import NatNetClient
+
+    # The harness runs without Motive and without internet access, and doesn't write the log file of the bridge
+    client = NatNetClient(verify_connection=False, log_path=None)
+    client.set_client_address("127.0.0.1")
+    client.set_server_address("127.0.0.1")
+    client.set_use_multicast(False)
+    client.command_port = args.command_port
+    client.set_websocket_connection_url("127.0.0.1", port=args.sink_port)
+    client.set_rigid_body_filter([{"id_range": [FIRST_RIGID_BODY_ID, FIRST_RIGID_BODY_ID + args.max_rigid_bodies - 1]}, {"name_prefix": LABEL_BASE}])
+    client.start()
+    print(DATA_PORT_LINE + str(client.data_socket.getsockname()[1]))
+    sys.stdout.flush()
+    client.run()
+
+def format_step(step):
+    latency = "-" if step["latency_p50_ms"] is None else "%7.2f %7.2f %7.2f" % (step["latency_p50_ms"], step["latency_p95_ms"], step["latency_p99_ms"])
+    return "%6d %7d %10.1f %10.1f %7.2f%%  %-23s %s%s" % (step["rigid_bodies"], step["rate"], step["send_rate"], step["throughput"], 100 * step["loss"], latency,
+                                                           "ok" if step["sustained"] else "saturated", " (source limited)" if step["source_limited"] else "")
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test of the bridge")
+    parser.add_argument("--rigid-bodies", default="10,100,300", help="numbers of rigid bodies (comma separated)")
+    parser.add_argument("--markers", type=int, default=3, help="markers for each rigid body")
+    parser.add_argument("--version", default="4.1", help="NatNet version of the frames (major.minor)")
+    parser.add_argument("--start-rate", type=int, default=120, help="first rate (frames per second)")
+    parser.add_argument("--max-rate", type=int, default=4000, help="highest rate tested")
+    parser.add_argument("--rate-step", type=float, default=1.5, help="factor between two rates of the ramp")
+    parser.add_argument("--refine", type=int, default=3, help="steps of the search between the last sustained rate and the first failing one")
+    parser.add_argument("--warmup", type=float, default=1.0, help="seconds before the measure of each step")
+    parser.add_argument("--duration", type=float, default=3.0, help="seconds measured in each step")
+    parser.add_argument("--max-loss", type=float, default=0.01, help="highest fraction of lost frames of a sustained step")
+    parser.add_argument("--max-latency", type=float, default=50.0, help="highest 99th percentile of the latency (ms) of a sustained step")
+    parser.add_argument("--command-port", type=int, default=1510)
+    parser.add_argument("--sink-port", type=int, default=8765)
+    parser.add_argument("--save", help="file where the results are saved (JSON)")
+    parser.add_argument("--bridge-log", help="file where the output of the bridge is written")
+    parser.add_argument("--bridge", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--max-rigid-bodies", type=int, default=1000, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.bridge:
+        run_bridge(args)
+        return
+
+    rigid_body_counts = [int(value) for value in args.rigid_bodies.split(",")]
+    harness = LoadHarness(args.version, args.markers, args.command_port, args.sink_port, args.warmup, args.duration, args.max_loss, args.max_latency, args.bridge_log)
+    results = []
+    all_steps = []
+    print("bodies    rate   sent/s   received/s    loss  latency ms p50/p95/p99")
+    harness.start(max(rigid_body_counts))
+    try:
+        for rigid_body_count in rigid_body_counts:
+            result, steps = harness.find_saturation(rigid_body_count, args.start_rate, args.max_rate, args.rate_step, args.refine, on_step=lambda step: print(format_step(step), flush=True))
+            results.append(result)
+            all_steps += steps
+    except KeyboardInterrupt:
+        pass
+    finally:
+        harness.stop()
+
+    print("\nSaturation points")
+    for result in results:
+        best = result["best"]
+        if result["source_limited"]:
+            summary = "not reached: the simulator is the limit (%d frames/s sustained)" % best["rate"]
+        elif result["saturation_rate"] is None:
+            summary = "not reached below %d frames/s" % args.max_rate
+        elif best is None:
+            summary = "not sustained at %d frames/s" % args.start_rate
+        else:
+            summary = "%d frames/s (p99 latency %.2f ms, loss %.2f%%)" % (result["saturation_rate"], best["latency_p99_ms"], 100 * best["loss"])
+        print("  %5d rigid bodies: %s" % (result["rigid_bodies"], summary))
+
+    if args.save is not None:
+        with open(args.save, "w") as results_file:
+            json.dump({"settings": vars(args), "results": results, "steps": all_steps}, results_file, indent=4)
+        print("Results saved in " + args.save)
+
+if __name__ == '__main__':
+    main()
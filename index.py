@@ -8,7 +8,12 @@ if __name__ == '__main__':
         streaming_client.set_client_address(CLIENT_ADDRESS)
         streaming_client.set_server_address(OPTITRACK_ADDRESS)
         streaming_client.set_use_multicast(USE_MULTICAST)
-        streaming_client.set_websocket_connection_url(WEBSOCKET_SERVER_ADDRESS, is_DNS=IS_WEBSOCKET_ADDRESS_DNS)
+        if REPLAY_PATH is not None:
+            streaming_client.set_replay(REPLAY_PATH, speed=REPLAY_SPEED, start_frame=REPLAY_START_FRAME, loop=REPLAY_LOOP)
+        if WEBSOCKET_MODE == "server":
+            streaming_client.set_websocket_server(WEBSOCKET_LISTEN_HOST, WEBSOCKET_LISTEN_PORT)
+        else:
+            streaming_client.set_websocket_connection_url(WEBSOCKET_SERVER_ADDRESS, is_DNS=IS_WEBSOCKET_ADDRESS_DNS)
 
         ##### Start the streaming client #####
         streaming_client.start()
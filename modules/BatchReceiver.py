@@ -0,0 +1,112 @@
+# Batched receiver for the NatNet data socket
+#
+# The receiver reads the datagrams queued on a non-blocking UDP socket by batches of up to batch_size.
+# The event loop reads one batch each time the socket is readable, so the sender of the websocket runs
+# between the batches (the frame buffer must hold a whole batch, see DATA_QUEUE_SIZE in the settings).
+# On Linux the datagrams are read with a single recvmmsg call, on the other platforms
+# it falls back to a loop of non-blocking recv_into calls.
+# In both cases the datagrams are written in buffers allocated once at startup, so the
+# returned memoryviews are valid only until the next call to receive_batch().
+
+import ctypes
+import ctypes.util
+import errno
+import socket
+import sys
+
+# Definition of the structures used by recvmmsg (see "man recvmmsg")
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IOVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+def _load_recvmmsg():
+    """ Return the recvmmsg function of the C library or None if it's not available """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+_recvmmsg = _load_recvmmsg()
+
+class BatchReceiver:
+    def __init__(self, sock, batch_size=32, buffer_size=64*1024, use_recvmmsg=True):
+        self.sock = sock
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+
+        # Preallocated buffers (one for each datagram of a batch)
+        self.buffers = [bytearray(buffer_size) for _ in range(batch_size)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+
+        # Statistics
+        self.syscall_count = 0
+        self.datagram_count = 0
+
+        self.use_recvmmsg = use_recvmmsg and _recvmmsg is not None
+        if self.use_recvmmsg:
+            self.__setup_recvmmsg()
+
+    def __setup_recvmmsg(self):
+        self.__c_buffers = [(ctypes.c_char * self.buffer_size).from_buffer(buffer) for buffer in self.buffers]
+        self.__iovecs = (_IOVec * self.batch_size)()
+        self.__msgs = (_MMsgHdr * self.batch_size)()
+        for i in range(self.batch_size):
+            self.__iovecs[i].iov_base = ctypes.addressof(self.__c_buffers[i])
+            self.__iovecs[i].iov_len = self.buffer_size
+            self.__msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.__iovecs[i])
+            self.__msgs[i].msg_hdr.msg_iovlen = 1
+
+    def is_using_recvmmsg(self):
+        return self.use_recvmmsg
+
+    def __receive_batch_recvmmsg(self):
+        self.syscall_count += 1
+        count = _recvmmsg(self.sock.fileno(), self.__msgs, self.batch_size, socket.MSG_DONTWAIT, None)
+        if count < 0:
+            error_code = ctypes.get_errno()
+            if error_code in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(error_code, "recvmmsg: " + errno.errorcode.get(error_code, str(error_code)))
+        msgs = self.__msgs
+        views = self.views
+        return [views[i][:msgs[i].msg_len] for i in range(count)]
+
+    def __receive_batch_recv_into(self):
+        batch = []
+        recv_into = self.sock.recv_into
+        for view in self.views:
+            self.syscall_count += 1
+            try:
+                size = recv_into(view)
+            except (BlockingIOError, InterruptedError):
+                break
+            batch.append(view[:size])
+        return batch
+
+    def receive_batch(self):
+        """ Receive up to batch_size datagrams without blocking """
+        if self.use_recvmmsg:
+            batch = self.__receive_batch_recvmmsg()
+        else:
+            batch = self.__receive_batch_recv_into()
+        self.datagram_count += len(batch)
+        return batch
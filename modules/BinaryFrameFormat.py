@@ -0,0 +1,120 @@
+# Binary format of the websocket messages (reference decoder)
+#
+# The binary format is used only if the websocket server selects the BINARY_SUBPROTOCOL subprotocol
+# during the handshake (the bridge offers it if WEBSOCKET_BINARY_FORMAT is True). Otherwise the JSON format is used.
+# Each message is a binary websocket message with all the values little-endian and without padding:
+#
+#   Header (20 bytes)
+#     magic               2 bytes   b"OT"
+#     version             uint8     FORMAT_VERSION
+#     flags               uint8     bit 0: no position in the rigid body records, bit 1: no orientation,
+#                                   bit 2: delta frame (only the rigid bodies which moved are in the frame)
+#     frame_number        uint32
+#     timestamp           float64   seconds
+#     rigid_body_count    uint16
+#     marker_count        uint16
+#   rigid_body_count rigid body records (33 bytes each, less if some fields are not subscribed)
+#     id                  uint32
+#     x, y, z             float32   (if bit 0 of flags is not set)
+#     qx, qy, qz, qw      float32   (if bit 1 of flags is not set)
+#     flags               uint8     bit 0: tracking valid
+#   marker_count marker records (18 bytes each)
+#     rigid_body_id       uint32    id of the rigid body of the marker set (NO_RIGID_BODY_ID if unknown)
+#     id                  uint16    index of the marker in its marker set (starting from 1)
+#     x, y, z             float32
+#
+# A batched message (subscription with "batch" or "window") is the concatenation of several frames.
+#
+# This module can be copied as it is in a Python consumer: it doesn't depend on the rest of the bridge.
+
+import struct
+
+SUBPROTOCOL = "optitrack.binary.v1"
+JSON_SUBPROTOCOL = "optitrack.json"
+MAGIC = b"OT"
+FORMAT_VERSION = 1
+NO_RIGID_BODY_ID = 0xffffffff
+
+HEADER_FORMAT = "2sBBIdHH"
+RIGID_BODY_RECORD_FORMAT = "I7fB"
+RIGID_BODY_RECORD_FORMATS = {
+    0: RIGID_BODY_RECORD_FORMAT,
+    1: "I4fB",
+    2: "I3fB",
+    3: "IB"
+}
+MARKER_RECORD_FORMAT = "IH3f"
+
+Header = struct.Struct("<" + HEADER_FORMAT)
+RigidBodyRecord = struct.Struct("<" + RIGID_BODY_RECORD_FORMAT)
+MarkerRecord = struct.Struct("<" + MARKER_RECORD_FORMAT)
+
+RIGID_BODY_TRACKING_VALID = 0x01
+
+# Flags of the header
+NO_POSITION = 0x01
+NO_ORIENTATION = 0x02
+DELTA = 0x04
+
+def get_message_format(rigid_body_count, marker_count, flags=0):
+    """ Return the struct format of a whole message """
+    return "<" + HEADER_FORMAT + RIGID_BODY_RECORD_FORMATS[flags & 0x03]*rigid_body_count + MARKER_RECORD_FORMAT*marker_count
+
+def decode_frame(message, rigid_body_names=None):
+    """ Decode a binary message in the same dictionary sent with the JSON format """
+    return decode_frame_at(message, 0, rigid_body_names)[0]
+
+def decode_frames(message, rigid_body_names=None):
+    """ Decode a batched binary message in the list of its frames """
+    frames = []
+    offset = 0
+    while offset < len(message):
+        frame, offset = decode_frame_at(message, offset, rigid_body_names)
+        frames.append(frame)
+    return frames
+
+def decode_frame_at(message, offset, rigid_body_names=None):
+    """ Decode the frame starting at offset. Return the frame and the offset of its end """
+    magic, version, flags, frame_number, timestamp, rigid_body_count, marker_count = Header.unpack_from(message, offset)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError("Unsupported binary frame (magic %r, version %d)" % (magic, version))
+    offset += Header.size
+    rigid_body_record = struct.Struct("<" + RIGID_BODY_RECORD_FORMATS[flags & 0x03])
+    has_position = ( flags & NO_POSITION ) == 0
+    has_orientation = ( flags & NO_ORIENTATION ) == 0
+    expected_size = offset + rigid_body_record.size*rigid_body_count + MarkerRecord.size*marker_count
+    if len(message) < expected_size:
+        raise ValueError("Truncated binary frame (%d bytes instead of %d)" % (len(message), expected_size))
+    message = memoryview(message)
+
+    mocap_data = []
+    rigid_body_end = offset + rigid_body_record.size*rigid_body_count
+    for values in rigid_body_record.iter_unpack(message[offset:rigid_body_end]):
+        item = {'type': 'rigidBody', 'ID': values[0]}
+        index = 1
+        if has_position:
+            item['x'], item['y'], item['z'] = values[index:index + 3]
+            index += 3
+        if has_orientation:
+            item['qx'], item['qy'], item['qz'], item['qw'] = values[index:index + 4]
+        item['valid'] = ( values[-1] & RIGID_BODY_TRACKING_VALID ) != 0
+        mocap_data.append(item)
+
+    # The marker sets are identified by the id of their rigid body: rigid_body_names (id -> name) gives back their name
+    if rigid_body_names is None:
+        rigid_body_names = {}
+    for rigid_body_id, marker_id, x, y, z in MarkerRecord.iter_unpack(message[rigid_body_end:expected_size]):
+        mocap_data.append({
+            'type': 'marker',
+            'ID': marker_id,
+            'rigidBodyID': None if rigid_body_id == NO_RIGID_BODY_ID else rigid_body_id,
+            'rigidBody': rigid_body_names.get(rigid_body_id),
+            'x': x,
+            'y': y,
+            'z': z
+        })
+
+    frame = {"frame_number": frame_number, "timestamp": timestamp, "mocap_data": mocap_data}
+    if flags & DELTA:
+        frame["delta"] = True
+    return frame, expected_size
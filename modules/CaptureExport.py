@@ -0,0 +1,314 @@
+# Export of a capture (see PacketCapture) to memory-mapped column arrays
+#
+# The frames of the capture are decoded once more with NatNetClient and their rigid bodies and labeled
+# markers are written in NumPy (.npy) files, which can be opened with np.load(..., mmap_mode='r') so that any
+# range of frames is read without copy and without loading the whole session in memory.
+# The conversion is done in two passes over the capture: the first one finds the size of the arrays (rigid
+# bodies, number of labeled markers), the second one fills the arrays created on disk with open_memmap.
+# The capture must contain the server info packet before its first frame (it gives the NatNet version of the
+# frames). The packets which can't be decoded are skipped and counted, as the bridge does with the live stream.
+#
+# Layout of the export directory:
+#   index.json                              frame count, rigid body ids, NatNet version, records skipped and source capture
+#   frames/frame_number.npy                 (N,) uint32
+#   frames/timestamp.npy                    (N,) float64    timestamp of the frame (seconds, Motive clock)
+#   frames/receive_time.npy                 (N,) uint64     receive time of the packet (nanoseconds, monotonic)
+#   rigid_bodies/<id>/position.npy          (N, 3) float32  NaN in the frames without the rigid body
+#   rigid_bodies/<id>/quaternion.npy        (N, 4) float32  (qx, qy, qz, qw)
+#   rigid_bodies/<id>/valid.npy             (N,) bool       tracking valid
+#   labeled_markers/frame_offsets.npy       (N+1,) uint64   the markers of frame i are the rows frame_offsets[i]:frame_offsets[i+1]
+#   labeled_markers/model_id.npy            (M,) uint16
+#   labeled_markers/marker_id.npy           (M,) uint16
+#   labeled_markers/position.npy            (M, 3) float32
+#   labeled_markers/size.npy                (M,) float32
+#   labeled_markers/residual.npy            (M,) float32
+#   labeled_markers/occluded.npy            (M,) bool
+# NumPy is needed (optional dependency of the bridge).
+
+import json
+import os
+import sys
+import tempfile
+
+try:
+    import numpy as np
+    from numpy.lib.format import open_memmap
+except ImportError:
+    np = None
+
+import modules.ColumnarData as ColumnarData
+import modules.MoCapData as MoCapData
+from modules.NatNetClient import NatNetClient, DecodeSelection, generate_test_frame_packet, generate_test_server_info_packet
+from modules.PacketCapture import CaptureReader, NO_FRAME_NUMBER, SOURCE_COMMAND, SOURCE_DATA, record_test_capture
+
+EXPORT_VERSION = 1
+INDEX_FILE = "index.json"
+
+def create_decoder():
+    """ Client used to decode the frames of the capture (all the rigid bodies and the labeled markers, nothing else). It works offline and doesn't write a log file """
+    decoder = NatNetClient(verify_connection=False, log_path=None)
+    decoder.set_rigid_body_filter(None)
+    decoder.set_decode_mode("numpy")
+    decoder.set_decode_selection(DecodeSelection(sections=("rigid_bodies", "labeled_markers")))
+    return decoder
+
+def get_rigid_body_columns(rigid_body_data):
+    """ Return the ids, positions, quaternions and tracking flags of the rigid bodies as arrays """
+    if isinstance(rigid_body_data, ColumnarData.RigidBodyColumns):
+        return rigid_body_data.ids, rigid_body_data.positions, rigid_body_data.quaternions, rigid_body_data.tracking_valid
+    rigid_bodies = rigid_body_data.get_rigid_body_list()
+    ids = np.array([rigid_body.id_num for rigid_body in rigid_bodies], dtype=np.uint32)
+    positions = np.array([rigid_body.pos for rigid_body in rigid_bodies], dtype=np.float32).reshape(-1, 3)
+    quaternions = np.array([rigid_body.rot for rigid_body in rigid_bodies], dtype=np.float32).reshape(-1, 4)
+    tracking_valid = np.array([rigid_body.tracking_valid for rigid_body in rigid_bodies], dtype=bool)
+    return ids, positions, quaternions, tracking_valid
+
+def get_labeled_marker_columns(labeled_marker_data):
+    """ Return the labeled markers as a LabeledMarkerColumns """
+    if isinstance(labeled_marker_data, ColumnarData.LabeledMarkerColumns):
+        return labeled_marker_data
+    labeled_markers = labeled_marker_data.get_labeled_markers_list()
+    records = np.zeros(len(labeled_markers), dtype=ColumnarData.LABELED_MARKER_DTYPE)
+    for i, labeled_marker in enumerate(labeled_markers):
+        records[i] = (labeled_marker.id_num, labeled_marker.pos, labeled_marker.size, labeled_marker.param, labeled_marker.residual)
+    return ColumnarData.LabeledMarkerColumns(records)
+
+def check_server_info(reader):
+    """ Raise a ValueError if the capture has no server info packet before its first frame """
+    for record in reader.records():
+        if record.message_id == NatNetClient.NAT_SERVERINFO:
+            return
+        if record.frame_number != NO_FRAME_NUMBER:
+            break
+    raise ValueError("The capture has no server info packet before its first frame, the NatNet version of its frames is unknown: " + reader.capture_path)
+
+def decode_frames(reader, decoder, skipped_records=None):
+    """ Iterate over the frames of the capture: receive time and MoCapData (the other packets update the decoder).
+    The offsets of the records which can't be decoded are added to skipped_records """
+    for record in reader.records():
+        try:
+            mocap_data = decoder.decode_packet(record.data)
+        except Exception:
+            if skipped_records is not None:
+                skipped_records.append(record.offset)
+            continue
+        if mocap_data is not None:
+            yield record.receive_time, mocap_data
+
+def export_capture(capture_path, export_path):
+    """ Export the capture in the directory export_path. Return the number of frames exported """
+    if np is None:
+        raise RuntimeError("The export of the captures requires numpy to be installed")
+
+    with CaptureReader(capture_path) as reader:
+        check_server_info(reader)
+
+        # First pass: number of frames, rigid bodies and number of labeled markers
+        frame_count = 0
+        labeled_marker_count = 0
+        rigid_body_ids = set()
+        skipped_records = []
+        for receive_time, mocap_data in decode_frames(reader, create_decoder(), skipped_records):
+            frame_count += 1
+            rigid_body_ids.update(get_rigid_body_columns(mocap_data.get_rigid_body_data())[0].tolist())
+            labeled_marker_count += get_labeled_marker_columns(mocap_data.get_labeled_marker_data()).get_labeled_marker_count()
+        rigid_body_ids = sorted(rigid_body_ids)
+
+        # Arrays on disk
+        def create_array(name, shape, dtype, fill_value=None):
+            path = os.path.join(export_path, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            array = open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+            if fill_value is not None:
+                array[:] = fill_value
+            return array
+
+        frame_numbers = create_array("frames/frame_number.npy", (frame_count,), np.uint32)
+        timestamps = create_array("frames/timestamp.npy", (frame_count,), np.float64)
+        receive_times = create_array("frames/receive_time.npy", (frame_count,), np.uint64)
+        rigid_bodies = {}
+        for rigid_body_id in rigid_body_ids:
+            rigid_bodies[rigid_body_id] = (
+                create_array("rigid_bodies/%d/position.npy" % rigid_body_id, (frame_count, 3), np.float32, np.nan),
+                create_array("rigid_bodies/%d/quaternion.npy" % rigid_body_id, (frame_count, 4), np.float32, np.nan),
+                create_array("rigid_bodies/%d/valid.npy" % rigid_body_id, (frame_count,), bool, False))
+        frame_offsets = create_array("labeled_markers/frame_offsets.npy", (frame_count + 1,), np.uint64)
+        model_ids = create_array("labeled_markers/model_id.npy", (labeled_marker_count,), np.uint16)
+        marker_ids = create_array("labeled_markers/marker_id.npy", (labeled_marker_count,), np.uint16)
+        marker_positions = create_array("labeled_markers/position.npy", (labeled_marker_count, 3), np.float32)
+        marker_sizes = create_array("labeled_markers/size.npy", (labeled_marker_count,), np.float32)
+        marker_residuals = create_array("labeled_markers/residual.npy", (labeled_marker_count,), np.float32)
+        marker_occluded = create_array("labeled_markers/occluded.npy", (labeled_marker_count,), bool)
+
+        # Second pass: fill the arrays (the decoder starts again from the beginning of the capture)
+        decoder = create_decoder()
+        row = 0
+        for frame, (receive_time, mocap_data) in enumerate(decode_frames(reader, decoder)):
+            frame_numbers[frame] = mocap_data.prefix_data.frame_number
+            timestamps[frame] = mocap_data.suffix_data.timestamp
+            receive_times[frame] = receive_time
+
+            ids, positions, quaternions, tracking_valid = get_rigid_body_columns(mocap_data.get_rigid_body_data())
+            for i, rigid_body_id in enumerate(ids.tolist()):
+                rigid_body_positions, rigid_body_quaternions, rigid_body_valid = rigid_bodies[rigid_body_id]
+                rigid_body_positions[frame] = positions[i]
+                rigid_body_quaternions[frame] = quaternions[i]
+                rigid_body_valid[frame] = tracking_valid[i]
+
+            labeled_markers = get_labeled_marker_columns(mocap_data.get_labeled_marker_data())
+            frame_offsets[frame] = row
+            end = row + labeled_markers.get_labeled_marker_count()
+            model_ids[row:end] = labeled_markers.model_ids
+            marker_ids[row:end] = labeled_markers.marker_ids
+            marker_positions[row:end] = labeled_markers.positions
+            marker_sizes[row:end] = labeled_markers.sizes
+            marker_residuals[row:end] = labeled_markers.residuals
+            marker_occluded[row:end] = labeled_markers.occluded
+            row = end
+        frame_offsets[frame_count] = row
+
+        arrays = [frame_numbers, timestamps, receive_times, frame_offsets, model_ids, marker_ids, marker_positions, marker_sizes, marker_residuals, marker_occluded]
+        for rigid_body_arrays in rigid_bodies.values():
+            arrays.extend(rigid_body_arrays)
+        for array in arrays:
+            array.flush()
+
+        index = {
+            "version": EXPORT_VERSION,
+            "capture": os.path.abspath(reader.capture_path),
+            "frame_count": frame_count,
+            "labeled_marker_count": labeled_marker_count,
+            "rigid_body_ids": rigid_body_ids,
+            "nat_net_version": [decoder.get_major(), decoder.get_minor()],
+            "records_skipped": len(skipped_records)
+        }
+    with open(os.path.join(export_path, INDEX_FILE), "w") as index_file:
+        json.dump(index, index_file, indent=4)
+    return frame_count
+
+class CaptureExport:
+    """ Read an export. The arrays are memory mapped and the ranges of frames are returned as views (no copy) """
+    def __init__(self, path):
+        if np is None:
+            raise RuntimeError("Reading the exports requires numpy to be installed")
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE), "r") as index_file:
+            self.index = json.load(index_file)
+        if self.index["version"] != EXPORT_VERSION:
+            raise ValueError("Unsupported export version: " + str(self.index["version"]))
+        self.__arrays = {}
+
+    def __get_array(self, name):
+        array = self.__arrays.get(name)
+        if array is None:
+            array = np.load(os.path.join(self.path, name), mmap_mode="r")
+            self.__arrays[name] = array
+        return array
+
+    def get_frame_count(self):
+        return self.index["frame_count"]
+
+    def get_rigid_body_ids(self):
+        return self.index["rigid_body_ids"]
+
+    def find_frame(self, frame_number):
+        """ Return the position of the first frame with a frame number >= frame_number """
+        return int(np.searchsorted(self.__get_array("frames/frame_number.npy"), frame_number))
+
+    def get_frames(self, start=0, stop=None):
+        """ Return the frame numbers, the timestamps and the receive times of the frames start:stop """
+        return (self.__get_array("frames/frame_number.npy")[start:stop],
+                self.__get_array("frames/timestamp.npy")[start:stop],
+                self.__get_array("frames/receive_time.npy")[start:stop])
+
+    def get_rigid_body(self, rigid_body_id, start=0, stop=None):
+        """ Return the positions, the quaternions and the tracking flags of a rigid body in the frames start:stop """
+        name = "rigid_bodies/%d/" % rigid_body_id
+        return (self.__get_array(name + "position.npy")[start:stop],
+                self.__get_array(name + "quaternion.npy")[start:stop],
+                self.__get_array(name + "valid.npy")[start:stop])
+
+    def get_labeled_markers(self, start=0, stop=None):
+        """ Return the columns of the labeled markers of the frames start:stop (dictionary) and the offsets of the frames in them """
+        frame_offsets = self.__get_array("labeled_markers/frame_offsets.npy")
+        if stop is None:
+            stop = self.get_frame_count()
+        first = int(frame_offsets[start])
+        last = int(frame_offsets[stop])
+        columns = {}
+        for name in ("model_id", "marker_id", "position", "size", "residual", "occluded"):
+            columns[name] = self.__get_array("labeled_markers/%s.npy" % name)[first:last]
+        return columns, frame_offsets[start:stop + 1] - first
+
+def read_test_export(export_path):
+    """ Return the values of an export checked by the tests as lists (the memory mapped arrays are released on return) """
+    export = CaptureExport(export_path)
+    frames, timestamps, receive_times = export.get_frames()
+    values = {"Frames": (frames.tolist(), timestamps.tolist(), export.index["nat_net_version"], export.index["records_skipped"])}
+
+    # Pose of the last frame and tracking flags of all the frames
+    rigid_bodies = []
+    for rigid_body_id in export.get_rigid_body_ids():
+        positions, quaternions, valid = export.get_rigid_body(rigid_body_id)
+        rigid_bodies.append((rigid_body_id, positions[-1].tolist(), quaternions[-1].tolist(), valid.tolist()))
+    values["Rigid Bodies"] = rigid_bodies
+
+    columns, frame_offsets = export.get_labeled_markers(1, 3)
+    values["Labeled Markers"] = (frame_offsets.tolist(), columns["model_id"].tolist(), columns["marker_id"].tolist(), columns["position"][0].tolist())
+    return values
+
+def export_test_capture(major, minor):
+    """ Export a capture of frames of the NatNet version with a truncated frame in the middle. Return the expected and exported values of each test """
+    frame_numbers = [100, 101, 102, 104]
+    packets = [(generate_test_server_info_packet(major, minor), SOURCE_COMMAND)]
+    packets += [(generate_test_frame_packet(major, minor, frame_number), SOURCE_DATA) for frame_number in frame_numbers[:3]]
+    packets += [(generate_test_frame_packet(major, minor, 103)[:60], SOURCE_DATA)]
+    packets += [(generate_test_frame_packet(major, minor, frame_numbers[3]), SOURCE_DATA)]
+    quaternion = np.array([0.0, 0.6, 0.0, 0.8], dtype=np.float32).tolist()
+    expected_values = {
+        "Frames": (frame_numbers, [10.28125] * 4, [major, minor], 1),
+        "Rigid Bodies": [(2, [3.5, 4.25, 1.0], quaternion, [True] * 4), (3, [-0.5, 0.25, -3.0], quaternion, [False] * 4), (100, [1.5, 2.25, -1.0], quaternion, [True] * 4)],
+        "Labeled Markers": ([0, 2, 4], [100, 7, 100, 7], [1, 3, 1, 3], [1.0, 1.5, 2.0]),
+        "Without Server Info": True
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        capture_path = record_test_capture(os.path.join(directory, "session"), packets).capture_path
+        export_path = os.path.join(directory, "export")
+        export_capture(capture_path, export_path)
+        values = read_test_export(export_path)
+
+        # The frames of a capture without server info can't be decoded
+        capture_path = record_test_capture(os.path.join(directory, "no_server_info"), packets[1:]).capture_path
+        try:
+            export_capture(capture_path, os.path.join(directory, "no_server_info_export"))
+            values["Without Server Info"] = False
+        except ValueError:
+            values["Without Server Info"] = True
+    return {test_name: (expected_value, values.get(test_name)) for test_name, expected_value in expected_values.items()}
+
+def test_all(run_test=True):
+    totals=[0,0,0]
+    if run_test is True:
+        run_export_test = np is not None
+        for major, minor in ((2, 9), (4, 1)):
+            results = export_test_capture(major, minor) if run_export_test else {}
+            for test_name in ("Frames", "Rigid Bodies", "Labeled Markers", "Without Server Info"):
+                expected_value, value = results.get(test_name, (None, None))
+                totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Export %s %d.%d" % (test_name, major, minor), expected_value, value, run_export_test))
+
+    print("--------------------")
+    print("[PASS] Count = %3.1d"%totals[0])
+    print("[FAIL] Count = %3.1d"%totals[1])
+    print("[SKIP] Count = %3.1d"%totals[2])
+
+    return totals
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        test_all(True)
+        sys.exit(0)
+    if len(sys.argv) != 3:
+        print("Usage: python -m modules.CaptureExport <capture> <export directory> (without arguments: run the tests)")
+        sys.exit(1)
+    frame_count = export_capture(sys.argv[1], sys.argv[2])
+    print("%d frames exported (%d records skipped)" % (frame_count, CaptureExport(sys.argv[2]).index["records_skipped"]))
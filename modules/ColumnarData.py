@@ -0,0 +1,105 @@
+# Columnar (NumPy) containers for the rigid bodies and the labeled markers of a frame
+#
+# From NatNet 3.0 the rigid bodies and the labeled markers are sent as fixed size records.
+# In this case a whole block can be mapped with np.frombuffer using a structured dtype and
+# the values are exposed as column arrays, without creating a Python object for each record.
+# NumPy is an optional dependency: it's needed only if the "numpy" decode mode is used.
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from modules.MoCapData import get_tab_str
+
+# Record layouts (NatNet 3.0 and later)
+if np is not None:
+    RIGID_BODY_DTYPE = np.dtype([
+        ('id', '<u4'),
+        ('pos', '<f4', (3,)),
+        ('rot', '<f4', (4,)),
+        ('error', '<f4'),
+        ('params', '<i2')
+    ])
+    LABELED_MARKER_DTYPE = np.dtype([
+        ('id', '<u4'),
+        ('pos', '<f4', (3,)),
+        ('size', '<f4'),
+        ('param', '<i2'),
+        ('residual', '<f4')
+    ])
+
+def is_available():
+    return np is not None
+
+def map_records(data, offset, count, dtype):
+    """ Copy count records starting at offset in a structured array (the receive buffers are reused) """
+    return np.frombuffer(data, dtype=dtype, count=count, offset=offset).copy()
+
+def selection_mask(keys, selected_keys):
+    """ Boolean mask of the keys which are in selected_keys (a set or any object supporting the in operator) """
+    if isinstance(selected_keys, (set, frozenset)):
+        return np.isin(keys, list(selected_keys))
+    return np.fromiter((key in selected_keys for key in keys.tolist()), dtype=bool, count=len(keys))
+
+def select_records(records, keys, selected_keys):
+    """ Keep only the records whose key is in selected_keys """
+    return records[selection_mask(keys, selected_keys)]
+
+class RigidBodyColumns:
+    def __init__(self, records):
+        self.records = records
+        self.ids = records['id']
+        self.positions = records['pos']        # Nx3
+        self.quaternions = records['rot']      # Nx4 (qx, qy, qz, qw)
+        self.errors = records['error']
+        self.tracking_valid = ( records['params'] & 0x01 ) != 0
+
+    def get_rigid_body_count(self):
+        return len(self.records)
+
+    def select(self, ids):
+        """ Return the ids, positions, orientations and tracking flags (as lists) of the rigid bodies whose id is in ids """
+        mask = selection_mask(self.ids, ids)
+        return self.ids[mask].tolist(), self.positions[mask].tolist(), self.quaternions[mask].tolist(), self.tracking_valid[mask].tolist()
+
+    def get_as_string(self, tab_str="  ", level=0):
+        out_tab_str = get_tab_str(tab_str, level)
+        out_tab_str2 = get_tab_str(tab_str, level+1)
+        out_str = "%sRigid Body Count: %3.1d\n"%(out_tab_str, len(self.records))
+        for i in range(len(self.records)):
+            pos = self.positions[i]
+            rot = self.quaternions[i]
+            out_str += "%sID            : %3.1d\n"% (out_tab_str2, self.ids[i])
+            out_str += "%sPosition      : [%3.2f, %3.2f, %3.2f]\n"% (out_tab_str2, pos[0], pos[1], pos[2] )
+            out_str += "%sOrientation   : [%3.2f, %3.2f, %3.2f, %3.2f]\n"% (out_tab_str2, rot[0], rot[1], rot[2], rot[3] )
+            out_str += "%sMarker Error  : %3.2f\n"% (out_tab_str2, self.errors[i])
+            out_str += "%sTracking Valid: %s\n"%(out_tab_str2, bool(self.tracking_valid[i]))
+        return out_str
+
+class LabeledMarkerColumns:
+    def __init__(self, records):
+        self.records = records
+        self.ids = records['id']
+        self.model_ids = self.ids >> 16
+        self.marker_ids = self.ids & 0x0000ffff
+        self.positions = records['pos']        # Nx3
+        self.sizes = records['size']
+        self.params = records['param']
+        self.residuals = records['residual']
+        self.occluded = ( self.params & 0x01 ) != 0
+
+    def get_labeled_marker_count(self):
+        return len(self.records)
+
+    def get_as_string(self, tab_str="  ", level=0):
+        out_tab_str = get_tab_str(tab_str, level)
+        out_tab_str2 = get_tab_str(tab_str, level+1)
+        out_str = "%sLabeled Marker Count:%3.1d\n"%(out_tab_str, len(self.records))
+        for i in range(len(self.records)):
+            pos = self.positions[i]
+            out_str += "%sID                 : [MarkerID: %3.1d] [ModelID: %3.1d]\n"%(out_tab_str2, self.marker_ids[i], self.model_ids[i])
+            out_str += "%spos                : [%3.2f, %3.2f, %3.2f]\n"%(out_tab_str2, pos[0], pos[1], pos[2])
+            out_str += "%ssize               : [%3.2f]\n"%(out_tab_str2, self.sizes[i])
+            out_str += "%serr                : [%3.2f]\n"%(out_tab_str2, self.residuals[i])
+        return out_str
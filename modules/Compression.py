@@ -0,0 +1,112 @@
+# Per-message compression (permessage-deflate) of the websocket connections
+#
+# The compression level, the memory level and the size of the window are set in the settings.
+# In server mode the bridge asks for "server_no_context_takeover": each message is compressed on its own, so the
+# compressed bytes depend only on the message and they can be shared by all the connections. The compressed
+# messages are kept in a small cache shared by the connections, so a frame broadcast to N clients is
+# compressed once instead of N times.
+# The peers in the networks of WEBSOCKET_UNCOMPRESSED_NETWORKS (e.g. the LAN, where the CPU time spent
+# compressing costs more than the bandwidth saved) don't use the compression.
+
+import dataclasses
+import ipaddress
+
+import websockets
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ClientPerMessageDeflateFactory, ServerPerMessageDeflateFactory
+from websockets.frames import CTRL_OPCODES, OP_CONT
+
+class CompressionCache:
+    """ Last messages compressed (key: uncompressed data and compression parameters) """
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.entries = {}
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        data = self.entries.get(key)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        if len(self.entries) >= self.max_entries:
+            # The oldest entry is the first one (dictionaries keep the insertion order)
+            del self.entries[next(iter(self.entries))]
+        self.entries[key] = data
+
+class SharedPerMessageDeflate(PerMessageDeflate):
+    """ permessage-deflate which reuses the compressed messages of the other connections (only without context takeover) """
+    def __init__(self, extension, cache):
+        super().__init__(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings)
+        self.cache = cache
+        self.cache_key = (extension.local_max_window_bits, tuple(sorted(extension.compress_settings.items())))
+
+    def encode(self, frame):
+        # Only the whole messages compressed without context can be shared
+        if not self.local_no_context_takeover or frame.opcode in CTRL_OPCODES or frame.opcode is OP_CONT or not frame.fin:
+            return super().encode(frame)
+        key = (frame.data, self.cache_key)
+        data = self.cache.get(key)
+        if data is None:
+            frame = super().encode(frame)
+            self.cache.put(key, frame.data)
+            return frame
+        return dataclasses.replace(frame, rsv1=True, data=data)
+
+class SharedServerPerMessageDeflateFactory(ServerPerMessageDeflateFactory):
+    def __init__(self, cache, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, SharedPerMessageDeflate(extension, self.cache)
+
+def get_compress_settings(level, memory_level):
+    return {"level": level, "memLevel": memory_level}
+
+def is_uncompressed_address(address, networks):
+    """ Return True if the address (ip string) is in one of the networks which don't use the compression """
+    try:
+        ip_address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    for network in networks:
+        if ip_address in ipaddress.ip_network(network, strict=False):
+            return True
+    return False
+
+def get_client_extensions(level, memory_level, window_bits):
+    """ Extensions offered to the websocket server in client mode """
+    return [ClientPerMessageDeflateFactory(
+        server_max_window_bits=window_bits,
+        client_max_window_bits=window_bits,
+        compress_settings=get_compress_settings(level, memory_level))]
+
+def get_server_extensions(level, memory_level, window_bits, cache):
+    """ Extensions accepted from the websocket clients in server mode """
+    return [SharedServerPerMessageDeflateFactory(
+        cache,
+        server_no_context_takeover=True,
+        server_max_window_bits=window_bits,
+        compress_settings=get_compress_settings(level, memory_level))]
+
+def get_server_protocol(uncompressed_networks):
+    """ Protocol of the server connections which doesn't negotiate the compression with the clients in uncompressed_networks """
+    class BridgeServerProtocol(websockets.WebSocketServerProtocol):
+        def process_extensions(self, headers, available_extensions):
+            remote_address = self.remote_address
+            if remote_address is not None and is_uncompressed_address(remote_address[0], uncompressed_networks):
+                available_extensions = None
+            return websockets.WebSocketServerProtocol.process_extensions(headers, available_extensions)
+    return BridgeServerProtocol
@@ -0,0 +1,178 @@
+# Dead-band (delta) filter of the rigid bodies sent to a subscriber
+#
+# A rigid body is sent only if its position moved more than distance (meters) or its orientation rotated
+# more than angle (degrees) since the last pose sent (or if its tracking state changed). The frames which
+# don't contain every rigid body are marked as delta frames ("delta": true in JSON, flag in the binary format).
+# Every keyframe_interval seconds (on the frame timestamps) a keyframe with all the rigid bodies is sent,
+# so a client which lost some messages or joined late gets the whole state again.
+# A threshold which is not set (None) is ignored: with only a distance the orientation changes don't make a rigid
+# body move, and with only an angle the position changes don't.
+# The markers are not filtered. If nothing changed since the last frame sent, the frame is not sent at all.
+
+import math
+
+import modules.MoCapData as MoCapData
+
+class DeltaFilter:
+    def __init__(self, distance=None, angle=None, keyframe_interval=1.0):
+        self.distance = distance
+        self.angle = angle
+        self.keyframe_interval = keyframe_interval
+
+        # The comparisons are done on the squared distance and on the cosine of half the angle (the bounds
+        # of a threshold which is not set are never crossed)
+        self.__squared_distance = math.inf if distance is None else distance**2
+        self.__min_quaternion_dot = -1.0 if angle is None else math.cos(math.radians(angle) / 2)
+
+        # Last pose sent for each rigid body
+        self.last_poses = {}
+        self.__last_keyframe_slot = None
+
+        # Statistics
+        self.rigid_bodies_sent = 0
+        self.rigid_bodies_skipped = 0
+
+    def reset(self):
+        """ Forget the poses sent: the next frame is a keyframe """
+        self.last_poses.clear()
+        self.__last_keyframe_slot = None
+
+    def __is_keyframe(self, timestamp):
+        if self.__last_keyframe_slot is None:
+            self.__last_keyframe_slot = int(timestamp / self.keyframe_interval) if self.keyframe_interval else 0
+            return True
+        if not self.keyframe_interval:
+            return False
+        slot = int(timestamp / self.keyframe_interval)
+        if slot == self.__last_keyframe_slot:
+            return False
+        self.__last_keyframe_slot = slot
+        return True
+
+    def __has_moved(self, last, item):
+        if item['valid'] != last['valid']:
+            return True
+        if 'x' in item:
+            dx = item['x'] - last['x']
+            dy = item['y'] - last['y']
+            dz = item['z'] - last['z']
+            if dx*dx + dy*dy + dz*dz > self.__squared_distance:
+                return True
+        if 'qx' in item:
+            # Rotation angle between the two orientations: 2*acos(|q1.q2|)
+            dot = abs(item['qx']*last['qx'] + item['qy']*last['qy'] + item['qz']*last['qz'] + item['qw']*last['qw'])
+            if dot < self.__min_quaternion_dot:
+                return True
+        return False
+
+    def apply(self, processed_data):
+        """ Return the frame with only the rigid bodies which moved (the whole frame if it's a keyframe, None if nothing changed) """
+        mocap_data = processed_data["mocap_data"]
+        if not isinstance(mocap_data, list):
+            return processed_data
+
+        last_poses = self.last_poses
+        if self.__is_keyframe(processed_data["timestamp"]):
+            for item in mocap_data:
+                if item['type'] == 'rigidBody':
+                    last_poses[item['ID']] = item
+                    self.rigid_bodies_sent += 1
+            return processed_data
+
+        delta_data = []
+        for item in mocap_data:
+            if item['type'] == 'rigidBody':
+                last = last_poses.get(item['ID'])
+                if last is not None and not self.__has_moved(last, item):
+                    self.rigid_bodies_skipped += 1
+                    continue
+                last_poses[item['ID']] = item
+                self.rigid_bodies_sent += 1
+            delta_data.append(item)
+
+        if not delta_data:
+            return None
+        return {"frame_number": processed_data["frame_number"], "timestamp": processed_data["timestamp"], "mocap_data": delta_data, "delta": True}
+
+def generate_test_item(rigid_body_id, x=0.0, angle=0.0, valid=True):
+    """ Rigid body at x on the x axis, rotated by angle (degrees) around the z axis """
+    half_angle = math.radians(angle) / 2
+    return {'type': 'rigidBody', 'ID': rigid_body_id, 'x': x, 'y': 0.0, 'z': 0.0,
+            'qx': 0.0, 'qy': 0.0, 'qz': math.sin(half_angle), 'qw': math.cos(half_angle), 'valid': valid}
+
+def apply_test_frames(delta_filter, frames):
+    """ Apply delta_filter to frames ((timestamp, items) pairs). Return None or the delta flag and the items sent of each frame """
+    results = []
+    for frame_number, (timestamp, items) in enumerate(frames):
+        processed_data = delta_filter.apply({"frame_number": frame_number, "timestamp": timestamp, "mocap_data": items})
+        if processed_data is None:
+            results.append(None)
+        else:
+            results.append((processed_data.get("delta", False), [(item['type'], item['ID']) for item in processed_data["mocap_data"]]))
+    return results
+
+def test_all(run_test=True):
+    totals=[0,0,0]
+    if run_test is True:
+        full_frame = (False, [('rigidBody', 1), ('rigidBody', 2)])
+        # [name, delta filter, frames, expected results]
+        test_cases=[["Test Jitter",          DeltaFilter(0.001, 0.5),
+                     [(0.0, [generate_test_item(1), generate_test_item(2)]),
+                      (0.01, [generate_test_item(1, 0.0005, 0.2), generate_test_item(2, -0.0005, -0.2)])],
+                     [full_frame, None]],
+                    ["Test Motion",          DeltaFilter(0.001, 0.5),
+                     [(0.0, [generate_test_item(1), generate_test_item(2)]),
+                      (0.01, [generate_test_item(1, 0.002), generate_test_item(2, 0.0, 1.0)]),
+                      (0.02, [generate_test_item(1, 0.0025), generate_test_item(2, 0.0, 1.0)])],
+                     [full_frame, (True, [('rigidBody', 1), ('rigidBody', 2)]), None]],
+                    ["Test Distance Only",   DeltaFilter(0.001, None),
+                     [(0.0, [generate_test_item(1), generate_test_item(2)]),
+                      (0.01, [generate_test_item(1, 0.0, 0.01), generate_test_item(2, 0.0, 90.0)]),
+                      (0.02, [generate_test_item(1, 0.002, 0.01), generate_test_item(2, 0.0, 90.0)])],
+                     [full_frame, None, (True, [('rigidBody', 1)])]],
+                    ["Test Angle Only",      DeltaFilter(None, 0.5),
+                     [(0.0, [generate_test_item(1), generate_test_item(2)]),
+                      (0.01, [generate_test_item(1, 0.000001), generate_test_item(2, 1.0)]),
+                      (0.02, [generate_test_item(1, 0.000001), generate_test_item(2, 1.0, 1.0)])],
+                     [full_frame, None, (True, [('rigidBody', 2)])]],
+                    ["Test Valid",           DeltaFilter(0.001, 0.5),
+                     [(0.0, [generate_test_item(1), generate_test_item(2)]),
+                      (0.01, [generate_test_item(1, valid=False), generate_test_item(2)]),
+                      (0.02, [generate_test_item(1, valid=True), generate_test_item(2)])],
+                     [full_frame, (True, [('rigidBody', 1)]), (True, [('rigidBody', 1)])]],
+                    ["Test Keyframe",        DeltaFilter(0.001, 0.5, keyframe_interval=1.0),
+                     [(0.0, [generate_test_item(1), generate_test_item(2)]),
+                      (0.99, [generate_test_item(1), generate_test_item(2)]),
+                      (1.0, [generate_test_item(1), generate_test_item(2)]),
+                      (1.5, [generate_test_item(1), generate_test_item(2)]),
+                      (2.25, [generate_test_item(1), generate_test_item(2)])],
+                     [full_frame, None, full_frame, None, full_frame]],
+                    ["Test No Keyframe",     DeltaFilter(0.001, 0.5, keyframe_interval=0),
+                     [(0.0, [generate_test_item(1), generate_test_item(2)]),
+                      (5.0, [generate_test_item(1), generate_test_item(2)])],
+                     [full_frame, None]],
+                    ["Test Markers",         DeltaFilter(0.001, 0.5),
+                     [(0.0, [generate_test_item(1)]),
+                      (0.01, [{'type': 'marker', 'ID': 1, 'rigidBody': "Holder", 'x': 0.0, 'y': 0.0, 'z': 0.0}, generate_test_item(1)])],
+                     [(False, [('rigidBody', 1)]), (True, [('marker', 1)])]]
+                    ]
+        for test_name, delta_filter, frames, expected_results in test_cases:
+            totals=MoCapData.add_lists(totals, MoCapData.test_value(test_name, expected_results, apply_test_frames(delta_filter, frames)))
+
+        # Statistics and reset (the next frame is a keyframe)
+        delta_filter = DeltaFilter(0.001, 0.5)
+        frame = (0.0, [generate_test_item(1), generate_test_item(2)])
+        apply_test_frames(delta_filter, [frame, (0.01, frame[1])])
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Stats", (2, 2), (delta_filter.rigid_bodies_sent, delta_filter.rigid_bodies_skipped)))
+        delta_filter.reset()
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Reset", [full_frame], apply_test_frames(delta_filter, [(0.02, frame[1])])))
+
+    print("--------------------")
+    print("[PASS] Count = %3.1d"%totals[0])
+    print("[FAIL] Count = %3.1d"%totals[1])
+    print("[SKIP] Count = %3.1d"%totals[2])
+
+    return totals
+
+if __name__ == "__main__":
+    test_all(True)
@@ -0,0 +1,206 @@
+# Buffer of the decoded frames waiting to be sent to the websocket
+#
+# The data socket is read by the event loop as soon as packets arrive, while the sender waits for the
+# websocket. The buffer decouples the two: the receiver never waits for the sender and the sender always
+# gets the freshest data. Two policies are available:
+#   "drop_oldest"   bounded ring of frames: when it's full the oldest frame is dropped
+#   "keep_latest"   one slot for each rigid body / marker: a new frame overwrites the poses which haven't
+#                   been sent yet, so the sender transmits only the latest pose of each rigid body (a frame
+#                   which was not merged is given as it was put). The result is a delta frame only if all the
+#                   merged frames were delta frames (see DeltaFilter)
+# The buffer must be used from the thread of the event loop which runs the sender. A sender waiting for a frame is
+# woken up at the next iteration of the loop, so it runs between two batches of packets read from the data socket.
+
+import asyncio
+from collections import deque
+
+import modules.MoCapData as MoCapData
+
+POLICIES = ("drop_oldest", "keep_latest")
+
+class FrameBuffer:
+    def __init__(self, policy="drop_oldest", size=8):
+        if policy not in POLICIES:
+            raise ValueError("Unknown frame buffer policy " + str(policy))
+        self.policy = policy
+        self.size = size
+
+        # Future of the sender waiting for a frame (None if it's not waiting)
+        self.__waiter = None
+
+        # drop_oldest: frames waiting to be sent
+        self.__frames = deque(maxlen=size)
+
+        # keep_latest: last frame received (header) and latest item of each rigid body / marker
+        self.__latest_frame = None
+        self.__slots = {}
+        self.__is_merged = False
+        self.__is_delta = False
+
+        # Statistics
+        self.frames_received = 0
+        self.frames_sent = 0
+        self.frames_dropped = 0     # Frames removed from the ring before being sent (drop_oldest)
+        self.frames_conflated = 0   # Frames merged with a newer one before being sent (keep_latest)
+
+    def __len__(self):
+        if self.policy == "keep_latest":
+            return 0 if self.__latest_frame is None else 1
+        return len(self.__frames)
+
+    def put(self, processed_data):
+        """ Add a decoded frame (never waits) """
+        self.frames_received += 1
+        if self.policy == "keep_latest":
+            self.__put_latest(processed_data)
+        else:
+            if len(self.__frames) == self.size:
+                self.frames_dropped += 1
+            self.__frames.append(processed_data)
+        waiter = self.__waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def __put_latest(self, processed_data):
+        is_delta = processed_data.get("delta", False)
+        if self.__latest_frame is None:
+            self.__is_merged = False
+            self.__is_delta = is_delta
+        else:
+            self.frames_conflated += 1
+            self.__is_merged = True
+            self.__is_delta = self.__is_delta and is_delta
+        self.__latest_frame = processed_data
+
+        # Without the rigid body filter the frame is not a list of items and it's replaced as a whole
+        mocap_data = processed_data["mocap_data"]
+        if not isinstance(mocap_data, list):
+            self.__slots.clear()
+            return
+        slots = self.__slots
+        for item in mocap_data:
+            if item['type'] == 'marker':
+                slots[('marker', item['rigidBody'], item['ID'])] = item
+            else:
+                slots[(item['type'], item['ID'])] = item
+
+    def get_nowait(self):
+        """ Return the next frame to send (None if there is nothing to send) """
+        if self.policy == "keep_latest":
+            processed_data = self.__latest_frame
+            if processed_data is None:
+                return None
+            if self.__is_merged and isinstance(processed_data["mocap_data"], list):
+                processed_data = dict(processed_data)
+                processed_data["mocap_data"] = list(self.__slots.values())
+                if not self.__is_delta:
+                    processed_data.pop("delta", None)
+            self.__latest_frame = None
+            self.__slots.clear()
+        else:
+            if not self.__frames:
+                return None
+            processed_data = self.__frames.popleft()
+        self.frames_sent += 1
+        return processed_data
+
+    async def get(self, timeout):
+        """ Wait (at most timeout seconds) for the next frame to send. Return None if no frame arrived """
+        if len(self) == 0:
+            # A plain future (not wait_for, which wraps the wait in a task) wakes the sender up as soon as possible
+            loop = asyncio.get_running_loop()
+            waiter = loop.create_future()
+            timer = loop.call_later(timeout, lambda: waiter.done() or waiter.set_result(None))
+            self.__waiter = waiter
+            try:
+                await waiter
+            finally:
+                timer.cancel()
+                self.__waiter = None
+        return self.get_nowait()
+
+    def get_stats(self):
+        return {
+            "policy": self.policy,
+            "frames_received": self.frames_received,
+            "frames_sent": self.frames_sent,
+            "frames_dropped": self.frames_dropped,
+            "frames_conflated": self.frames_conflated
+        }
+
+def generate_test_frame(frame_number, rigid_body_ids, marker_count=0, delta=None):
+    """ Frame as given by the rigid body filter: the rigid bodies of rigid_body_ids and marker_count markers of "Holder" """
+    items = [{'type': 'marker', 'ID': marker_id, 'rigidBody': "Holder", 'x': frame_number, 'y': 0.0, 'z': 0.0} for marker_id in range(1, marker_count + 1)]
+    items += [{'type': 'rigidBody', 'ID': rigid_body_id, 'x': frame_number, 'y': 0.0, 'z': 0.0} for rigid_body_id in rigid_body_ids]
+    processed_data = {"frame_number": frame_number, "timestamp": frame_number / 100, "mocap_data": items}
+    if delta is not None:
+        processed_data["delta"] = delta
+    return processed_data
+
+def get_test_frames(frame_buffer):
+    """ Take all the frames of frame_buffer. Return the frame numbers and the (type, ID, x) of the items of each frame """
+    frames = []
+    processed_data = frame_buffer.get_nowait()
+    while processed_data is not None:
+        items = sorted((item['type'], item['ID'], item['x']) for item in processed_data["mocap_data"])
+        frames.append((processed_data["frame_number"], processed_data.get("delta"), items))
+        processed_data = frame_buffer.get_nowait()
+    return frames
+
+async def get_test_frame_after_timeout():
+    frame_buffer = FrameBuffer("keep_latest")
+    return await frame_buffer.get(0.01)
+
+def test_all(run_test=True):
+    totals=[0,0,0]
+    if run_test is True:
+        # drop_oldest: the oldest frames are dropped when the ring is full, the others are sent in order
+        frame_buffer = FrameBuffer("drop_oldest", size=3)
+        for frame_number in range(1, 6):
+            frame_buffer.put(generate_test_frame(frame_number, [1]))
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Drop Oldest Size", 3, len(frame_buffer)))
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Drop Oldest Order", [3, 4, 5], [frame[0] for frame in get_test_frames(frame_buffer)]))
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Drop Oldest Stats",
+            {"policy": "drop_oldest", "frames_received": 5, "frames_sent": 3, "frames_dropped": 2, "frames_conflated": 0}, frame_buffer.get_stats()))
+
+        # keep_latest: a frame which was not merged is given as it was put
+        frame_buffer = FrameBuffer("keep_latest")
+        processed_data = generate_test_frame(1, [1, 2], 2)
+        frame_buffer.put(processed_data)
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Keep Latest Single Frame", True, frame_buffer.get_nowait() is processed_data))
+
+        # keep_latest: latest pose of each rigid body and marker, header of the latest frame
+        frame_buffer.put(generate_test_frame(2, [1, 2], 2))
+        frame_buffer.put(generate_test_frame(3, [2, 3], 1))
+        frame_buffer.put(generate_test_frame(4, [3]))
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Keep Latest Size", 1, len(frame_buffer)))
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Keep Latest Merge",
+            [(4, None, [('marker', 1, 3), ('marker', 2, 2), ('rigidBody', 1, 2), ('rigidBody', 2, 3), ('rigidBody', 3, 4)])], get_test_frames(frame_buffer)))
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Keep Latest Stats",
+            {"policy": "keep_latest", "frames_received": 4, "frames_sent": 2, "frames_dropped": 0, "frames_conflated": 2}, frame_buffer.get_stats()))
+
+        # keep_latest: the merged frame is a delta frame only if all the merged frames were delta frames
+        frame_buffer.put(generate_test_frame(5, [1], delta=True))
+        frame_buffer.put(generate_test_frame(6, [2], delta=True))
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Keep Latest Delta", [(6, True, [('rigidBody', 1, 5), ('rigidBody', 2, 6)])], get_test_frames(frame_buffer)))
+        frame_buffer.put(generate_test_frame(7, [1, 2], delta=False))
+        frame_buffer.put(generate_test_frame(8, [2], delta=True))
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Keep Latest Full Frame", [(8, None, [('rigidBody', 1, 7), ('rigidBody', 2, 8)])], get_test_frames(frame_buffer)))
+
+        # keep_latest: without the rigid body filter the frames are replaced as a whole
+        processed_data = {"frame_number": 10, "timestamp": 0.1, "mocap_data": MoCapData.MoCapData()}
+        frame_buffer.put(generate_test_frame(9, [1]))
+        frame_buffer.put(processed_data)
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Keep Latest Unfiltered", True, frame_buffer.get_nowait() is processed_data))
+
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Get Timeout", None, asyncio.run(get_test_frame_after_timeout())))
+
+    print("--------------------")
+    print("[PASS] Count = %3.1d"%totals[0])
+    print("[FAIL] Count = %3.1d"%totals[1])
+    print("[SKIP] Count = %3.1d"%totals[2])
+
+    return totals
+
+if __name__ == "__main__":
+    test_all(True)
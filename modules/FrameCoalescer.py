@@ -0,0 +1,40 @@
+# Coalescing of several frames in a single websocket message
+#
+# The frames are accumulated until max_frames frames are waiting or window seconds passed since the first
+# of them (whichever comes first), then on_flush is called with the list of the frames.
+# It must be used from the thread of the event loop (the window is a timer of the event loop).
+
+import asyncio
+
+class FrameCoalescer:
+    def __init__(self, on_flush, max_frames=None, window=None):
+        if max_frames is None and window is None:
+            raise ValueError("The coalescer needs a maximum number of frames or a window")
+        self.on_flush = on_flush
+        self.max_frames = max_frames
+        self.window = window
+        self.frames = []
+        self.__timer = None
+
+    def add(self, processed_data):
+        self.frames.append(processed_data)
+        if self.max_frames is not None and len(self.frames) >= self.max_frames:
+            self.flush()
+        elif self.__timer is None and self.window is not None:
+            self.__timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        frames = self.frames
+        self.frames = []
+        if frames:
+            self.on_flush(frames)
+
+    def close(self):
+        """ Drop the frames waiting and stop the timer """
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        self.frames = []
@@ -0,0 +1,247 @@
+# Encoders of the frames sent to the websocket
+#
+# JsonFrameEncoder writes the message envelope and the list of markers/rigid bodies in a single pass,
+# using precomputed templates for the fixed keys of each item. The output is the same as json.dumps.
+# If data_as_string is True the frame is sent as a JSON string inside the envelope (format used by the
+# first versions of the bridge): {"type": "optitrack-data", "data": "{\"frame_number\": ...}"}
+#
+# The batched messages (several frames in one message, see FrameCoalescer) have the format
+# {"type": "optitrack-data-batch", "data": [{"frame_number": ...}, ...]} in JSON, while in the binary
+# format they are the concatenation of the frames.
+#
+# BinaryFrameEncoder writes the frame in the binary format described in BinaryFrameFormat with a single
+# struct.pack_into in a buffer reused for every frame.
+
+import json
+import struct
+from math import isfinite
+from json.encoder import encode_basestring_ascii
+
+import modules.BinaryFrameFormat as BinaryFrameFormat
+import modules.MoCapData as MoCapData
+
+MESSAGE_TYPE = "optitrack-data"
+BATCH_MESSAGE_TYPE = "optitrack-data-batch"
+
+# Templates of the items of mocap_data (same keys and order used by makeDataReadyForWebsocket)
+MARKER_TEMPLATE = '{"type": "marker", "ID": %d, "rigidBody": %s, "x": %r, "y": %r, "z": %r}'
+RIGID_BODY_TEMPLATE = '{"type": "rigidBody", "ID": %d, "x": %r, "y": %r, "z": %r, "qx": %r, "qy": %r, "qz": %r, "qw": %r, "valid": %s}'
+RIGID_BODY_POSITION_TEMPLATE = '{"type": "rigidBody", "ID": %d, "x": %r, "y": %r, "z": %r, "valid": %s}'
+RIGID_BODY_ORIENTATION_TEMPLATE = '{"type": "rigidBody", "ID": %d, "qx": %r, "qy": %r, "qz": %r, "qw": %r, "valid": %s}'
+FRAME_TEMPLATE = '{"frame_number": %d, "timestamp": %r, "mocap_data": [%s]}'
+DELTA_FRAME_TEMPLATE = '{"frame_number": %d, "timestamp": %r, "mocap_data": [%s], "delta": true}'
+
+class JsonFrameEncoder:
+    def __init__(self, data_as_string=False):
+        self.data_as_string = data_as_string
+        self.envelope_start = '{"type": %s, "data": ' % encode_basestring_ascii(MESSAGE_TYPE)
+        self.batch_envelope_start = '{"type": %s, "data": [' % encode_basestring_ascii(BATCH_MESSAGE_TYPE)
+
+    def encode_item(self, item):
+        """ Encode an item of mocap_data (None if it has a non finite value, which repr and json write differently) """
+        item_type = item.get('type')
+        if item_type == 'rigidBody':
+            # The subscriptions can remove the position or the orientation (see Subscription.project)
+            if 'x' in item:
+                if 'qx' in item:
+                    values = (item['x'], item['y'], item['z'], item['qx'], item['qy'], item['qz'], item['qw'])
+                    template = RIGID_BODY_TEMPLATE
+                else:
+                    values = (item['x'], item['y'], item['z'])
+                    template = RIGID_BODY_POSITION_TEMPLATE
+            elif 'qx' in item:
+                values = (item['qx'], item['qy'], item['qz'], item['qw'])
+                template = RIGID_BODY_ORIENTATION_TEMPLATE
+            else:
+                return json.dumps(item)
+            if not all(map(isfinite, values)):
+                return None
+            return template % (item['ID'], *values, "true" if item['valid'] else "false")
+        if item_type == 'marker':
+            values = (item['x'], item['y'], item['z'])
+            if not all(map(isfinite, values)):
+                return None
+            return MARKER_TEMPLATE % (item['ID'], encode_basestring_ascii(item['rigidBody']), *values)
+        return json.dumps(item)
+
+    def encode_frame(self, processed_data):
+        """ Encode a frame (the dictionary returned by the decoder) as a JSON string """
+        mocap_data = processed_data["mocap_data"]
+        if not isinstance(mocap_data, list):
+            return json.dumps(processed_data)
+        encode_item = self.encode_item
+        items = [encode_item(item) for item in mocap_data]
+
+        # repr writes nan/inf for the non finite values while json uses NaN/Infinity: in this case the frame
+        # is encoded again with the json module
+        timestamp = processed_data["timestamp"]
+        if None in items or not isfinite(timestamp):
+            return json.dumps(processed_data)
+        template = DELTA_FRAME_TEMPLATE if processed_data.get("delta") else FRAME_TEMPLATE
+        return template % (processed_data["frame_number"], timestamp, ", ".join(items))
+
+    def encode(self, processed_data):
+        """ Encode the whole websocket message """
+        frame = self.encode_frame(processed_data)
+        if self.data_as_string:
+            frame = encode_basestring_ascii(frame)
+        return self.envelope_start + frame + "}"
+
+    def encode_batch(self, frames):
+        """ Encode a message containing several frames """
+        return self.batch_envelope_start + ", ".join([self.encode_frame(processed_data) for processed_data in frames]) + "]}"
+
+class BinaryFrameEncoder:
+    def __init__(self, rigid_body_ids=None, buffer_size=4096):
+        # Id of the rigid body of each marker set (by name), used to identify the markers in the binary records
+        self.rigid_body_ids = rigid_body_ids if rigid_body_ids is not None else {}
+        self.buffer = bytearray(buffer_size)
+        self.structs = {}
+
+    def __get_struct(self, rigid_body_count, marker_count, flags):
+        key = (rigid_body_count, marker_count, flags)
+        message_struct = self.structs.get(key)
+        if message_struct is None:
+            if len(self.structs) > 64:
+                self.structs.clear()
+            message_struct = struct.Struct(BinaryFrameFormat.get_message_format(rigid_body_count, marker_count, flags))
+            self.structs[key] = message_struct
+        return message_struct
+
+    def encode(self, processed_data):
+        """ Encode the whole websocket message (the returned memoryview is valid until the next call) """
+        rigid_body_values = []
+        marker_values = []
+        rigid_body_count = 0
+        flags = None
+        rigid_body_ids = self.rigid_body_ids
+        for item in processed_data["mocap_data"]:
+            if item['type'] == 'rigidBody':
+                # All the rigid bodies of a frame have the same fields (see Subscription.project)
+                if flags is None:
+                    flags = 0
+                    if 'x' not in item:
+                        flags |= BinaryFrameFormat.NO_POSITION
+                    if 'qx' not in item:
+                        flags |= BinaryFrameFormat.NO_ORIENTATION
+                rigid_body_values.append(item['ID'])
+                if not flags & BinaryFrameFormat.NO_POSITION:
+                    rigid_body_values += (item['x'], item['y'], item['z'])
+                if not flags & BinaryFrameFormat.NO_ORIENTATION:
+                    rigid_body_values += (item['qx'], item['qy'], item['qz'], item['qw'])
+                rigid_body_values.append(BinaryFrameFormat.RIGID_BODY_TRACKING_VALID if item['valid'] else 0)
+                rigid_body_count += 1
+            else:
+                rigid_body_id = rigid_body_ids.get(item['rigidBody'], BinaryFrameFormat.NO_RIGID_BODY_ID)
+                marker_values += (rigid_body_id, item['ID'], item['x'], item['y'], item['z'])
+
+        if flags is None:
+            flags = 0
+        if processed_data.get("delta"):
+            flags |= BinaryFrameFormat.DELTA
+        marker_count = len(marker_values) // 5
+        message_struct = self.__get_struct(rigid_body_count, marker_count, flags)
+        if len(self.buffer) < message_struct.size:
+            self.buffer = bytearray(2*message_struct.size)
+        message_struct.pack_into(self.buffer, 0, BinaryFrameFormat.MAGIC, BinaryFrameFormat.FORMAT_VERSION, flags,
+                                 processed_data["frame_number"], processed_data["timestamp"], rigid_body_count, marker_count,
+                                 *rigid_body_values, *marker_values)
+        return memoryview(self.buffer)[:message_struct.size]
+
+    def encode_batch(self, frames):
+        """ Encode a message containing several frames (concatenated) """
+        return b"".join([bytes(self.encode(processed_data)) for processed_data in frames])
+
+def generate_test_frame(frame_number, position=True, orientation=True, markers=True, delta=False):
+    """ Frame as given by the rigid body filter and the subscription projection (the values are exact in float32) """
+    mocap_data = []
+    if markers:
+        mocap_data += [{'type': 'marker', 'ID': marker_id, 'rigidBody': "Holder", 'x': marker_id + 0.5, 'y': -0.25, 'z': 2.0} for marker_id in (1, 2)]
+        mocap_data.append({'type': 'marker', 'ID': 1, 'rigidBody': "Unknown", 'x': 0.0, 'y': 1.0, 'z': -1.5})
+    for rigid_body_id, valid in ((100, True), (3, False)):
+        item = {'type': 'rigidBody', 'ID': rigid_body_id}
+        if position:
+            item.update({'x': 1.5, 'y': -2.25, 'z': rigid_body_id / 4})
+        if orientation:
+            item.update({'qx': 0.0, 'qy': 0.5, 'qz': -0.5, 'qw': 0.75})
+        item['valid'] = valid
+        mocap_data.append(item)
+    processed_data = {"frame_number": frame_number, "timestamp": frame_number / 128, "mocap_data": mocap_data}
+    if delta:
+        processed_data["delta"] = True
+    return processed_data
+
+def get_test_binary_frame(processed_data, rigid_body_ids):
+    """ Frame expected from BinaryFrameFormat.decode_frames: rigid bodies first, markers identified by the id of their rigid body """
+    mocap_data = [item for item in processed_data["mocap_data"] if item['type'] == 'rigidBody']
+    for item in processed_data["mocap_data"]:
+        if item['type'] == 'marker':
+            rigid_body_id = rigid_body_ids.get(item['rigidBody'])
+            mocap_data.append({'type': 'marker', 'ID': item['ID'], 'rigidBodyID': rigid_body_id, 'rigidBody': item['rigidBody'] if rigid_body_id is not None else None,
+                               'x': item['x'], 'y': item['y'], 'z': item['z']})
+    frame = {"frame_number": processed_data["frame_number"], "timestamp": processed_data["timestamp"], "mocap_data": mocap_data}
+    if processed_data.get("delta"):
+        frame["delta"] = True
+    return frame
+
+def test_all(run_test=True):
+    totals=[0,0,0]
+    if run_test is True:
+        rigid_body_ids = {"Holder": 100}
+        rigid_body_names = {100: "Holder"}
+        binary_frame_encoder = BinaryFrameEncoder(rigid_body_ids)
+
+        # Binary format: every combination of the flags, with and without markers
+        frames = []
+        for frame_number, (position, orientation, delta, markers) in enumerate([(position, orientation, delta, markers)
+                for position in (True, False) for orientation in (True, False) for delta in (False, True) for markers in (True, False)]):
+            processed_data = generate_test_frame(frame_number, position, orientation, markers, delta)
+            frames.append(processed_data)
+            message = bytes(binary_frame_encoder.encode(processed_data))
+            flags = ( 0 if position else BinaryFrameFormat.NO_POSITION ) | ( 0 if orientation else BinaryFrameFormat.NO_ORIENTATION ) | ( BinaryFrameFormat.DELTA if delta else 0 )
+            marker_count = 3 if markers else 0
+            test_name = "Test Binary Frame position=%d orientation=%d delta=%d markers=%d" % (position, orientation, delta, markers)
+            totals=MoCapData.add_lists(totals, MoCapData.test_value(test_name + " Header",
+                ((BinaryFrameFormat.MAGIC, BinaryFrameFormat.FORMAT_VERSION, flags, frame_number, processed_data["timestamp"], 2, marker_count), struct.calcsize(BinaryFrameFormat.get_message_format(2, marker_count, flags))),
+                (BinaryFrameFormat.Header.unpack_from(message), len(message))))
+            totals=MoCapData.add_lists(totals, MoCapData.test_value(test_name + " Records",
+                [get_test_binary_frame(processed_data, rigid_body_ids)], BinaryFrameFormat.decode_frames(message, rigid_body_names)))
+
+        # Binary format: a batch is the concatenation of the frames
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Binary Batch",
+            [get_test_binary_frame(processed_data, rigid_body_ids) for processed_data in frames], BinaryFrameFormat.decode_frames(binary_frame_encoder.encode_batch(frames), rigid_body_names)))
+
+        # JSON format: same output as json.dumps, including the names looking like non finite values and the non finite values
+        json_frame_encoder = JsonFrameEncoder()
+        json_string_frame_encoder = JsonFrameEncoder(data_as_string=True)
+        names_frame = generate_test_frame(1)
+        for item, name in zip(names_frame["mocap_data"], ("Info", "Finance", "nan")):
+            item['rigidBody'] = name
+        names_frame["mocap_data"][-1].update({'x': 0.1, 'y': 1/3, 'z': -1e-20})
+        json_frames = [("Test Json Frame %d" % frame_number, processed_data) for frame_number, processed_data in enumerate(frames)]
+        json_frames.append(("Test Json Names", names_frame))
+        for test_name, item_index, key, value in (("Test Json NaN", -1, 'x', float("nan")), ("Test Json Infinity", -1, 'qw', float("inf")),
+                                                  ("Test Json Marker Infinity", 0, 'z', float("-inf")), ("Test Json Timestamp NaN", None, 'timestamp', float("nan"))):
+            processed_data = generate_test_frame(1)
+            if item_index is None:
+                processed_data[key] = value
+            else:
+                processed_data["mocap_data"][item_index][key] = value
+            json_frames.append((test_name, processed_data))
+        for test_name, processed_data in json_frames:
+            totals=MoCapData.add_lists(totals, MoCapData.test_value(test_name,
+                (json.dumps({"type": MESSAGE_TYPE, "data": processed_data}), json.dumps({"type": MESSAGE_TYPE, "data": json.dumps(processed_data)})),
+                (json_frame_encoder.encode(processed_data), json_string_frame_encoder.encode(processed_data))))
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Json Batch",
+            json.dumps({"type": BATCH_MESSAGE_TYPE, "data": [processed_data for test_name, processed_data in json_frames]}),
+            json_frame_encoder.encode_batch([processed_data for test_name, processed_data in json_frames])))
+
+    print("--------------------")
+    print("[PASS] Count = %3.1d"%totals[0])
+    print("[FAIL] Count = %3.1d"%totals[1])
+    print("[SKIP] Count = %3.1d"%totals[2])
+
+    return totals
+
+if __name__ == "__main__":
+    test_all(True)
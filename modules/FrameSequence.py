@@ -0,0 +1,180 @@
+# Continuity of the frame numbers of the NatNet stream
+#
+# Motive numbers the frames consecutively, so the frame numbers received on the data socket show what
+# happened to the UDP packets on the way:
+#   gap          frame number higher than the next one expected: the frames in between are missing (lost,
+#                or late if they arrive afterwards)
+#   reordered    frame older than the last one which was missing: it arrived after a newer frame
+#   duplicate    frame already received (or older than the frames still expected)
+#   reset        jump forward larger than max_gap or backward larger than max_late (Motive restarted, replay
+#                looped or seeked): the sequence starts again
+# The effective capture rate is estimated from the frame numbers received over rate_interval seconds, and
+# the receive rate from the number of frames received in the same interval.
+# With drop_late the reordered and duplicate frames are rejected so a frame is never forwarded after a newer one.
+# The tracker must be used from the thread of the event loop.
+
+from collections import OrderedDict
+
+import modules.MoCapData as MoCapData
+
+class FrameSequenceTracker:
+    def __init__(self, drop_late=False, max_gap=1000, max_late=100, max_missing=1024, rate_interval=1.0):
+        self.drop_late = drop_late
+        self.max_gap = max_gap
+        self.max_late = max_late
+        self.max_missing = max_missing
+        self.rate_interval = int(rate_interval * 1e9)
+        self.__last_frame_number = None
+
+        # Frames missing from the recent gaps (frame number -> None), the oldest are forgotten
+        self.__missing = OrderedDict()
+
+        # Frame number and receive time (nanoseconds) at the start of the rate interval
+        self.__interval_frame_number = None
+        self.__interval_start = None
+        self.__interval_frames = 0
+
+        # Statistics
+        self.frames_received = 0
+        self.frames_missing = 0     # Frames of the gaps which have not arrived (yet)
+        self.gaps = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self.resets = 0
+        self.late_dropped = 0
+        self.capture_rate = None    # Frames per second produced by Motive
+        self.receive_rate = None    # Frames per second received by the bridge
+
+    def check(self, frame_number, receive_time):
+        """ Track a frame received at receive_time (nanoseconds). Return False if the frame must be dropped """
+        self.frames_received += 1
+        last = self.__last_frame_number
+        if last is None or frame_number - last > self.max_gap or last - frame_number > self.max_late:
+            if last is not None:
+                self.resets += 1
+            self.__restart(frame_number, receive_time)
+            return True
+
+        if frame_number == last + 1:
+            self.__last_frame_number = frame_number
+            self.__update_rate(frame_number, receive_time)
+            return True
+
+        if frame_number > last:
+            # Gap: the frames in between are missing until they arrive
+            self.gaps += 1
+            missing = self.__missing
+            for missing_frame_number in range(max(last + 1, frame_number - self.max_missing), frame_number):
+                missing[missing_frame_number] = None
+            self.frames_missing += frame_number - last - 1
+            while len(missing) > self.max_missing:
+                missing.popitem(last=False)
+            self.__last_frame_number = frame_number
+            self.__update_rate(frame_number, receive_time)
+            return True
+
+        # Older frame: one of the missing frames arriving late, or a frame already received
+        if frame_number in self.__missing:
+            del self.__missing[frame_number]
+            self.frames_missing -= 1
+            self.reordered += 1
+        else:
+            self.duplicates += 1
+        self.__interval_frames += 1
+        if self.drop_late:
+            self.late_dropped += 1
+            return False
+        return True
+
+    def __restart(self, frame_number, receive_time):
+        self.__last_frame_number = frame_number
+        self.__missing.clear()
+        self.__interval_frame_number = frame_number
+        self.__interval_start = receive_time
+        self.__interval_frames = 0
+
+    def __update_rate(self, frame_number, receive_time):
+        self.__interval_frames += 1
+        elapsed = receive_time - self.__interval_start
+        if elapsed >= self.rate_interval:
+            self.capture_rate = (frame_number - self.__interval_frame_number) * 1e9 / elapsed
+            self.receive_rate = self.__interval_frames * 1e9 / elapsed
+            self.__interval_frame_number = frame_number
+            self.__interval_start = receive_time
+            self.__interval_frames = 0
+
+    def get_last_frame_number(self):
+        return self.__last_frame_number
+
+    def get_loss_ratio(self):
+        """ Fraction of the frames produced by Motive which never arrived """
+        expected = self.frames_received - self.duplicates + self.frames_missing
+        return self.frames_missing / expected if expected > 0 else 0.0
+
+    def get_stats(self):
+        return {
+            "frames_received": self.frames_received,
+            "frames_missing": self.frames_missing,
+            "gaps": self.gaps,
+            "reordered": self.reordered,
+            "duplicates": self.duplicates,
+            "resets": self.resets,
+            "late_dropped": self.late_dropped,
+            "loss_ratio": self.get_loss_ratio(),
+            "capture_rate": self.capture_rate,
+            "receive_rate": self.receive_rate
+        }
+
+def check_test_frames(tracker, frame_numbers, frame_period=10000000):
+    """ Check frame_numbers received every frame_period nanoseconds. Return the results of check and the statistics """
+    results = [tracker.check(frame_number, i*frame_period) for i, frame_number in enumerate(frame_numbers)]
+    return results, tracker.get_stats()
+
+def get_test_stats(**stats):
+    """ Statistics of a tracker with the values of stats (the other counters at 0) """
+    test_stats = {"frames_received": 0, "frames_missing": 0, "gaps": 0, "reordered": 0, "duplicates": 0, "resets": 0, "late_dropped": 0,
+                  "loss_ratio": 0.0, "capture_rate": None, "receive_rate": None}
+    test_stats.update(stats)
+    return test_stats
+
+def test_all(run_test=True):
+    totals=[0,0,0]
+    if run_test is True:
+        # [name, tracker, frame numbers, expected results of check, expected statistics]
+        test_cases=[["Test In Order",       FrameSequenceTracker(), [1, 2, 3, 4, 5],
+                     [True]*5, get_test_stats(frames_received=5)],
+                    ["Test Gap",            FrameSequenceTracker(), [1, 2, 5, 6],
+                     [True]*4, get_test_stats(frames_received=4, frames_missing=2, gaps=1, loss_ratio=2/6)],
+                    ["Test Reordered",      FrameSequenceTracker(), [1, 2, 5, 3, 6, 4],
+                     [True]*6, get_test_stats(frames_received=6, gaps=1, reordered=2)],
+                    ["Test Duplicate",      FrameSequenceTracker(), [1, 2, 2, 1, 3],
+                     [True]*5, get_test_stats(frames_received=5, duplicates=2)],
+                    ["Test Drop Late",      FrameSequenceTracker(drop_late=True), [1, 3, 2, 3, 4],
+                     [True, True, False, False, True], get_test_stats(frames_received=5, gaps=1, reordered=1, duplicates=1, late_dropped=2)],
+                    ["Test Reset Forward",  FrameSequenceTracker(max_gap=10), [1, 2, 4, 100, 101],
+                     [True]*5, get_test_stats(frames_received=5, frames_missing=1, gaps=1, resets=1, loss_ratio=1/6)],
+                    ["Test Reset Backward", FrameSequenceTracker(drop_late=True, max_late=5), [100, 101, 98, 10, 11],
+                     [True, True, False, True, True], get_test_stats(frames_received=5, duplicates=1, resets=1, late_dropped=1)],
+                    ["Test Max Missing",    FrameSequenceTracker(max_missing=4), [1, 11, 3, 8],
+                     [True]*4, get_test_stats(frames_received=4, frames_missing=8, gaps=1, reordered=1, duplicates=1, loss_ratio=8/11)],
+                    ["Test Rates",          FrameSequenceTracker(), list(range(0, 202, 2)),
+                     [True]*101, get_test_stats(frames_received=101, frames_missing=100, gaps=100, loss_ratio=100/201, capture_rate=200.0, receive_rate=100.0)]
+                    ]
+        for test_name, tracker, frame_numbers, expected_results, expected_stats in test_cases:
+            results, stats = check_test_frames(tracker, frame_numbers)
+            totals=MoCapData.add_lists(totals, MoCapData.test_value(test_name, (expected_results, expected_stats), (results, stats)))
+
+        # The sequence continues from the frame after a reset
+        tracker = FrameSequenceTracker(max_gap=10)
+        check_test_frames(tracker, [1, 2, 500])
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Last Frame Number", 500, tracker.get_last_frame_number()))
+
+    print("--------------------")
+    print("[PASS] Count = %3.1d"%totals[0])
+    print("[FAIL] Count = %3.1d"%totals[1])
+    print("[SKIP] Count = %3.1d"%totals[2])
+
+    return totals
+
+if __name__ == "__main__":
+    test_all(True)
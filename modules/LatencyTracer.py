@@ -0,0 +1,186 @@
+# Latency of the frames through the bridge
+#
+# Each frame is followed from the camera to the websocket and the time spent in each stage is kept in a
+# rolling window (the last window frames) from which the percentiles are computed:
+#   camera_to_transmit    mid exposure of the cameras -> transmission by Motive (hi-res timestamps of the frame)
+#   transmit_to_receive   transmission by Motive -> reception by the bridge (see below)
+#   decode                reception -> frame decoded
+#   queue                 frame decoded -> frame taken from the frame buffer by the sender
+#   encode                frame taken from the buffer -> messages encoded for all the subscriptions
+#   send                  messages encoded -> first message sent on a websocket
+#   total                 reception -> first message sent
+# The clocks of Motive and of the bridge are not synchronized: transmit_to_receive is measured against the
+# fastest frame of the last clock_offset_window seconds (the frame with the smallest difference between the two
+# clocks), so it shows the network and socket queueing delay on top of the fastest transfer, not the absolute
+# transfer time. The window follows the drift between the two clocks (e.g. 20 ppm is 72 ms per hour), which would
+# make the stage grow without bound against the fastest frame of the whole session. The window starts again
+# when the clock of Motive goes backwards (Motive restarted, replay looped) and with reset_clock_offset().
+# The reception time of a packet is taken when the bridge starts processing it (the packets read together in a
+# batch are timed one by one), so the time waiting for the packets before it in the batch is counted in
+# transmit_to_receive. The local times are time.perf_counter_ns() values. The tracer must be used from the thread
+# of the event loop.
+
+from collections import deque, OrderedDict
+
+import modules.MoCapData as MoCapData
+
+STAGES = ("camera_to_transmit", "transmit_to_receive", "decode", "queue", "encode", "send", "total")
+PERCENTILES = (50, 95, 99)
+
+class RollingHistogram:
+    """ Last size samples of a stage (nanoseconds) """
+    def __init__(self, size=1000):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+
+    def get_percentiles(self, percentiles=PERCENTILES):
+        """ Return the percentiles (nanoseconds) of the samples in the window (None if there isn't any sample) """
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        last = len(samples) - 1
+        return [samples[min(last, int(round(percentile / 100 * last)))] for percentile in percentiles]
+
+class LatencyTracer:
+    def __init__(self, window=1000, clock_frequency=None, max_pending=256, clock_offset_window=10.0):
+        self.clock_frequency = clock_frequency # Frequency of the hi-res timestamps of Motive (from the server info)
+        self.max_pending = max_pending
+        self.clock_offset_window = int(clock_offset_window * 1e9)
+        self.histograms = {stage: RollingHistogram(window) for stage in STAGES}
+
+        # Frames not sent yet (frame number -> reception, decoded, taken from the buffer and encoded times)
+        self.__pending = OrderedDict()
+
+        # Differences between the local clock and the clock of Motive (nanoseconds) which can still be the smallest
+        # one of the window: (receive time, clock offset), increasing offsets (the first one is the minimum)
+        self.__clock_offsets = deque()
+        self.__last_transmit_time = None
+
+    def reset_clock_offset(self):
+        """ Forget the fastest frame (the clock of Motive changed) """
+        self.__clock_offsets.clear()
+        self.__last_transmit_time = None
+
+    def on_decoded(self, frame_number, receive_time, decode_time, frame_suffix_data=None):
+        """ Frame received at receive_time and decoded at decode_time. frame_suffix_data has the hi-res timestamps """
+        histograms = self.histograms
+        histograms["decode"].add(decode_time - receive_time)
+        if frame_suffix_data is not None and self.clock_frequency:
+            self.__add_server_stages(receive_time, frame_suffix_data)
+
+        pending = self.__pending
+        pending[frame_number] = [receive_time, decode_time, None, None]
+        if len(pending) > self.max_pending:
+            # The frames dropped by the buffers are never sent
+            pending.popitem(last=False)
+
+    def __add_server_stages(self, receive_time, frame_suffix_data):
+        to_ns = 1e9 / self.clock_frequency
+        camera_time = frame_suffix_data.stamp_camera_mid_exposure
+        transmit_time = frame_suffix_data.stamp_transmit
+        if camera_time <= 0 or transmit_time <= 0:
+            return
+        self.histograms["camera_to_transmit"].add(int((transmit_time - camera_time) * to_ns))
+        if self.__last_transmit_time is not None and transmit_time < self.__last_transmit_time:
+            self.reset_clock_offset()
+        self.__last_transmit_time = transmit_time
+
+        # Minimum of the sliding window: the offsets larger than the new one can't be the minimum anymore
+        clock_offset = receive_time - int(transmit_time * to_ns)
+        clock_offsets = self.__clock_offsets
+        while clock_offsets and clock_offsets[-1][1] >= clock_offset:
+            clock_offsets.pop()
+        clock_offsets.append((receive_time, clock_offset))
+        window_start = receive_time - self.clock_offset_window
+        while clock_offsets[0][0] < window_start:
+            clock_offsets.popleft()
+        self.histograms["transmit_to_receive"].add(clock_offset - clock_offsets[0][1])
+
+    def on_dequeued(self, frame_number, time):
+        trace = self.__pending.get(frame_number)
+        if trace is not None:
+            trace[2] = time
+            self.histograms["queue"].add(time - trace[1])
+
+    def on_encoded(self, frame_number, time):
+        trace = self.__pending.get(frame_number)
+        if trace is not None and trace[2] is not None:
+            trace[3] = time
+            self.histograms["encode"].add(time - trace[2])
+
+    def on_sent(self, frame_number, time):
+        """ First message of the frame sent (the frame is not followed anymore) """
+        trace = self.__pending.pop(frame_number, None)
+        if trace is None or trace[3] is None:
+            return
+        self.histograms["send"].add(time - trace[3])
+        self.histograms["total"].add(time - trace[0])
+
+    def get_summary(self):
+        """ Return the percentiles of each stage in milliseconds ({stage: {"p50": ..., "p95": ..., "p99": ..., "count": ...}}) """
+        summary = {}
+        for stage in STAGES:
+            histogram = self.histograms[stage]
+            values = histogram.get_percentiles()
+            if values is None:
+                continue
+            stage_summary = {"p%d" % percentile: value / 1e6 for percentile, value in zip(PERCENTILES, values)}
+            stage_summary["count"] = histogram.count
+            summary[stage] = stage_summary
+        return summary
+
+    def format_summary(self):
+        lines = ["Latency (ms)            p50       p95       p99"]
+        for stage, values in self.get_summary().items():
+            lines.append("  %-20s %8.3f  %8.3f  %8.3f" % (stage, values["p50"], values["p95"], values["p99"]))
+        return "\n".join(lines)
+
+def trace_test_frames(latency_tracer, frame_count, frame_period, drift=0.0, transmit_start=0):
+    """ Frames transmitted every frame_period nanoseconds (clock of Motive at 1 GHz) and received 1 ms later by a clock
+    running drift (fraction) faster, with a delay of 5 ms every 7 frames. Return the last receive time """
+    frame_suffix_data = MoCapData.FrameSuffixData()
+    receive_time = 0
+    for frame_number in range(frame_count):
+        transmit_time = transmit_start + (frame_number + 1)*frame_period
+        frame_suffix_data.stamp_camera_mid_exposure = transmit_time - 2000000
+        frame_suffix_data.stamp_transmit = transmit_time
+        receive_time = int((frame_number + 1)*frame_period*(1 + drift)) + 1000000 + (5000000 if frame_number % 7 == 6 else 0)
+        latency_tracer.on_decoded(frame_number, receive_time, receive_time + 100000, frame_suffix_data)
+    return receive_time
+
+def test_all(run_test=True):
+    totals=[0,0,0]
+    if run_test is True:
+        # Stable clocks: the network stage is the delay on top of the fastest frame
+        latency_tracer = LatencyTracer(window=700, clock_frequency=1e9)
+        trace_test_frames(latency_tracer, 700, 10000000)
+        summary = latency_tracer.get_summary()
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Stages",
+            {"camera_to_transmit": 2.0, "transmit_to_receive": (0.0, 5.0), "decode": 0.1},
+            {"camera_to_transmit": summary["camera_to_transmit"]["p50"], "transmit_to_receive": (summary["transmit_to_receive"]["p50"], summary["transmit_to_receive"]["p99"]), "decode": summary["decode"]["p50"]}))
+
+        # One hour with a clock 20 ppm faster than Motive: the drift in the window (0.2 ms in 10 s) instead of 72 ms
+        latency_tracer = LatencyTracer(window=700, clock_frequency=1e9)
+        trace_test_frames(latency_tracer, 36000, 100000000, drift=0.00002)
+        transmit_to_receive = latency_tracer.get_summary()["transmit_to_receive"]
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Clock Drift", True, transmit_to_receive["p50"] <= 0.2 and transmit_to_receive["p99"] <= 5.2))
+
+        # The clock of Motive starts again: the frames are measured against the fastest frame of the new clock
+        latency_tracer = LatencyTracer(window=100, clock_frequency=1e9)
+        trace_test_frames(latency_tracer, 100, 10000000, transmit_start=3600000000000)
+        trace_test_frames(latency_tracer, 100, 10000000)
+        totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Clock Reset", 0.0, latency_tracer.get_summary()["transmit_to_receive"]["p50"]))
+
+    print("--------------------")
+    print("[PASS] Count = %3.1d"%totals[0])
+    print("[FAIL] Count = %3.1d"%totals[1])
+    print("[SKIP] Count = %3.1d"%totals[2])
+
+    return totals
+
+if __name__ == "__main__":
+    test_all(True)
@@ -0,0 +1,158 @@
+# Metrics of the bridge in the Prometheus text format
+#
+# The counters are plain attributes of BridgeMetrics incremented by the event loop of the data thread (no lock,
+# nothing is formatted on the hot path). The text is built only when the endpoint is scraped, and the values
+# owned by the other components (frame buffer, frame sequence, data socket) are read at that time by the
+# collect function given to the server, which returns a list of Sample.
+# MetricsServer is a minimal HTTP server running on the same event loop: GET /metrics returns the metrics,
+# any other path returns 404.
+# The drops of the data socket (datagrams lost because its receive buffer was full) are read from
+# /proc/net/udp and /proc/net/udp6, so they are available only on Linux.
+
+import asyncio
+import os
+from bisect import bisect_left
+from collections import namedtuple
+
+PREFIX = "optitrack_bridge_"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+TIME_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+# Value of a metric collected at scrape time (kind: "counter" or "gauge", value None if not available)
+Sample = namedtuple("Sample", ("name", "kind", "help", "value"))
+
+class Histogram:
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, help):
+        lines = ["# HELP %s %s" % (name, help), "# TYPE %s histogram" % name]
+        cumulative = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('%s_bucket{le="%g"} %d' % (name, bucket, cumulative))
+        lines.append('%s_bucket{le="+Inf"} %d' % (name, self.count))
+        lines.append("%s_sum %r" % (name, self.sum))
+        lines.append("%s_count %d" % (name, self.count))
+        return lines
+
+class BridgeMetrics:
+    def __init__(self):
+        # Data socket
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.frames_decoded = 0
+        self.decode_errors = 0
+        self.decode_time = Histogram()
+
+        # Websocket
+        self.frames_encoded = 0
+        self.encode_time = Histogram()
+        self.messages_sent = 0
+        self.bytes_sent = 0             # Size of the messages before compression
+        self.messages_dropped = 0       # Messages removed from the queue of a slow connection before being sent
+        self.frames_conflated = 0       # Frames merged with a newer one in the queue of a slow connection (keep_latest)
+        self.websocket_connections = 0
+        self.websocket_disconnections = 0
+        self.websocket_reconnects = 0   # Client mode: connections to the websocket server after the first one
+        self.websocket_errors = 0       # Client mode: failed connections and lost network
+
+    def get_samples(self):
+        return [
+            Sample("packets_received_total", "counter", "Packets received on the data socket", self.packets_received),
+            Sample("bytes_received_total", "counter", "Bytes received on the data socket", self.bytes_received),
+            Sample("frames_decoded_total", "counter", "Frames decoded", self.frames_decoded),
+            Sample("decode_errors_total", "counter", "Packets which could not be decoded", self.decode_errors),
+            Sample("frames_encoded_total", "counter", "Frames encoded for the websocket connections", self.frames_encoded),
+            Sample("messages_sent_total", "counter", "Messages sent on the websocket connections", self.messages_sent),
+            Sample("bytes_sent_total", "counter", "Bytes of the messages sent on the websocket connections (before compression)", self.bytes_sent),
+            Sample("messages_dropped_total", "counter", "Messages dropped from the queue of a slow websocket connection", self.messages_dropped),
+            Sample("frames_conflated_total", "counter", "Frames merged with a newer frame in the queue of a slow websocket connection", self.frames_conflated),
+            Sample("websocket_connections_total", "counter", "Websocket connections opened", self.websocket_connections),
+            Sample("websocket_reconnects_total", "counter", "Reconnections to the websocket server (client mode)", self.websocket_reconnects),
+            Sample("websocket_errors_total", "counter", "Failed connections to the websocket server (client mode)", self.websocket_errors),
+            Sample("websocket_subscribers", "gauge", "Websocket connections open", self.websocket_connections - self.websocket_disconnections)
+        ]
+
+    def render(self, samples=()):
+        """ Return the metrics in the Prometheus text format. samples are the values collected from the other components """
+        lines = []
+        for sample in self.get_samples() + list(samples):
+            if sample.value is None:
+                continue
+            name = PREFIX + sample.name
+            lines.append("# HELP %s %s" % (name, sample.help))
+            lines.append("# TYPE %s %s" % (name, sample.kind))
+            lines.append("%s %r" % (name, sample.value))
+        lines.extend(self.decode_time.render(PREFIX + "decode_seconds", "Time to decode a frame"))
+        lines.extend(self.encode_time.render(PREFIX + "encode_seconds", "Time to encode a frame for all the websocket connections"))
+        return "\n".join(lines) + "\n"
+
+def get_socket_queue_stats(sock):
+    """ Return the bytes waiting in the receive queue of a UDP socket and the datagrams it dropped (None, None if not available) """
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+    except (OSError, ValueError):
+        return None, None
+    for path in ("/proc/net/udp", "/proc/net/udp6"):
+        try:
+            with open(path, "r") as udp_file:
+                lines = udp_file.readlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            # sl local_address rem_address st tx_queue:rx_queue tr:tm->when retrnsmt uid timeout inode ref pointer drops
+            fields = line.split()
+            if len(fields) >= 13 and fields[9] == inode:
+                return int(fields[4].split(":")[1], 16), int(fields[12])
+    return None, None
+
+class MetricsServer:
+    def __init__(self, metrics, host="127.0.0.1", port=9108, collect=None, logger=None):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.collect = collect
+        self.logger = logger
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.__handle_request, self.host, self.port)
+        if self.logger is not None:
+            self.logger.debug("Metrics available on http://%s:%d/metrics" % (self.host, self.port))
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def __handle_request(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+            fields = request.split(b"\r\n", 1)[0].split()
+            path = fields[1].split(b"?", 1)[0] if len(fields) >= 2 else b""
+            if fields[:1] == [b"GET"] and path == b"/metrics":
+                samples = self.collect() if self.collect is not None else ()
+                status = "200 OK"
+                body = self.metrics.render(samples).encode()
+            else:
+                status = "404 Not Found"
+                body = b"Not found\n"
+            writer.write(("HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % (status, CONTENT_TYPE, len(body))).encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.error("ERROR: metrics request failed: " + str(e))
+        finally:
+            writer.close()
@@ -94,6 +94,19 @@ def test_hash2(test_name, test_hash_str, test_object, run_test=True):
     return ret_value
 
 
+def test_value(test_name, expected_value, value, run_test=True):
+    if not run_test:
+        print("[SKIP]:%s"%test_name)
+        return K_SKIP
+    if value == expected_value:
+        print("[PASS]:%s"%test_name)
+        return K_PASS
+    print("[FAIL]:%s"%test_name)
+    print("       expected_value=%s"%expected_value)
+    print("       value=%s"%value)
+    return K_FAIL
+
+
 def get_as_string(input_str):
     type_input_str=str(type(input_str))
     if type_input_str == "<class 'str'>":
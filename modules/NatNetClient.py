@@ -21,9 +21,28 @@ import socket
 import struct
 from threading import Thread
 import copy
+import hashlib
+import os
+import tempfile
 import time
 import modules.DataDescriptions as DataDescriptions
 import modules.MoCapData as MoCapData
+from modules.BatchReceiver import BatchReceiver
+from modules.FrameBuffer import FrameBuffer
+from modules.WebsocketServer import WebsocketBroadcaster
+from modules.Subscription import Subscription
+import modules.Compression as Compression
+from modules.PacketCapture import PacketRecorder, SOURCE_DATA, SOURCE_COMMAND
+from modules.PacketReplay import PacketReplay
+from modules.LatencyTracer import LatencyTracer
+from modules.FrameSequence import FrameSequenceTracker
+from modules.Metrics import BridgeMetrics, MetricsServer, Sample, get_socket_queue_stats
+from modules.StageProfiler import StageProfiler
+from urllib.parse import urlsplit
+import modules.ColumnarData as ColumnarData
+from modules.RigidBodyFilter import RigidBodyFilter
+from modules.FrameEncoder import JsonFrameEncoder, BinaryFrameEncoder
+import modules.BinaryFrameFormat as BinaryFrameFormat
 import websockets
 import json
 from modules.settings import *
@@ -59,6 +78,16 @@ DoubleValue = struct.Struct( '<d' )
 NNIntValue = struct.Struct( '<I')
 FPCalMatrixRow = struct.Struct( '<ffffffffffff' )
 FPCorners      = struct.Struct( '<ffffffffffff')
+ShortValue = struct.Struct( '<h' )
+NNIntPair = struct.Struct( '<II' )
+HiresTimestamps = struct.Struct( '<QQQ' )
+
+# Stages of the frame decoding measured by the profiler (the time of process_message without its sub stages is the dispatch on the message id)
+PROCESS_MESSAGE_STAGE = ("receive", "process_message")
+UNPACK_FRAME_STAGE = PROCESS_MESSAGE_STAGE + ("unpack_mocap_frame",)
+MAKE_DATA_READY_STAGE = PROCESS_MESSAGE_STAGE + ("make_data_ready",)
+PROFILED_SECTIONS = (("unpack_marker_set_data", "marker_sets"), ("unpack_rigid_body_data", "rigid_bodies"), ("unpack_skeleton_data", "skeletons"),
+                     ("unpack_labeled_marker_data", "labeled_markers"), ("unpack_force_plate_data", "force_plates"), ("unpack_device_data", "devices"))
 
 class NetworkConnectionError(Exception):
     pass
@@ -66,6 +95,122 @@ class NetworkConnectionError(Exception):
 class WebsocketConnectionLost(Exception):
     pass
 
+# Layouts of the frame records for a given NatNet version.
+# The version checks are done once here so that the frame decoding doesn't need to do them for every record.
+# The missing fields of the older versions are replaced by the values in the padding tuples.
+class DecodePlan:
+    def __init__(self, major, minor):
+        self.major = major
+        self.minor = minor
+
+        # Rigid bodies: ID, position, orientation, markers (before 3.0), marker error (2.0 and later) and params (2.6 and later)
+        self.rigid_body_has_markers = major < 3 and major != 0
+        self.rigid_body_has_marker_ids = major >= 2
+        self.rigid_body_marker_size = 20 if self.rigid_body_has_marker_ids else 12 # Position, ID and size of each marker
+        rigid_body_tail_format = ""
+        self.rigid_body_padding = ()
+        if major >= 2:
+            rigid_body_tail_format += "f"
+        else:
+            self.rigid_body_padding += (0.0,)
+        if ( major == 2 and minor >= 6 ) or major > 2:
+            rigid_body_tail_format += "h"
+        else:
+            self.rigid_body_padding += (0,)
+        self.rigid_body_head = struct.Struct( "<I7f" )
+        self.rigid_body_tail = struct.Struct( "<" + rigid_body_tail_format )
+        self.rigid_body_record = struct.Struct( "<I7f" + rigid_body_tail_format )
+
+        # Sections added by the different versions
+        self.has_skeletons = ( major == 2 and minor > 0 ) or major > 2
+        self.has_labeled_markers = ( major == 2 and minor > 3 ) or major > 2
+        self.has_force_plates = ( major == 2 and minor >= 9 ) or major > 2
+        self.has_devices = ( major == 2 and minor >= 11 ) or major > 2
+
+        # Labeled markers: ID, position, size, param (2.6 and later) and residual (3.0 and later)
+        labeled_marker_format = "<I3ff"
+        self.labeled_marker_padding = ()
+        if ( major == 2 and minor >= 6 ) or major > 2:
+            labeled_marker_format += "h"
+        else:
+            self.labeled_marker_padding += (0,)
+        if major >= 3:
+            labeled_marker_format += "f"
+        else:
+            self.labeled_marker_padding += (0.0,)
+        self.labeled_marker_record = struct.Struct( labeled_marker_format )
+
+        # Frame suffix: timecode, timestamp (double in 2.7 and later), hires timestamps (3.0 and later) and params
+        frame_suffix_format = "<II"
+        self.frame_suffix_fields = ("timecode", "timecode_sub", "timestamp")
+        if ( major == 2 and minor >= 7 ) or major > 2:
+            frame_suffix_format += "d"
+        else:
+            frame_suffix_format += "f"
+        if major >= 3:
+            frame_suffix_format += "QQQ"
+            self.frame_suffix_fields += ("stamp_camera_mid_exposure", "stamp_data_received", "stamp_transmit")
+        frame_suffix_format += "h"
+        self.frame_suffix_fields += ("param",)
+        self.frame_suffix_record = struct.Struct( frame_suffix_format )
+
+        # From version 3.0 the rigid bodies and the labeled markers are fixed size records (they can be mapped as arrays)
+        self.has_fixed_size_records = major >= 3
+
+        # Functions used to unpack the sections of the frame (selected by NatNetClient)
+        self.selection = None
+        self.unpack_marker_set_data = None
+        self.unpack_rigid_body_data = None
+        self.unpack_rigid_bodies = None
+        self.skip_rigid_bodies = None
+        self.unpack_skeleton_data = None
+        self.unpack_labeled_marker_data = None
+        self.unpack_force_plate_data = None
+        self.unpack_device_data = None
+
+# Sections and models of the frame needed by the consumer of the data.
+# The records which are not selected are skipped (only their size is computed) without creating any object.
+# None means that everything is selected. The frame prefix and suffix are always decoded.
+class DecodeSelection:
+    SECTIONS = ("marker_sets", "rigid_bodies", "skeletons", "labeled_markers", "force_plates", "devices")
+
+    def __init__(self, sections=None, marker_set_names=None, rigid_body_ids=None, labeled_marker_model_ids=None):
+        if sections is None:
+            sections = self.SECTIONS
+        for section in sections:
+            if section not in self.SECTIONS:
+                raise ValueError("Unknown frame section: " + str(section))
+        self.sections = frozenset(sections)
+
+        # Marker sets are selected by model name (the unlabeled markers are decoded only if all the marker sets are selected)
+        # Rigid bodies are selected by ID, labeled markers by the ID of their model (upper 16 bits of the marker ID)
+        # The selections can be lists of values or lookup objects (e.g. the lookups of a RigidBodyFilter)
+        if isinstance(marker_set_names, (list, tuple, set, frozenset)):
+            marker_set_names = [name.encode('utf-8') if isinstance(name, str) else name for name in marker_set_names]
+        self.marker_set_names = self.__as_lookup(marker_set_names)
+        self.rigid_body_ids = self.__as_lookup(rigid_body_ids)
+        self.labeled_marker_model_ids = self.__as_lookup(labeled_marker_model_ids)
+
+    def __as_lookup(self, values):
+        if isinstance(values, (list, tuple, set)):
+            return frozenset(values)
+        return values
+
+    def needs(self, section):
+        return section in self.sections
+
+# Asyncio protocol receiving the data packets on the event loops which can't watch a socket (see __watch_data_socket)
+class DataChannelProtocol(asyncio.DatagramProtocol):
+    def __init__(self, on_datagram, on_error):
+        self.on_datagram = on_datagram
+        self.on_error = on_error
+
+    def datagram_received(self, data, addr):
+        self.on_datagram(data)
+
+    def error_received(self, exc):
+        self.on_error(exc)
+
 # Definition of the personalized NatNetClient class
 class NatNetClient:   
     # Client/server message ids
@@ -84,8 +229,11 @@ class NatNetClient:
     NAT_UNDEFINED             = 999999.9999
 
     # Costructor of the class
-    def __init__( self ):
-        self.logger = logger(log_on_stout = LOGGING_ON_STDOUT)
+    # A client used only to decode packets (e.g. read from a capture) doesn't need internet nor a log file:
+    # verify_connection=False skips the connection checks and log_path=None disables the log file
+    def __init__( self, verify_connection = True, log_path = 'logs.log' ):
+        self.logger = logger(log_on_stout = LOGGING_ON_STDOUT, log_path = log_path)
+        self.verify_connection = verify_connection
         # Verify that the connection is working
         if(self.check_connection() == False):
             self.logger.error("ERROR: No internet connection. Please connect to internet and try again.")
@@ -125,6 +273,9 @@ class NatNetClient:
         # server stream version. This will be updated to the actual version the server is using during initialization.
         self.__server_version = [0,0,0,0]
 
+        # Frequency of the hi-res timestamps of the server (None if the server doesn't send it). This will be updated during initialization only.
+        self.__high_res_clock_frequency = None
+
         # Lock values once run is called
         self.__is_locked = False
 
@@ -141,11 +292,82 @@ class NatNetClient:
         # Define the websocket connection url
         self.websocket_connection_url = ""
 
+        # Websocket mode: "client" connects to websocket_connection_url, "server" accepts many clients on websocket_server_host:websocket_server_port
+        self.websocket_mode = "client"
+        self.websocket_server_host = ""
+        self.websocket_server_port = 8765
+
         # With this function it's possible to define from inside the threads that the program should stop (otherwise the shutdown process won't work)
         self.shutdown_threads = False
 
         self.isReady = False
 
+        # Decode mode of the rigid bodies and labeled markers ("objects" or "numpy")
+        self.__decode_mode = "objects"
+        if DECODE_MODE != "objects":
+            self.set_decode_mode(DECODE_MODE, compile_plan = False)
+
+        # Rigid bodies streamed to the websocket (None if all the data is streamed)
+        self.rigid_body_filter = None
+        if RIGIDBODY_FILTER_ON:
+            self.rigid_body_filter = RigidBodyFilter(RIGIDBODY_FILTER)
+
+        # Sections and models of the frames which are decoded
+        self.__decode_selection = self.__get_filter_decode_selection()
+
+        # Frame layouts for the NatNet version in use. This will be compiled again every time the version changes.
+        self.__compile_decode_plan()
+
+        # Encoder of the websocket messages
+        self.frame_encoder = JsonFrameEncoder(data_as_string = JSON_DATA_AS_STRING)
+        self.binary_frame_encoder = BinaryFrameEncoder(self.__get_marker_set_rigid_body_ids())
+
+        # Rate and fields of the frames sent to the websocket server (client mode)
+        self.websocket_subscription = Subscription.from_dict(WEBSOCKET_SUBSCRIPTION)
+
+        # Decoded frames waiting to be sent to the websocket (created by the data thread event loop)
+        self.frame_buffer = None
+
+        # Distribution of the frames to the websocket connections (created by the data thread event loop)
+        self.broadcaster = None
+
+        # Compressed messages shared by the websocket clients (server mode with compression)
+        self.compression_cache = None
+
+        # Recorder of the raw packets (None if the packets are not recorded)
+        self.packet_recorder = None
+
+        # Last server info and data descriptions packets received (written at the start of each recording)
+        self.__server_info_packet = None
+        self.__data_descriptions_packet = None
+
+        # Replay of a capture used instead of the NatNet server (None if the live stream is used)
+        self.replay = None
+
+        # Latency of the frames in each stage (None if the latency is not traced)
+        self.latency_tracer = None
+        if LATENCY_TRACING:
+            self.latency_tracer = LatencyTracer(window=LATENCY_WINDOW)
+
+        # Continuity of the frame numbers received (None if the frame numbers are not checked)
+        self.frame_sequence_tracker = None
+        if FRAME_SEQUENCE_TRACKING:
+            self.frame_sequence_tracker = FrameSequenceTracker(drop_late=DROP_LATE_FRAMES, max_gap=FRAME_SEQUENCE_MAX_GAP)
+
+        # Counters of the bridge exposed on the metrics endpoint (None if the metrics are not collected)
+        self.metrics = None
+        if METRICS_ON:
+            self.metrics = BridgeMetrics()
+
+        # Time of the stages of the pipeline measured on a sample of the frames (None if the pipeline is not profiled)
+        self.profiler = None
+        if PROFILING_ON:
+            self.profiler = StageProfiler(PROFILING_SAMPLE_INTERVAL)
+        self.__profiled_plan = None
+
+        # Suffix (timestamps) of the last frame decoded
+        self.__last_frame_suffix_data = None
+
     def need_shutdown(self):
         return self.shutdown_threads
 
@@ -182,10 +404,136 @@ class NatNetClient:
     def get_websocket_connection_url(self):
         return self.websocket_connection_url
 
+    def set_websocket_server(self, host, port=8765):
+        """ Accept the websocket clients on host:port instead of connecting to a websocket server (server mode) """
+        if not self.__is_locked:
+            self.websocket_mode = "server"
+            self.websocket_server_host = host
+            self.websocket_server_port = port
+
+    def get_websocket_mode(self):
+        return self.websocket_mode
+
+    def set_websocket_subscription(self, subscription):
+        """ Set the rate and the fields sent to the websocket server in client mode (same format of WEBSOCKET_SUBSCRIPTION) """
+        self.websocket_subscription = Subscription.from_dict(subscription)
+
+    def get_websocket_subscription(self):
+        return self.websocket_subscription
+
+    def start_recording(self, path):
+        """ Record every packet received on the data and command sockets in the capture path (see PacketCapture) """
+        self.stop_recording()
+        packet_recorder = PacketRecorder(path, logger=self.logger)
+        packet_recorder.start()
+
+        # A recording started during a session begins with the packets which configured the client, so the
+        # capture can be decoded (exported or replayed) on its own
+        for data in self.__get_setup_packets():
+            packet_recorder.record( data, SOURCE_COMMAND )
+        self.packet_recorder = packet_recorder
+        self.logger.debug("Recording the packets in " + packet_recorder.capture_path)
+
+    # Server info packet of the current NatNet version (the last one received, or one made from the version
+    # if the version was changed since) and the last data descriptions packet
+    def __get_setup_packets(self):
+        packets = []
+        version = self.__nat_net_requested_version
+        if version[0] != 0 or version[1] != 0:
+            server_info_packet = self.__server_info_packet
+            if server_info_packet is None or list(server_info_packet[264:268]) != version:
+                payload = self.__application_name.encode('utf-8')[:255].ljust(256, b'\0')
+                payload += bytes(self.__server_version) + bytes(version)
+                if self.__high_res_clock_frequency is not None:
+                    payload += struct.pack( '<Q', self.__high_res_clock_frequency )
+                server_info_packet = struct.pack( '<HH', self.NAT_SERVERINFO, len(payload) ) + payload
+            packets.append(server_info_packet)
+        if self.__data_descriptions_packet is not None:
+            packets.append(self.__data_descriptions_packet)
+        return packets
+
+    def stop_recording(self):
+        packet_recorder = self.packet_recorder
+        if packet_recorder is None:
+            return
+        self.packet_recorder = None
+        packet_recorder.stop()
+        self.logger.debug("Recording stopped (%d packets, %d bytes, %d packets dropped)" % (packet_recorder.packets_recorded, packet_recorder.bytes_recorded, packet_recorder.packets_dropped))
+
+    def is_recording(self):
+        return self.packet_recorder is not None and self.packet_recorder.is_recording()
+
+    def set_replay(self, path, speed=1.0, start_frame=None, loop=False):
+        """ Replay the capture path instead of connecting to the NatNet server (speed None: as fast as possible) """
+        if not self.__is_locked:
+            self.replay = PacketReplay(path, speed=speed, start_frame=start_frame, loop=loop, batch_size=RECEIVE_BATCH_SIZE, logger=self.logger)
+
+    def get_replay(self):
+        return self.replay
+
+    def seek_replay(self, frame_number):
+        """ Continue the replay from frame_number """
+        if self.replay is None:
+            self.logger.error("ERROR: no replay in progress")
+            return
+        self.replay.seek(frame_number)
+
     def set_use_multicast(self, use_multicast):
         if not self.__is_locked:
             self.use_multicast = use_multicast
 
+    def set_decode_mode(self, decode_mode, compile_plan = True):
+        """ Set how rigid bodies and labeled markers are decoded: "objects" (MoCapData objects) or "numpy" (column arrays, NatNet 3.0 and later) """
+        if decode_mode not in ("objects", "numpy"):
+            self.logger.error("ERROR: unknown decode mode " + str(decode_mode))
+            return False
+        if decode_mode == "numpy" and not ColumnarData.is_available():
+            self.logger.error("ERROR: the numpy decode mode requires numpy to be installed")
+            return False
+        self.__decode_mode = decode_mode
+        if compile_plan:
+            self.__compile_decode_plan()
+        return True
+
+    def get_decode_mode(self):
+        return self.__decode_mode
+
+    def set_rigid_body_filter(self, entries):
+        """ Stream only the rigid bodies selected by entries (same format of RIGIDBODY_FILTER, None to stream everything) """
+        self.rigid_body_filter = None
+        if entries is not None:
+            self.rigid_body_filter = RigidBodyFilter(entries)
+        self.binary_frame_encoder.rigid_body_ids = self.__get_marker_set_rigid_body_ids()
+        self.set_decode_selection(self.__get_filter_decode_selection())
+
+    def get_rigid_body_filter(self):
+        return self.rigid_body_filter
+
+    # Id of the rigid body of each marker set (used to identify the markers in the binary websocket messages)
+    def __get_marker_set_rigid_body_ids(self):
+        if self.rigid_body_filter is None:
+            return {}
+        return dict(self.rigid_body_filter.name_to_id)
+
+    # Decode only what is streamed to the websocket (if selective decoding is enabled)
+    def __get_filter_decode_selection(self):
+        if not SELECTIVE_DECODING or self.rigid_body_filter is None:
+            return DecodeSelection()
+        return DecodeSelection(
+            sections = ("marker_sets", "rigid_bodies"),
+            marker_set_names = self.rigid_body_filter.name_lookup,
+            rigid_body_ids = self.rigid_body_filter.id_lookup)
+
+    def set_decode_selection(self, decode_selection):
+        """ Decode only the sections and models of the frame in decode_selection (a DecodeSelection, None to decode everything) """
+        if decode_selection is None:
+            decode_selection = DecodeSelection()
+        self.__decode_selection = decode_selection
+        self.__compile_decode_plan()
+
+    def get_decode_selection(self):
+        return self.__decode_selection
+
     def can_change_bitstream_version(self):
         return self.__can_change_bitstream_version
 
@@ -202,6 +550,7 @@ class NatNetClient:
                 self.__nat_net_requested_version[1] = minor
                 self.__nat_net_requested_version[2] = 0
                 self.__nat_net_requested_version[3] = 0
+                self.__compile_decode_plan()
                 print("changing bitstream MAIN")
                 # get original output state
                 #print_results = self.get_print_results()
@@ -231,8 +580,10 @@ class NatNetClient:
         """ Return true if connected to server, false otherwise """
         is_connected = True
 
-        # check sockets
-        if self.command_socket == None:
+        # check sockets (there isn't any socket during a replay)
+        if self.replay is not None:
+            pass
+        elif self.command_socket == None:
             is_connected = False
         elif self.data_socket ==None:
             is_connected = False
@@ -249,7 +600,7 @@ class NatNetClient:
         return is_connected
 
     def check_connection(self):
-        if VERIFY_CONNECTION == False:
+        if VERIFY_CONNECTION == False or self.verify_connection == False:
             return
         try:
             socket.gethostbyname(DNS_CONNECTION_TESTING)
@@ -320,6 +671,7 @@ class NatNetClient:
                                   socket.SOCK_DGRAM,
                                   0)    # UDP
             result.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            result.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, DATA_SOCKET_RECEIVE_BUFFER_SIZE)
             result.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(self.multicast_address) + socket.inet_aton(self.local_ip_address))
             try:
                 result.bind( (self.local_ip_address, port) )
@@ -342,6 +694,7 @@ class NatNetClient:
                                   socket.SOCK_DGRAM,
                                   socket.IPPROTO_UDP)
             result.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            result.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, DATA_SOCKET_RECEIVE_BUFFER_SIZE)
             #result.bind( (self.local_ip_address, port) )
             try:
                 result.bind( ('', 0) )
@@ -364,192 +717,329 @@ class NatNetClient:
 
         return result
 
-     # Unpack a rigid body object from a data packet
-    def __unpack_rigid_body( self, data, major, minor, rb_num):
-        offset = 0
-
-        # ID (4 bytes)
-        new_id = int.from_bytes( data[offset:offset+4], byteorder='little' )
-        offset += 4
+    # Read a null terminated string starting at offset (end bounds the search to the packet)
+    def __unpack_string( self, data, offset, end):
+        string_end = data.index( b'\0', offset, end )
+        return string_end + 1, bytes( data[offset:string_end] )
 
-        trace_mf( "RB: %3.1d ID: %3.1d"% (rb_num, new_id))
-
-        # Position and orientation
-        pos = Vector3.unpack( data[offset:offset+12] )
-        offset += 12
-        trace_mf( "\tPosition    : [%3.2f, %3.2f, %3.2f]"% (pos[0], pos[1], pos[2] ))
+    # Compile the decode plan for the NatNet version currently in use
+    def __compile_decode_plan( self ):
+        plan = DecodePlan( self.get_major(), self.get_minor() )
 
-        rot = Quaternion.unpack( data[offset:offset+16] )
-        offset += 16
-        trace_mf( "\tOrientation : [%3.2f, %3.2f, %3.2f, %3.2f]"% (rot[0], rot[1], rot[2], rot[3] ))
+        selection = self.__decode_selection
+        plan.selection = selection
+        use_columns = self.__decode_mode == "numpy" and plan.has_fixed_size_records
 
-        rigid_body = MoCapData.RigidBody(new_id, pos, rot)
+        # Select the functions used for each section of the frame
+        if plan.rigid_body_has_markers:
+            plan.unpack_rigid_bodies = self.__unpack_rigid_bodies_with_markers
+            plan.skip_rigid_bodies = self.__skip_rigid_bodies_with_markers
+        else:
+            plan.unpack_rigid_bodies = self.__unpack_rigid_body_records
+            plan.skip_rigid_bodies = self.__skip_rigid_body_records
+
+        # Marker sets
+        if not selection.needs("marker_sets"):
+            plan.unpack_marker_set_data = self.__skip_marker_set_data
+        elif selection.marker_set_names is not None:
+            plan.unpack_marker_set_data = self.__unpack_selected_marker_set_data
+        else:
+            plan.unpack_marker_set_data = self.__unpack_marker_set_data
+
+        # Rigid bodies
+        if not selection.needs("rigid_bodies"):
+            plan.unpack_rigid_body_data = self.__skip_rigid_body_data
+        elif use_columns:
+            plan.unpack_rigid_body_data = self.__unpack_rigid_body_columns
+        elif selection.rigid_body_ids is not None:
+            plan.unpack_rigid_body_data = self.__unpack_selected_rigid_body_data
+        else:
+            plan.unpack_rigid_body_data = self.__unpack_rigid_body_data
 
-        # Send information to any listener.
-        if self.rigid_body_listener is not None:
-            self.rigid_body_listener( new_id, pos, rot )
+        # Skeletons
+        if not plan.has_skeletons:
+            plan.unpack_skeleton_data = self.__unpack_missing_skeleton_data
+        elif not selection.needs("skeletons"):
+            plan.unpack_skeleton_data = self.__skip_skeleton_data
+        else:
+            plan.unpack_skeleton_data = self.__unpack_skeleton_data
+
+        # Labeled markers
+        if not plan.has_labeled_markers:
+            plan.unpack_labeled_marker_data = self.__unpack_missing_labeled_marker_data
+        elif not selection.needs("labeled_markers"):
+            plan.unpack_labeled_marker_data = self.__skip_labeled_marker_data
+        elif use_columns:
+            plan.unpack_labeled_marker_data = self.__unpack_labeled_marker_columns
+        elif selection.labeled_marker_model_ids is not None:
+            plan.unpack_labeled_marker_data = self.__unpack_selected_labeled_marker_data
+        else:
+            plan.unpack_labeled_marker_data = self.__unpack_labeled_marker_data
 
-        # RB Marker Data ( Before version 3.0.  After Version 3.0 Marker data is in description )
-        if( major < 3  and major != 0) :
-            # Marker count (4 bytes)
-            marker_count = int.from_bytes( data[offset:offset+4], byteorder='little' )
-            offset += 4
-            marker_count_range = range( 0, marker_count )
-            trace_mf( "\tMarker Count:", marker_count )
-
-            rb_marker_list=[]
-            for i in marker_count_range:
-                rb_marker_list.append(MoCapData.RigidBodyMarker())
-
-            # Marker positions
-            for i in marker_count_range:
-                pos = Vector3.unpack( data[offset:offset+12] )
-                offset += 12
-                trace_mf( "\tMarker", i, ":", pos[0],",", pos[1],",", pos[2] )
-                rb_marker_list[i].pos=pos
-
-
-            if major >= 2:
-                # Marker ID's
-                for i in marker_count_range:
-                    new_id = int.from_bytes( data[offset:offset+4], byteorder='little' )
-                    offset += 4
-                    trace_mf( "\tMarker ID", i, ":", new_id )
-                    rb_marker_list[i].id=new_id
-
-                # Marker sizes
-                for i in marker_count_range:
-                    size = FloatValue.unpack( data[offset:offset+4] )
-                    offset += 4
-                    trace_mf( "\tMarker Size", i, ":", size[0] )
-                    rb_marker_list[i].size=size
-
-            for i in marker_count_range:
-                rigid_body.add_rigid_body_marker(rb_marker_list[i])
-        if major >= 2 :
-            marker_error, = FloatValue.unpack( data[offset:offset+4] )
+        # Force plates and devices
+        if not plan.has_force_plates:
+            plan.unpack_force_plate_data = self.__unpack_missing_force_plate_data
+        elif not selection.needs("force_plates"):
+            plan.unpack_force_plate_data = self.__skip_force_plate_data
+        else:
+            plan.unpack_force_plate_data = self.__unpack_force_plate_data
+        if not plan.has_devices:
+            plan.unpack_device_data = self.__unpack_missing_device_data
+        elif not selection.needs("devices"):
+            plan.unpack_device_data = self.__skip_device_data
+        else:
+            plan.unpack_device_data = self.__unpack_device_data
+
+        self.__decode_plan = plan
+        trace_mf( "Decode plan compiled for NatNet version", plan.major, ".", plan.minor )
+
+    # Unpack count rigid bodies stored as fixed size records (no marker data in the frame)
+    def __unpack_rigid_body_records( self, data, offset, plan, count):
+        record = plan.rigid_body_record
+        padding = plan.rigid_body_padding
+        listener = self.rigid_body_listener
+        end = offset + record.size*count
+
+        rigid_body_list = []
+        for values in record.iter_unpack( memoryview( data )[offset:end] ):
+            new_id, pos_x, pos_y, pos_z, rot_x, rot_y, rot_z, rot_w, error, param = values + padding
+            pos = ( pos_x, pos_y, pos_z )
+            rot = ( rot_x, rot_y, rot_z, rot_w )
+            rigid_body = MoCapData.RigidBody(new_id, pos, rot)
+            rigid_body.error = error
+            rigid_body.tracking_valid = ( param & 0x01 ) != 0
+            rigid_body_list.append(rigid_body)
+
+            # Send information to any listener.
+            if listener is not None:
+                listener( new_id, pos, rot )
+        return end, rigid_body_list
+
+    # Unpack count rigid bodies followed by their marker data ( Before version 3.0.  After Version 3.0 Marker data is in description )
+    def __unpack_rigid_bodies_with_markers( self, data, offset, plan, count):
+        head = plan.rigid_body_head
+        tail = plan.rigid_body_tail
+        padding = plan.rigid_body_padding
+        listener = self.rigid_body_listener
+
+        rigid_body_list = []
+        for _ in range( 0, count ):
+            values = head.unpack_from( data, offset )
+            offset += head.size
+            new_id = values[0]
+            pos = values[1:4]
+            rot = values[4:8]
+            rigid_body = MoCapData.RigidBody(new_id, pos, rot)
+
+            # Send information to any listener.
+            if listener is not None:
+                listener( new_id, pos, rot )
+
+            # Marker count (4 bytes) and positions
+            marker_count, = NNIntValue.unpack_from( data, offset )
             offset += 4
-            trace_mf( "\tMarker Error: %3.2f"% marker_error )
-            rigid_body.error = marker_error
-
-        # Version 2.6 and later
-        if ( ( major == 2 ) and ( minor >= 6 ) ) or major > 2 :
-            param, = struct.unpack( 'h', data[offset:offset+2] )
-            tracking_valid = ( param & 0x01 ) != 0
-            offset += 2
-            is_valid_str='False'
-            if tracking_valid:
-                is_valid_str = 'True'
-            trace_mf( "\tTracking Valid: %s"%is_valid_str)
-            if tracking_valid:
-                rigid_body.tracking_valid = True
-            else:
-                rigid_body.tracking_valid = False
-
-
-        return offset, rigid_body
+            rb_marker_list = [MoCapData.RigidBodyMarker() for _ in range( 0, marker_count )]
+            for i, pos in enumerate( Vector3.iter_unpack( memoryview( data )[offset:offset + 12*marker_count] ) ):
+                rb_marker_list[i].pos = pos
+            offset += 12*marker_count
+
+            # Marker ID's and sizes (Version 2.0 and later)
+            if plan.rigid_body_has_marker_ids:
+                marker_ids = struct.unpack_from( '<%dI' % marker_count, data, offset )
+                offset += 4*marker_count
+                marker_sizes = struct.unpack_from( '<%df' % marker_count, data, offset )
+                offset += 4*marker_count
+                for i in range( 0, marker_count ):
+                    rb_marker_list[i].id_num = marker_ids[i]
+                    rb_marker_list[i].size = marker_sizes[i]
+            rigid_body.rb_marker_list = rb_marker_list
+
+            # Marker error and tracking flags
+            error, param = tail.unpack_from( data, offset ) + padding
+            offset += tail.size
+            rigid_body.error = error
+            rigid_body.tracking_valid = ( param & 0x01 ) != 0
+
+            rigid_body_list.append(rigid_body)
+        return offset, rigid_body_list
+
+    # Skip count rigid bodies stored as fixed size records
+    def __skip_rigid_body_records( self, data, offset, plan, count):
+        return offset + plan.rigid_body_record.size*count
+
+    # Skip count rigid bodies followed by their marker data
+    def __skip_rigid_bodies_with_markers( self, data, offset, plan, count):
+        head_size = plan.rigid_body_head.size
+        tail_size = plan.rigid_body_tail.size
+        marker_size = plan.rigid_body_marker_size
+        for _ in range( 0, count ):
+            marker_count, = NNIntValue.unpack_from( data, offset + head_size )
+            offset += head_size + 4 + marker_size*marker_count + tail_size
+        return offset
 
     # Unpack a skeleton object from a data packet
-    def __unpack_skeleton( self, data, major, minor):
-
-        offset = 0
-        new_id = int.from_bytes( data[offset:offset+4], byteorder='little' )
-        offset += 4
+    def __unpack_skeleton( self, data, offset, plan):
+        new_id, rigid_body_count = NNIntPair.unpack_from( data, offset )
+        offset += 8
         trace_mf( "ID:", new_id )
+        trace_mf( "Rigid Body Count :", rigid_body_count )
         skeleton = MoCapData.Skeleton(new_id)
-
-        rigid_body_count = int.from_bytes( data[offset:offset+4], byteorder='little' )
-        offset += 4
-        trace_mf( "Rigid Body Count : %3.1d"% rigid_body_count )
-        for rb_num in range( 0, rigid_body_count ):
-            offset_tmp, rigid_body = self.__unpack_rigid_body( data[offset:], major, minor, rb_num )
-            skeleton.add_rigid_body(rigid_body)
-            offset+=offset_tmp
-
+        offset, skeleton.rigid_body_list = plan.unpack_rigid_bodies( data, offset, plan, rigid_body_count )
         return offset, skeleton
 
 #Unpack Mocap Data Functions
-    def __unpack_frame_prefix_data( self, data):
-        offset = 0
+# All the functions below read the packet in place: they receive the absolute offset of the section
+# and return the absolute offset of the next one. The objects are created here, so they are added
+# directly to the lists of their containers (the add_* functions would deep copy them).
+# The version dependent layouts are taken from the decode plan (see DecodePlan).
+    def __unpack_frame_prefix_data( self, data, offset):
         # Frame number (4 bytes)
-        frame_number = int.from_bytes( data[offset:offset+4], byteorder='little' )
+        frame_number, = NNIntValue.unpack_from( data, offset )
         offset += 4
         trace_mf( "Frame #:", frame_number )
         frame_prefix_data=MoCapData.FramePrefixData(frame_number)
         return offset, frame_prefix_data
 
-    def __unpack_marker_set_data( self, data, packet_size, major, minor):
+    def __unpack_marker_set_data( self, data, offset, end, plan):
         marker_set_data=MoCapData.MarkerSetData()
-        offset = 0
         # Marker set count (4 bytes)
-        marker_set_count = int.from_bytes( data[offset:offset+4], byteorder='little' )
+        marker_set_count, = NNIntValue.unpack_from( data, offset )
         offset += 4
         trace_mf( "Marker Set Count:", marker_set_count )
 
+        unpack_pos = Vector3.unpack_from
+        marker_data_list = marker_set_data.marker_data_list
         for i in range( 0, marker_set_count ):
             marker_data = MoCapData.MarkerData()
             # Model name
-            model_name, separator, remainder = bytes(data[offset:]).partition( b'\0' )
-            offset += len( model_name ) + 1
-            trace_mf( "Model Name      : ", model_name.decode( 'utf-8' ) )
+            offset, model_name = self.__unpack_string( data, offset, end )
             marker_data.set_model_name(model_name)
             # Marker count (4 bytes)
-            marker_count = int.from_bytes( data[offset:offset+4], byteorder='little' )
+            marker_count, = NNIntValue.unpack_from( data, offset )
             offset += 4
-            trace_mf( "Marker Count    : ", marker_count )
+            trace_mf( "Model Name      : ", model_name, " Marker Count : ", marker_count )
 
-            for j in range( 0, marker_count ):
-                pos = Vector3.unpack( data[offset:offset+12] )
-                offset += 12
-                trace_mf( "\tMarker %3.1d : [%3.2f,%3.2f,%3.2f]"%( j, pos[0], pos[1], pos[2] ))
-                marker_data.add_pos(pos)
-            marker_set_data.add_marker_data(marker_data)
+            marker_data.marker_pos_list = [unpack_pos( data, offset + 12*j ) for j in range( 0, marker_count )]
+            offset += 12*marker_count
+            marker_data_list.append(marker_data)
 
         # Unlabeled markers count (4 bytes)
-        unlabeled_markers_count = int.from_bytes( data[offset:offset+4], byteorder='little' )
+        unlabeled_markers_count, = NNIntValue.unpack_from( data, offset )
         offset += 4
         trace_mf( "Unlabeled Markers Count:", unlabeled_markers_count )
 
-        for i in range( 0, unlabeled_markers_count ):
-            pos = Vector3.unpack( data[offset:offset+12] )
-            offset += 12
-            trace_mf( "\tMarker %3.1d : [%3.2f,%3.2f,%3.2f]"%( i, pos[0], pos[1], pos[2] ))
-            marker_set_data.add_unlabeled_marker(pos)
+        marker_set_data.unlabeled_markers.marker_pos_list = [unpack_pos( data, offset + 12*i ) for i in range( 0, unlabeled_markers_count )]
+        offset += 12*unlabeled_markers_count
+        return offset, marker_set_data
+
+    # Marker sets selected by model name (the other ones and the unlabeled markers are skipped)
+    def __unpack_selected_marker_set_data( self, data, offset, end, plan):
+        marker_set_data=MoCapData.MarkerSetData()
+        marker_set_count, = NNIntValue.unpack_from( data, offset )
+        offset += 4
+
+        names = plan.selection.marker_set_names
+        unpack_pos = Vector3.unpack_from
+        marker_data_list = marker_set_data.marker_data_list
+        for i in range( 0, marker_set_count ):
+            offset, model_name = self.__unpack_string( data, offset, end )
+            marker_count, = NNIntValue.unpack_from( data, offset )
+            offset += 4
+            if model_name in names:
+                marker_data = MoCapData.MarkerData()
+                marker_data.set_model_name(model_name)
+                marker_data.marker_pos_list = [unpack_pos( data, offset + 12*j ) for j in range( 0, marker_count )]
+                marker_data_list.append(marker_data)
+            offset += 12*marker_count
+
+        unlabeled_markers_count, = NNIntValue.unpack_from( data, offset )
+        offset += 4 + 12*unlabeled_markers_count
         return offset, marker_set_data
 
-    def __unpack_rigid_body_data( self, data, packet_size, major, minor):
+    def __skip_marker_set_data( self, data, offset, end, plan):
+        marker_set_count, = NNIntValue.unpack_from( data, offset )
+        offset += 4
+        for i in range( 0, marker_set_count ):
+            offset = data.index( b'\0', offset, end ) + 1
+            marker_count, = NNIntValue.unpack_from( data, offset )
+            offset += 4 + 12*marker_count
+
+        unlabeled_markers_count, = NNIntValue.unpack_from( data, offset )
+        offset += 4 + 12*unlabeled_markers_count
+        return offset, MoCapData.MarkerSetData()
+
+    def __unpack_rigid_body_data( self, data, offset, plan):
         rigid_body_data = MoCapData.RigidBodyData()
-        offset = 0
         # Rigid body count (4 bytes)
-        rigid_body_count = int.from_bytes( data[offset:offset+4], byteorder='little' )
+        rigid_body_count, = NNIntValue.unpack_from( data, offset )
         offset += 4
         trace_mf( "Rigid Body Count:", rigid_body_count )
 
-        for i in range( 0, rigid_body_count ):
-            offset_tmp, rigid_body = self.__unpack_rigid_body( data[offset:], major, minor, i )
-            offset += offset_tmp
-            rigid_body_data.add_rigid_body(rigid_body)
+        offset, rigid_body_data.rigid_body_list = plan.unpack_rigid_bodies( data, offset, plan, rigid_body_count )
+        return offset, rigid_body_data
+
+    # Rigid bodies selected by ID (the other ones are skipped)
+    def __unpack_selected_rigid_body_data( self, data, offset, plan):
+        rigid_body_data = MoCapData.RigidBodyData()
+        rigid_body_count, = NNIntValue.unpack_from( data, offset )
+        offset += 4
 
+        ids = plan.selection.rigid_body_ids
+        rigid_body_list = rigid_body_data.rigid_body_list
+        for _ in range( 0, rigid_body_count ):
+            new_id, = NNIntValue.unpack_from( data, offset )
+            if new_id in ids:
+                offset, rigid_bodies = plan.unpack_rigid_bodies( data, offset, plan, 1 )
+                rigid_body_list += rigid_bodies
+            else:
+                offset = plan.skip_rigid_bodies( data, offset, plan, 1 )
         return offset, rigid_body_data
 
+    def __skip_rigid_body_data( self, data, offset, plan):
+        rigid_body_count, = NNIntValue.unpack_from( data, offset )
+        return plan.skip_rigid_bodies( data, offset + 4, plan, rigid_body_count ), MoCapData.RigidBodyData()
 
-    def __unpack_skeleton_data( self, data, packet_size, major, minor):
-        skeleton_data = MoCapData.SkeletonData()
+    # Rigid bodies mapped as column arrays (numpy decode mode, version 3.0 and later)
+    def __unpack_rigid_body_columns( self, data, offset, plan):
+        rigid_body_count, = NNIntValue.unpack_from( data, offset )
+        offset += 4
+        records = ColumnarData.map_records( data, offset, rigid_body_count, ColumnarData.RIGID_BODY_DTYPE )
+        end = offset + records.nbytes
+        if plan.selection.rigid_body_ids is not None:
+            records = ColumnarData.select_records( records, records['id'], plan.selection.rigid_body_ids )
+        rigid_body_data = ColumnarData.RigidBodyColumns(records)
 
-        offset = 0
-        # Version 2.1 and later
-        skeleton_count = 0
-        if( ( major == 2 and minor > 0 ) or major > 2 ):
-            skeleton_count = int.from_bytes( data[offset:offset+4], byteorder='little' )
-            offset += 4
-            trace_mf( "Skeleton Count:", skeleton_count )
-            for _ in range( 0, skeleton_count ):
-                rel_offset, skeleton = self.__unpack_skeleton( data[offset:], major, minor )
-                offset += rel_offset
-                skeleton_data.add_skeleton(skeleton)
+        # Send information to any listener.
+        if self.rigid_body_listener is not None:
+            for new_id, pos, rot in zip( rigid_body_data.ids.tolist(), rigid_body_data.positions.tolist(), rigid_body_data.quaternions.tolist() ):
+                self.rigid_body_listener( new_id, tuple(pos), tuple(rot) )
+
+        return end, rigid_body_data
+
+    # Skeleton data (version 2.1 and later)
+    def __unpack_skeleton_data( self, data, offset, plan):
+        skeleton_data = MoCapData.SkeletonData()
+        skeleton_count, = NNIntValue.unpack_from( data, offset )
+        offset += 4
+        trace_mf( "Skeleton Count:", skeleton_count )
+        skeleton_list = skeleton_data.skeleton_list
+        for _ in range( 0, skeleton_count ):
+            offset, skeleton = self.__unpack_skeleton( data, offset, plan )
+            skeleton_list.append(skeleton)
 
         return offset, skeleton_data
 
+    def __unpack_missing_skeleton_data( self, data, offset, plan):
+        return offset, MoCapData.SkeletonData()
+
+    def __skip_skeleton_data( self, data, offset, plan):
+        skeleton_count, = NNIntValue.unpack_from( data, offset )
+        offset += 4
+        for _ in range( 0, skeleton_count ):
+            new_id, rigid_body_count = NNIntPair.unpack_from( data, offset )
+            offset = plan.skip_rigid_bodies( data, offset + 8, plan, rigid_body_count )
+        return offset, MoCapData.SkeletonData()
+
     def __decode_marker_id(self, new_id):
         model_id = 0
         marker_id = 0
@@ -557,211 +1047,175 @@ class NatNetClient:
         marker_id = new_id & 0x0000ffff
         return model_id, marker_id
 
-    def __unpack_labeled_marker_data( self, data, packet_size, major, minor):
+    # Labeled markers (Version 2.3 and later)
+    def __unpack_labeled_marker_data( self, data, offset, plan):
         labeled_marker_data = MoCapData.LabeledMarkerData()
-        offset = 0
-        # Labeled markers (Version 2.3 and later)
-        labeled_marker_count = 0
-        if( ( major == 2 and minor > 3 ) or major > 2 ):
-            labeled_marker_count = int.from_bytes( data[offset:offset+4], byteorder='little' )
+        labeled_marker_count, = NNIntValue.unpack_from( data, offset )
+        offset += 4
+        trace_mf( "Labeled Marker Count:", labeled_marker_count )
+
+        # ID, position, size, param (version 2.6 and later) and residual (version 3.0 and later)
+        record = plan.labeled_marker_record
+        padding = plan.labeled_marker_padding
+        end = offset + record.size*labeled_marker_count
+        labeled_marker_list = labeled_marker_data.labeled_marker_list
+        for values in record.iter_unpack( memoryview( data )[offset:end] ):
+            tmp_id, pos_x, pos_y, pos_z, size, param, residual = values + padding
+            #occluded = ( param & 0x01 ) != 0
+            #point_cloud_solved = ( param & 0x02 ) != 0
+            #model_solved = ( param & 0x04 ) != 0
+            labeled_marker_list.append(MoCapData.LabeledMarker(tmp_id, (pos_x, pos_y, pos_z), size, param, residual))
+
+        return end, labeled_marker_data
+
+    # Labeled markers mapped as column arrays (numpy decode mode, version 3.0 and later)
+    def __unpack_labeled_marker_columns( self, data, offset, plan):
+        labeled_marker_count, = NNIntValue.unpack_from( data, offset )
+        offset += 4
+        records = ColumnarData.map_records( data, offset, labeled_marker_count, ColumnarData.LABELED_MARKER_DTYPE )
+        end = offset + records.nbytes
+        if plan.selection.labeled_marker_model_ids is not None:
+            records = ColumnarData.select_records( records, records['id'] >> 16, plan.selection.labeled_marker_model_ids )
+        return end, ColumnarData.LabeledMarkerColumns(records)
+
+    # Labeled markers selected by the ID of their model (the other ones are skipped)
+    def __unpack_selected_labeled_marker_data( self, data, offset, plan):
+        labeled_marker_data = MoCapData.LabeledMarkerData()
+        labeled_marker_count, = NNIntValue.unpack_from( data, offset )
+        offset += 4
+
+        model_ids = plan.selection.labeled_marker_model_ids
+        record = plan.labeled_marker_record
+        padding = plan.labeled_marker_padding
+        end = offset + record.size*labeled_marker_count
+        labeled_marker_list = labeled_marker_data.labeled_marker_list
+        for record_offset in range( offset, end, record.size ):
+            tmp_id, = NNIntValue.unpack_from( data, record_offset )
+            if ( tmp_id >> 16 ) in model_ids:
+                tmp_id, pos_x, pos_y, pos_z, size, param, residual = record.unpack_from( data, record_offset ) + padding
+                labeled_marker_list.append(MoCapData.LabeledMarker(tmp_id, (pos_x, pos_y, pos_z), size, param, residual))
+
+        return end, labeled_marker_data
+
+    def __skip_labeled_marker_data( self, data, offset, plan):
+        labeled_marker_count, = NNIntValue.unpack_from( data, offset )
+        return offset + 4 + plan.labeled_marker_record.size*labeled_marker_count, MoCapData.LabeledMarkerData()
+
+    def __unpack_missing_labeled_marker_data( self, data, offset, plan):
+        return offset, MoCapData.LabeledMarkerData()
+
+    # Unpack the channels of a force plate or of a device (list of frame counts followed by the float values)
+    def __unpack_channel_data_list( self, data, offset, channel_data_class, channel_count):
+        channel_data_list = []
+        for _ in range( 0, channel_count ):
+            channel_data = channel_data_class()
+            frame_count, = NNIntValue.unpack_from( data, offset )
             offset += 4
-            trace_mf( "Labeled Marker Count:", labeled_marker_count )
-            for _ in range( 0, labeled_marker_count ):
-                model_id = 0
-                marker_id = 0
-                tmp_id = int.from_bytes( data[offset:offset+4], byteorder='little' )
-                offset += 4
-                model_id, marker_id = self.__decode_marker_id(tmp_id)
-                pos = Vector3.unpack( data[offset:offset+12] )
-                offset += 12
-                size = FloatValue.unpack( data[offset:offset+4] )
-                offset += 4
-                trace_mf("ID     : [MarkerID: %3.1d] [ModelID: %3.1d]"%(marker_id,model_id))
-                trace_mf("  pos  : [%3.2f, %3.2f, %3.2f]"%(pos[0],pos[1],pos[2]))
-                trace_mf("  size : [%3.2f]"%size)
-
-
-                # Version 2.6 and later
-                param = 0
-                if( ( major == 2 and minor >= 6 ) or major > 2):
-                    param, = struct.unpack( 'h', data[offset:offset+2] )
-                    offset += 2
-                    #occluded = ( param & 0x01 ) != 0
-                    #point_cloud_solved = ( param & 0x02 ) != 0
-                    #model_solved = ( param & 0x04 ) != 0
-
-                # Version 3.0 and later
-                residual = 0.0
-                if major >= 3 :
-                    residual, = FloatValue.unpack( data[offset:offset+4] )
-                    offset += 4
-                    trace_mf( "  err  : [%3.2f]"% residual )
-
-                labeled_marker = MoCapData.LabeledMarker(tmp_id,pos,size,param, residual)
-                labeled_marker_data.add_labeled_marker(labeled_marker)
-
-        return offset, labeled_marker_data
-
-    def __unpack_force_plate_data( self, data, packet_size, major, minor):
+            channel_data.frame_list = list( struct.unpack_from( '<%df' % frame_count, data, offset ) )
+            offset += 4*frame_count
+            channel_data_list.append(channel_data)
+        return offset, channel_data_list
+
+    # Skip the channels of a force plate or of a device
+    def __skip_channel_data_list( self, data, offset, channel_count):
+        for _ in range( 0, channel_count ):
+            frame_count, = NNIntValue.unpack_from( data, offset )
+            offset += 4 + 4*frame_count
+        return offset
+
+    # Force Plate data (version 2.9 and later)
+    def __unpack_force_plate_data( self, data, offset, plan):
         force_plate_data = MoCapData.ForcePlateData()
-        n_frames_show_max = 4
-        offset = 0
-        # Force Plate data (version 2.9 and later)
-        force_plate_count = 0
-        if( ( major == 2 and minor >= 9 ) or major > 2 ):
-            force_plate_count = int.from_bytes( data[offset:offset+4], byteorder='little' )
-            offset += 4
-            trace_mf( "Force Plate Count:", force_plate_count )
-            for i in range( 0, force_plate_count ):
-                # ID
-                force_plate_id = int.from_bytes( data[offset:offset+4], byteorder='little' )
-                offset += 4
-                force_plate = MoCapData.ForcePlate(force_plate_id)
-
-                # Channel Count
-                force_plate_channel_count = int.from_bytes( data[offset:offset+4], byteorder='little' )
-                offset += 4
-
-                trace_mf( "\tForce Plate %3.1d ID: %3.1d Num Channels: %3.1d"% (i, force_plate_id, force_plate_channel_count ))
-
-                # Channel Data
-                for j in range( force_plate_channel_count ):
-                    fp_channel_data = MoCapData.ForcePlateChannelData()
-                    force_plate_channel_frame_count = int.from_bytes( data[offset:offset+4], byteorder='little' )
-                    offset += 4
-                    out_string="\tChannel %3.1d: "%( j )
-                    out_string+="  %3.1d Frames - Frame Data: "%(force_plate_channel_frame_count)
-
-                    # Force plate frames
-                    n_frames_show = min(force_plate_channel_frame_count, n_frames_show_max)
-                    for k in range( force_plate_channel_frame_count ):
-                        force_plate_channel_val = FloatValue.unpack( data[offset:offset+4] )
-                        offset += 4
-                        fp_channel_data.add_frame_entry(force_plate_channel_val)
-
-                        if k < n_frames_show:
-                            out_string += "%3.2f "%(force_plate_channel_val)
-                    if n_frames_show < force_plate_channel_frame_count:
-                        out_string += " showing %3.1d of %3.1d frames"%(n_frames_show, force_plate_channel_frame_count)
-                    trace_mf( "%s"% out_string )
-                    force_plate.add_channel_data(fp_channel_data)
-                force_plate_data.add_force_plate(force_plate)
-        return offset, force_plate_data
+        force_plate_count, = NNIntValue.unpack_from( data, offset )
+        offset += 4
+        trace_mf( "Force Plate Count:", force_plate_count )
+        for i in range( 0, force_plate_count ):
+            # ID and channel count
+            force_plate_id, force_plate_channel_count = NNIntPair.unpack_from( data, offset )
+            offset += 8
+            force_plate = MoCapData.ForcePlate(force_plate_id)
+            trace_mf( "\tForce Plate", i, "ID:", force_plate_id, "Num Channels:", force_plate_channel_count )
 
-    def __unpack_device_data( self, data, packet_size, major, minor):
-        device_data = MoCapData.DeviceData()
-        n_frames_show_max = 4
-        offset = 0
-        # Device data (version 2.11 and later)
-        device_count = 0
-        if ( major == 2 and minor >= 11 ) or (major > 2) :
-            device_count = int.from_bytes( data[offset:offset+4], byteorder='little' )
-            offset += 4
-            trace_mf( "Device Count:", device_count )
-            for i in range( 0, device_count ):
-
-                # ID
-                device_id = int.from_bytes( data[offset:offset+4], byteorder='little' )
-                offset += 4
-                device = MoCapData.Device(device_id)
-                # Channel Count
-                device_channel_count = int.from_bytes( data[offset:offset+4], byteorder='little' )
-                offset += 4
-
-                trace_mf( "\tDevice %3.1d      ID: %3.1d Num Channels: %3.1d"% (i, device_id, device_channel_count ))
-
-                # Channel Data
-                for j in range( 0, device_channel_count ):
-                    device_channel_data = MoCapData.DeviceChannelData()
-                    device_channel_frame_count = int.from_bytes( data[offset:offset+4], byteorder='little' )
-                    offset += 4
-                    out_string="\tChannel %3.1d "% (j)
-                    out_string+="  %3.1d Frames - Frame Data: "%(device_channel_frame_count)
-
-                    # Device Frame Data
-                    n_frames_show = min(device_channel_frame_count, n_frames_show_max)
-                    for k in range( 0, device_channel_frame_count ):
-                        device_channel_val = int.from_bytes( data[offset:offset+4], byteorder='little' )
-                        device_channel_val = FloatValue.unpack( data[offset:offset+4] )
-                        offset += 4
-                        if k < n_frames_show:
-                            out_string += "%3.2f "%(device_channel_val)
-
-                        device_channel_data.add_frame_entry(device_channel_val)
-                    if n_frames_show < device_channel_frame_count:
-                        out_string += " showing %3.1d of %3.1d frames"%(n_frames_show, device_channel_frame_count)
-                    trace_mf( "%s"% out_string )
-                    device.add_channel_data(device_channel_data)
-                device_data.add_device(device)
-        return offset, device_data
+            # Channel Data
+            offset, force_plate.channel_data_list = self.__unpack_channel_data_list( data, offset, MoCapData.ForcePlateChannelData, force_plate_channel_count )
+            force_plate_data.force_plate_list.append(force_plate)
+        return offset, force_plate_data
 
-    def __unpack_frame_suffix_data( self, data, packet_size, major, minor):
-        frame_suffix_data = MoCapData.FrameSuffixData()
-        offset = 0
+    def __unpack_missing_force_plate_data( self, data, offset, plan):
+        return offset, MoCapData.ForcePlateData()
 
-        # Timecode
-        timecode = int.from_bytes( data[offset:offset+4], byteorder='little' )
+    def __skip_force_plate_data( self, data, offset, plan):
+        force_plate_count, = NNIntValue.unpack_from( data, offset )
         offset += 4
-        frame_suffix_data.timecode = timecode
+        for _ in range( 0, force_plate_count ):
+            force_plate_id, force_plate_channel_count = NNIntPair.unpack_from( data, offset )
+            offset = self.__skip_channel_data_list( data, offset + 8, force_plate_channel_count )
+        return offset, MoCapData.ForcePlateData()
 
-        timecode_sub = int.from_bytes( data[offset:offset+4], byteorder='little' )
+    # Device data (version 2.11 and later)
+    def __unpack_device_data( self, data, offset, plan):
+        device_data = MoCapData.DeviceData()
+        device_count, = NNIntValue.unpack_from( data, offset )
         offset += 4
-        frame_suffix_data.timecode_sub = timecode_sub
-
-        # Timestamp (increased to double precision in 2.7 and later)
-        if ( major == 2 and minor >= 7 ) or (major > 2 ):
-            timestamp, = DoubleValue.unpack( data[offset:offset+8] )
+        trace_mf( "Device Count:", device_count )
+        for i in range( 0, device_count ):
+            # ID and channel count
+            device_id, device_channel_count = NNIntPair.unpack_from( data, offset )
             offset += 8
-        else:
-            timestamp, = FloatValue.unpack( data[offset:offset+4] )
-            offset += 4
-        trace_mf("Timestamp : %3.2f"%timestamp)
-        frame_suffix_data.timestamp = timestamp
+            device = MoCapData.Device(device_id)
+            trace_mf( "\tDevice", i, "ID:", device_id, "Num Channels:", device_channel_count )
 
-        # Hires Timestamp (Version 3.0 and later)
-        if major >= 3 :
-            stamp_camera_mid_exposure = int.from_bytes( data[offset:offset+8], byteorder='little' )
-            trace_mf("Mid-exposure timestamp         : %3.1d"%stamp_camera_mid_exposure)
-            offset += 8
-            frame_suffix_data.stamp_camera_mid_exposure = stamp_camera_mid_exposure
+            # Channel Data
+            offset, device.channel_data_list = self.__unpack_channel_data_list( data, offset, MoCapData.DeviceChannelData, device_channel_count )
+            device_data.device_list.append(device)
+        return offset, device_data
 
-            stamp_data_received = int.from_bytes( data[offset:offset+8], byteorder='little' )
-            offset += 8
-            frame_suffix_data.stamp_data_received = stamp_data_received
-            trace_mf("Camera data received timestamp : %3.1d"%stamp_data_received)
+    def __unpack_missing_device_data( self, data, offset, plan):
+        return offset, MoCapData.DeviceData()
 
-            stamp_transmit = int.from_bytes( data[offset:offset+8], byteorder='little' )
-            offset += 8
-            trace_mf("Transmit timestamp             : %3.1d"%stamp_transmit)
-            frame_suffix_data.stamp_transmit = stamp_transmit
+    def __skip_device_data( self, data, offset, plan):
+        device_count, = NNIntValue.unpack_from( data, offset )
+        offset += 4
+        for _ in range( 0, device_count ):
+            device_id, device_channel_count = NNIntPair.unpack_from( data, offset )
+            offset = self.__skip_channel_data_list( data, offset + 8, device_channel_count )
+        return offset, MoCapData.DeviceData()
+
+    def __unpack_frame_suffix_data( self, data, offset, plan):
+        frame_suffix_data = MoCapData.FrameSuffixData()
 
+        # Timecode, timestamp (double precision in 2.7 and later), hires timestamps (version 3.0 and later) and frame parameters
+        record = plan.frame_suffix_record
+        for name, value in zip( plan.frame_suffix_fields, record.unpack_from( data, offset ) ):
+            setattr( frame_suffix_data, name, value )
+        offset += record.size
+        trace_mf("Timestamp :", frame_suffix_data.timestamp)
 
-        # Frame parameters
-        param, = struct.unpack( 'h', data[offset:offset+2] )
-        is_recording = ( param & 0x01 ) != 0
-        tracked_models_changed = ( param & 0x02 ) != 0
-        offset += 2
-        frame_suffix_data.param = param
-        frame_suffix_data.is_recording = is_recording
-        frame_suffix_data.tracked_models_changed = tracked_models_changed
+        param = frame_suffix_data.param
+        frame_suffix_data.is_recording = ( param & 0x01 ) != 0
+        frame_suffix_data.tracked_models_changed = ( param & 0x02 ) != 0
 
         return offset, frame_suffix_data
 
     # Unpack data from a motion capture frame message
-    def __unpack_mocap_data( self, data : bytes, packet_size, major, minor):
+    # data is the whole packet (bytes or bytearray), offset is the start of the frame and end the end of the packet
+    def __unpack_mocap_data( self, data, offset, end, plan):
         def makeDataReadyForWebsocket(data):
             # The division in marker data and rigid body data is done to make the data easier to manage and easier to modify in the future
             # It's indeed important to underline that some of the informations in the rigid body data are also present in the marker data
 
             # If the rigidbody filter is off return everything
-            if RIGIDBODY_FILTER_ON == False:
+            rigid_body_filter = self.rigid_body_filter
+            if rigid_body_filter is None:
                 return data
+            name_lookup = rigid_body_filter.name_lookup # The model names are the raw bytes read from the packet
+            id_lookup = rigid_body_filter.id_lookup
             
             # Get marker data
             return_data = []
             markers = data.get_marker_set_data().get_labeled_data()
             for markerSet in markers:
-                if markerSet.get_model_name_str() in [filter['name'] for filter in RIGIDBODY_FILTER]:
+                if markerSet.model_name in name_lookup:
                     points = markerSet.get_pos_list()
                     counter_id = 0
                     for i in points:
@@ -776,9 +1230,27 @@ class NatNetClient:
                         })
             
             # Get rigid body data
-            rigid_bodies = data.get_rigid_body_data().get_rigid_body_list()
+            rigid_body_data = data.get_rigid_body_data()
+            if isinstance(rigid_body_data, ColumnarData.RigidBodyColumns):
+                ids, positions, rotations, tracking_valid = rigid_body_data.select(id_lookup)
+                for rigid_body_id, pos, rot, valid in zip(ids, positions, rotations, tracking_valid):
+                    return_data.append({
+                            'type': 'rigidBody',
+                            'ID': rigid_body_id,
+                            'x': pos[0],
+                            'y': pos[1],
+                            'z': pos[2],
+                            'qx': rot[0],
+                            'qy': rot[1],
+                            'qz': rot[2],
+                            'qw': rot[3],
+                            'valid': valid
+                    })
+                return return_data
+
+            rigid_bodies = rigid_body_data.get_rigid_body_list()
             for rigid_body in rigid_bodies:
-                if rigid_body.get_id() in [filter['id'] for filter in RIGIDBODY_FILTER]:
+                if rigid_body.get_id() in id_lookup:
                     return_data.append({
                             'type': 'rigidBody',
                             'ID': rigid_body.get_id(),
@@ -788,74 +1260,71 @@ class NatNetClient:
                             'qx': rigid_body.get_rot()[0],
                             'qy': rigid_body.get_rot()[1],
                             'qz': rigid_body.get_rot()[2],
-                            'qw': rigid_body.get_rot()[3]
+                            'qw': rigid_body.get_rot()[3],
+                            'valid': rigid_body.tracking_valid
                     })
             return return_data
 
+        profiler = self.profiler
+        if profiler is not None and profiler.active:
+            mocap_data = profiler.wrap(self.__unpack_mocap_frame, UNPACK_FRAME_STAGE)(data, offset, end, plan)
+            makeDataReadyForWebsocket = profiler.wrap(makeDataReadyForWebsocket, MAKE_DATA_READY_STAGE)
+        else:
+            mocap_data = self.__unpack_mocap_frame(data, offset, end, plan)
+        self.__last_frame_suffix_data = mocap_data.suffix_data
+        return {
+            "frame_number": mocap_data.prefix_data.frame_number,
+            "timestamp": mocap_data.suffix_data.timestamp,
+            "mocap_data": makeDataReadyForWebsocket(mocap_data)
+        }
+
+    # Copy of the decode plan whose section functions are measured by the profiler (made again when the plan changes)
+    def __get_profiled_plan( self ):
+        plan = self.__decode_plan
+        if self.__profiled_plan is None or self.__profiled_plan[0] is not plan:
+            profiled_plan = copy.copy(plan)
+            for function_name, section in PROFILED_SECTIONS:
+                setattr(profiled_plan, function_name, self.profiler.wrap(getattr(plan, function_name), UNPACK_FRAME_STAGE + (section,)))
+            self.__profiled_plan = (plan, profiled_plan)
+        return self.__profiled_plan[1]
+
+    # Unpack the sections of a frame selected by the decode plan
+    def __unpack_mocap_frame( self, data, offset, end, plan):
         mocap_data = MoCapData.MoCapData()
-        data = memoryview( data )
-        offset = 0
-        rel_offset = 0
 
         #Frame Prefix Data
-        rel_offset, frame_prefix_data = self.__unpack_frame_prefix_data(data[offset:])
-        offset += rel_offset
+        offset, frame_prefix_data = self.__unpack_frame_prefix_data(data, offset)
         mocap_data.set_prefix_data(frame_prefix_data)
-        frame_number = frame_prefix_data.frame_number
 
         #Marker Set Data
-        rel_offset, marker_set_data =self.__unpack_marker_set_data(data[offset:], (packet_size - offset),major, minor)
-        offset += rel_offset
+        offset, marker_set_data = plan.unpack_marker_set_data(data, offset, end, plan)
         mocap_data.set_marker_set_data(marker_set_data)
-        marker_set_count = marker_set_data.get_marker_set_count()
-        unlabeled_markers_count = marker_set_data.get_unlabeled_marker_count()
 
         # Rigid Body Data
-        rel_offset, rigid_body_data = self.__unpack_rigid_body_data(data[offset:], (packet_size - offset),major, minor)
-        offset += rel_offset
+        offset, rigid_body_data = plan.unpack_rigid_body_data(data, offset, plan)
         mocap_data.set_rigid_body_data(rigid_body_data)
-        rigid_body_count = rigid_body_data.get_rigid_body_count()
 
         # Skeleton Data
-        rel_offset, skeleton_data = self.__unpack_skeleton_data(data[offset:], (packet_size - offset),major, minor)
-        offset += rel_offset
+        offset, skeleton_data = plan.unpack_skeleton_data(data, offset, plan)
         mocap_data.set_skeleton_data(skeleton_data)
-        skeleton_count = skeleton_data.get_skeleton_count()
 
         # Labeled Marker Data
-        rel_offset, labeled_marker_data = self.__unpack_labeled_marker_data(data[offset:], (packet_size - offset),major, minor)
-        offset += rel_offset
+        offset, labeled_marker_data = plan.unpack_labeled_marker_data(data, offset, plan)
         mocap_data.set_labeled_marker_data(labeled_marker_data)
-        labeled_marker_count = labeled_marker_data.get_labeled_marker_count()
 
         # Force Plate Data
-        rel_offset, force_plate_data = self.__unpack_force_plate_data(data[offset:], (packet_size - offset),major, minor)
-        offset += rel_offset
+        offset, force_plate_data = plan.unpack_force_plate_data(data, offset, plan)
         mocap_data.set_force_plate_data(force_plate_data)
 
         # Device Data
-        rel_offset,device_data = self.__unpack_device_data(data[offset:], (packet_size - offset),major, minor)
-        offset += rel_offset
+        offset, device_data = plan.unpack_device_data(data, offset, plan)
         mocap_data.set_device_data(device_data)
 
         # Frame Suffix Data
-        #rel_offset, timecode, timecode_sub, timestamp, is_recording, tracked_models_changed = \
-        rel_offset, frame_suffix_data =   self.__unpack_frame_suffix_data(data[offset:], (packet_size - offset),major, minor)
-        offset += rel_offset
+        offset, frame_suffix_data = self.__unpack_frame_suffix_data(data, offset, plan)
         mocap_data.set_suffix_data(frame_suffix_data)
 
-
-        timecode = frame_suffix_data.timecode
-        timecode_sub= frame_suffix_data.timecode_sub
-        timestamp = frame_suffix_data.timestamp
-        is_recording = frame_suffix_data.is_recording
-        tracked_models_changed = frame_suffix_data.tracked_models_changed
-
-        return {
-            "frame_number": frame_number,
-            "timestamp": timestamp,
-            "mocap_data": makeDataReadyForWebsocket(mocap_data)
-        }
+        return mocap_data
 
     # Unpack a marker set description packet
     def __unpack_marker_set_description( self, data, major, minor):
@@ -1210,10 +1679,19 @@ class NatNetClient:
             self.__nat_net_requested_version[1] = self.__nat_net_stream_version_server[1]
             self.__nat_net_requested_version[2] = self.__nat_net_stream_version_server[2]
             self.__nat_net_requested_version[3] = self.__nat_net_stream_version_server[3]
+            self.__compile_decode_plan()
             # Determine if the bitstream version can be changed
             if (self.__nat_net_stream_version_server[0] >= 4) and (self.use_multicast == False):
                 self.__can_change_bitstream_version = True
 
+        # Frequency of the hi-res timestamps (version 3.0 and later)
+        if len(data) >= offset + 8:
+            self.__high_res_clock_frequency, = struct.unpack( '<Q', data[offset:offset+8] )
+            offset += 8
+            if self.latency_tracer is not None:
+                self.latency_tracer.clock_frequency = self.__high_res_clock_frequency
+                self.latency_tracer.reset_clock_offset()
+
         trace_mf("Sending Application Name: ", self.__application_name)
         trace_mf("NatNetVersion " , str(self.__nat_net_stream_version_server[0]), " "
             , str(self.__nat_net_stream_version_server[1]), " "
@@ -1251,6 +1729,9 @@ class NatNetClient:
                     #return 4
 
             if len( data ) > 0 : 
+                packet_recorder = self.packet_recorder
+                if packet_recorder is not None:
+                    packet_recorder.record( data, SOURCE_COMMAND )
                 self.__process_message( data )
                 data=bytearray(0)
 
@@ -1273,13 +1754,133 @@ class NatNetClient:
         # Shut down everything
         self.set_shutdown()
 
+    # Decode a batch of packets received on the data socket and queue the frames for the websocket
+    def __on_data_packets(self, batch):
+        packet_recorder = self.packet_recorder
+        latency_tracer = self.latency_tracer
+        frame_sequence_tracker = self.frame_sequence_tracker
+        metrics = self.metrics
+        profiler = self.profiler
+        is_timed = latency_tracer is not None or frame_sequence_tracker is not None
+        for data in batch:
+            if len( data ) == 0:
+                continue
+            if is_timed:
+                # The packets of the batch are decoded one after the other: each one is timed from the start of its
+                # own processing, so its decoding time doesn't include the packets before it in the batch
+                receive_time = time.perf_counter_ns()
+            if packet_recorder is not None:
+                packet_recorder.record( data, SOURCE_DATA )
+            if metrics is not None:
+                metrics.packets_received += 1
+                metrics.bytes_received += len( data )
+            if frame_sequence_tracker is not None and len( data ) >= 8 and self.get_message_id( data ) == self.NAT_FRAMEOFDATA:
+                # The frame number is read from the header, so the late frames are dropped before being decoded
+                frame_number = int.from_bytes( data[4:8], byteorder='little' )
+                if not frame_sequence_tracker.check( frame_number, receive_time ):
+                    continue
+            if metrics is not None:
+                decode_start = time.perf_counter_ns()
+            try:
+                if profiler is not None and profiler.sample():
+                    processed_data = self.__process_sampled_message( data )
+                else:
+                    processed_data = self.__process_message( data )
+            except Exception as e:
+                if metrics is not None:
+                    metrics.decode_errors += 1
+                self.logger.error("ERROR: could not decode data packet: " + str(e))
+                continue
+            if not processed_data:
+                continue
+            if metrics is not None:
+                metrics.frames_decoded += 1
+                metrics.decode_time.observe((time.perf_counter_ns() - decode_start) / 1e9)
+            if latency_tracer is not None:
+                latency_tracer.on_decoded(processed_data["frame_number"], receive_time, time.perf_counter_ns(), self.__last_frame_suffix_data)
+
+            # The buffer keeps only the freshest data if the websocket is not able to follow
+            self.frame_buffer.put(processed_data)
+
+    # Decode a packet measuring the time of each stage
+    def __process_sampled_message(self, data):
+        profiler = self.profiler
+        profiler.active = True
+        start = time.perf_counter_ns()
+        try:
+            return self.__process_message( data )
+        finally:
+            profiler.active = False
+            profiler.record(PROCESS_MESSAGE_STAGE, time.perf_counter_ns() - start)
+
+    # Called by the event loop every time the data socket has packets waiting. A single batch is read: if more
+    # packets are waiting the callback is called again, after the websocket sender had a chance to run
+    def __on_data_socket_readable(self, receiver):
+        try:
+            batch = receiver.receive_batch()
+        except OSError as e:
+            self.__on_data_socket_error(e)
+            return
+        if batch:
+            self.__on_data_packets(batch)
+
+    def __on_data_socket_error(self, exc):
+        if not self.stop_threads:
+            self.logger.error("ERROR: data socket access error occurred:\n  %s" % exc)
+
+    # Start reading the data socket from the event loop. Return the function which stops it
+    async def __watch_data_socket(self, loop, in_socket):
+        in_socket.setblocking(False)
+        receiver = BatchReceiver(in_socket, batch_size=RECEIVE_BATCH_SIZE)
+        try:
+            loop.add_reader(in_socket.fileno(), self.__on_data_socket_readable, receiver)
+            return lambda: loop.remove_reader(in_socket.fileno())
+        except NotImplementedError:
+            # The proactor event loop (default on Windows) can't watch a socket: the packets are received one
+            # at a time by a datagram endpoint (which closes the socket when it's closed)
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: DataChannelProtocol(lambda data: self.__on_data_packets((data,)), self.__on_data_socket_error),
+                sock=in_socket)
+            return transport.close
+
     async def __data_thread_function(self, in_socket, stop):
+        stop_watching = None
+        try:
+            # Drive the data socket from the event loop so that the websocket is never starved
+            loop = asyncio.get_running_loop()
+            # The buffer holds at least a whole batch of packets, so a burst is not dropped before the sender runs
+            self.frame_buffer = FrameBuffer(policy=DATA_QUEUE_POLICY, size=max(DATA_QUEUE_SIZE, RECEIVE_BATCH_SIZE))
+            if self.latency_tracer is not None:
+                loop.create_task(self.__log_latency(stop))
+            if self.metrics is not None:
+                loop.create_task(self.__serve_metrics(in_socket, stop))
+            if self.replay is not None:
+                # In client mode the replay waits for the websocket connection, in server mode it starts immediately
+                self.__replay_started = asyncio.Event()
+                if self.websocket_mode == "server":
+                    self.__replay_started.set()
+                loop.create_task(self.__run_replay(stop))
+            else:
+                stop_watching = await self.__watch_data_socket(loop, in_socket)
+        except Exception as e:
+            self.logger.error("Error: " + str(e))
+            return 1
+
+        if self.websocket_mode == "server":
+            try:
+                return await self.__serve_websocket_clients(stop)
+            finally:
+                if stop_watching is not None:
+                    stop_watching()
+                self.logger.debug("Frame buffer statistics: %s" % self.frame_buffer.get_stats())
+                if self.frame_sequence_tracker is not None:
+                    self.logger.debug("Frame sequence statistics: %s" % self.frame_sequence_tracker.get_stats())
+
         try:
-            # Define the data buffer
-            data=bytearray(0)
-            recv_buffer_size=64*1024 # 64k buffer size
             websocket_attempts = 0
             connection_attempts = 0
+            broadcaster = WebsocketBroadcaster(self.frame_encoder, self.binary_frame_encoder, buffer_size=CLIENT_SEND_BUFFER_SIZE, timeout=DATA_QUEUE_TIMEOUT, logger=self.logger, latency_tracer=self.latency_tracer, metrics=self.metrics, profiler=self.profiler, policy=DATA_QUEUE_POLICY)
+            self.broadcaster = broadcaster
 
             while not stop():
                 try:
@@ -1293,39 +1894,44 @@ class NatNetClient:
                         raise NetworkConnectionError("Connection to the server lost")
                     connection_attempts = 0
 
-                    # Start websocket connection
-                    async with websockets.connect(self.websocket_connection_url) as websocket:
+                    # Start websocket connection (the binary format is used only if the server selects its subprotocol)
+                    subprotocols = None
+                    if WEBSOCKET_BINARY_FORMAT:
+                        subprotocols = [BinaryFrameFormat.SUBPROTOCOL, BinaryFrameFormat.JSON_SUBPROTOCOL]
+                    extensions = None
+                    if WEBSOCKET_COMPRESSION and not await self.__is_uncompressed_peer(self.websocket_connection_url):
+                        extensions = Compression.get_client_extensions(WEBSOCKET_COMPRESSION_LEVEL, WEBSOCKET_COMPRESSION_MEMORY_LEVEL, WEBSOCKET_COMPRESSION_WINDOW_BITS)
+                    async with websockets.connect(self.websocket_connection_url, subprotocols=subprotocols, compression=None, extensions=extensions) as websocket:
                         websocket_attempts = 0
-                        while not stop():
-                            # Wait for the input from the websocket
-                            try:
-                                data, addr = in_socket.recvfrom( recv_buffer_size )
-                            except socket.error as msg:
-                                if not stop():
-                                    self.logger.error("ERROR: data socket access error occurred:\n  %s" %msg)
-                                    return 1
-                            except  socket.herror:
-                                print("ERROR: data socket access herror occurred")
-                                #return 2
-                            except  socket.gaierror:
-                                print("ERROR: data socket access gaierror occurred")
-                                #return 3
-                            except  socket.timeout:
-                                #if self.use_multicast:
-                                print("ERROR: data socket access timeout occurred. Server not responding")
-                                #return 4
-
-                            # If the data is not null send it to the websocket                
-                            if len( data ) > 0 :
-                                processed_data = self.__process_message( data )
-                                await websocket.send(json.dumps({'type': 'optitrack-data', 'data': json.dumps(processed_data)}))
-                                await asyncio.sleep(0)
-                                data = bytearray(0)
+                        if self.metrics is not None and self.metrics.websocket_connections > 0:
+                            self.metrics.websocket_reconnects += 1
+
+                        # The connection is the only subscriber of the broadcaster (rate, fields, delta mode and batching of the subscription).
+                        # The frame buffer is emptied as soon as a frame arrives: if the server is slow, the frames wait (and are
+                        # merged with keep_latest) in the queue of the subscriber
+                        subscriber = broadcaster.add_subscriber(websocket, self.websocket_subscription)
+                        sender = asyncio.ensure_future(broadcaster.send_messages(subscriber))
+                        if self.replay is not None:
+                            self.__replay_started.set()
+                        try:
+                            while not stop() and not sender.done():
+                                # Wait for the next decoded frame (the timeout allows to check the stop condition)
+                                processed_data = await self.frame_buffer.get(DATA_QUEUE_TIMEOUT)
+                                if processed_data is None:
+                                    continue
+                                broadcaster.broadcast(processed_data)
+                            if sender.done():
+                                sender.result() # Raise the exception which closed the connection
+                        finally:
+                            sender.cancel()
+                            broadcaster.remove_subscriber(subscriber)
                 except websockets.ConnectionClosedOK:
                     continue
                 except websockets.ConnectionClosedError:
                     continue
                 except websockets.InvalidStatusCode as e: # This is to handle when the server is not turned on
+                    if self.metrics is not None:
+                        self.metrics.websocket_errors += 1
                     websocket_attempts += 1
                     if websocket_attempts > MAX_ATTEMPTS_TO_CONNECT:
                         self.logger.error("Websocket connection failed. Verify that the websocket server is on.")
@@ -1334,6 +1940,8 @@ class NatNetClient:
                     await asyncio.sleep(time_to_sleep)
                     continue
                 except NetworkConnectionError as e: # This is to handle when the connection is lost
+                    if self.metrics is not None:
+                        self.metrics.websocket_errors += 1
                     connection_attempts += 1
                     if connection_attempts > MAX_ATTEMPTS_TO_CONNECT:
                         self.logger.error("Your connection has been lost for too long.")
@@ -1347,6 +1955,127 @@ class NatNetClient:
         except Exception as e:
             self.logger.error("Error: " + str(e))
             return 1
+        finally:
+            if stop_watching is not None:
+                stop_watching()
+            self.logger.debug("Frame buffer statistics: %s" % self.frame_buffer.get_stats())
+            if self.frame_sequence_tracker is not None:
+                self.logger.debug("Frame sequence statistics: %s" % self.frame_sequence_tracker.get_stats())
+
+    # Replay the capture in place of the data socket, then stop the bridge once the frames have been sent
+    async def __run_replay(self, stop):
+        # The replay starts when the frames can be sent, so the first frames are not lost
+        while not self.__replay_started.is_set():
+            if stop():
+                return
+            try:
+                await asyncio.wait_for(self.__replay_started.wait(), timeout=DATA_QUEUE_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+        replay = self.replay
+        try:
+            await replay.run(self.__on_data_packets, self.__process_message, stop)
+        except Exception as e:
+            self.logger.error("ERROR: replay stopped: " + str(e))
+        finally:
+            self.logger.debug("Replay finished (packets: %d, frames: %d, loops: %d)" % (replay.packets_replayed, replay.frames_replayed, replay.loops))
+        # The frames still waiting in the frame buffer, in the coalescers and in the queues of the connections are
+        # sent before the bridge stops
+        while len(self.frame_buffer) > 0 and not stop():
+            await asyncio.sleep(DATA_QUEUE_TIMEOUT)
+        broadcaster = self.broadcaster
+        if broadcaster is not None:
+            broadcaster.flush()
+            while broadcaster.get_pending_count() > 0 and not stop():
+                await asyncio.sleep(DATA_QUEUE_TIMEOUT)
+        self.set_shutdown()
+
+    # Write a summary of the latency in the logs every LATENCY_LOG_INTERVAL seconds
+    async def __log_latency(self, stop):
+        last_time = time.monotonic()
+        while not stop():
+            await asyncio.sleep(min(DATA_QUEUE_TIMEOUT, LATENCY_LOG_INTERVAL))
+            if time.monotonic() - last_time >= LATENCY_LOG_INTERVAL:
+                last_time = time.monotonic()
+                self.logger.info(self.latency_tracer.format_summary())
+
+    # Serve the metrics on METRICS_HOST:METRICS_PORT until the bridge stops
+    async def __serve_metrics(self, in_socket, stop):
+        metrics_server = MetricsServer(self.metrics, METRICS_HOST, METRICS_PORT, collect=lambda: self.__collect_metrics(in_socket), logger=self.logger)
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            self.logger.error("ERROR: could not start the metrics server: " + str(e))
+            return
+        try:
+            while not stop():
+                await asyncio.sleep(DATA_QUEUE_TIMEOUT)
+        finally:
+            await metrics_server.close()
+
+    # Values of the frame buffer, the frame sequence and the data socket (read when the metrics are scraped)
+    def __collect_metrics(self, in_socket):
+        frame_buffer = self.frame_buffer
+        samples = [
+            Sample("frame_buffer_frames", "gauge", "Decoded frames waiting to be sent", len(frame_buffer)),
+            Sample("frame_buffer_dropped_total", "counter", "Frames dropped by the frame buffer before being sent", frame_buffer.frames_dropped),
+            Sample("frame_buffer_conflated_total", "counter", "Frames merged with a newer frame before being sent", frame_buffer.frames_conflated)
+        ]
+        tracker = self.frame_sequence_tracker
+        if tracker is not None:
+            samples += [
+                Sample("frames_missing", "gauge", "Frames missing from the sequence of frame numbers", tracker.frames_missing),
+                Sample("frame_gaps_total", "counter", "Gaps in the sequence of frame numbers", tracker.gaps),
+                Sample("frames_reordered_total", "counter", "Frames received after a newer frame", tracker.reordered),
+                Sample("frames_duplicated_total", "counter", "Frames received more than once", tracker.duplicates),
+                Sample("frames_late_dropped_total", "counter", "Late frames dropped before being decoded", tracker.late_dropped),
+                Sample("frame_sequence_resets_total", "counter", "Restarts of the sequence of frame numbers", tracker.resets),
+                Sample("capture_rate_hz", "gauge", "Frames per second produced by Motive", tracker.capture_rate),
+                Sample("receive_rate_hz", "gauge", "Frames per second received by the bridge", tracker.receive_rate)
+            ]
+        if in_socket is not None:
+            queued_bytes, drops = get_socket_queue_stats(in_socket)
+            samples += [
+                Sample("data_socket_queued_bytes", "gauge", "Bytes waiting in the receive buffer of the data socket", queued_bytes),
+                Sample("data_socket_drops_total", "counter", "Datagrams dropped because the receive buffer of the data socket was full", drops)
+            ]
+        return samples
+
+    # Client mode: the compression is not used if the websocket server is in one of the WEBSOCKET_UNCOMPRESSED_NETWORKS
+    async def __is_uncompressed_peer(self, url):
+        try:
+            addresses = await asyncio.get_running_loop().getaddrinfo(urlsplit(url).hostname, None)
+        except OSError:
+            return False
+        return any(Compression.is_uncompressed_address(address[4][0], WEBSOCKET_UNCOMPRESSED_NETWORKS) for address in addresses)
+
+    # Server mode: broadcast every frame to all the websocket clients connected to the bridge
+    async def __serve_websocket_clients(self, stop):
+        # Each client has its own queue following DATA_QUEUE_POLICY: with keep_latest a slow client receives the latest poses
+        broadcaster = WebsocketBroadcaster(self.frame_encoder, self.binary_frame_encoder, buffer_size=CLIENT_SEND_BUFFER_SIZE, timeout=DATA_QUEUE_TIMEOUT, logger=self.logger, latency_tracer=self.latency_tracer, metrics=self.metrics, profiler=self.profiler, policy=DATA_QUEUE_POLICY)
+        self.broadcaster = broadcaster
+
+        # The compressed messages are shared by the connections (each message is compressed once)
+        extensions = None
+        create_protocol = None
+        if WEBSOCKET_COMPRESSION:
+            self.compression_cache = Compression.CompressionCache()
+            extensions = Compression.get_server_extensions(WEBSOCKET_COMPRESSION_LEVEL, WEBSOCKET_COMPRESSION_MEMORY_LEVEL, WEBSOCKET_COMPRESSION_WINDOW_BITS, self.compression_cache)
+            create_protocol = Compression.get_server_protocol(WEBSOCKET_UNCOMPRESSED_NETWORKS)
+        try:
+            async with broadcaster.serve(self.websocket_server_host, self.websocket_server_port, binary_format=WEBSOCKET_BINARY_FORMAT, extensions=extensions, create_protocol=create_protocol):
+                self.logger.debug("Websocket server listening on %s:%d" % (self.websocket_server_host, self.websocket_server_port))
+                while not stop():
+                    processed_data = await self.frame_buffer.get(DATA_QUEUE_TIMEOUT)
+                    if processed_data is None:
+                        continue
+                    broadcaster.broadcast(processed_data)
+            return 0
+        except KeyboardInterrupt:
+            return 0
+        except Exception as e:
+            self.logger.error("Error: " + str(e))
+            return 1
 
     def __process_message( self, data : bytes):
         # Get usefull informations
@@ -1360,15 +2089,36 @@ class NatNetClient:
         # Skip the 4 bytes for message ID and packet_size
         offset = 4
         if message_id == self.NAT_FRAMEOFDATA :
-            return self.__unpack_mocap_data( data[offset:], packet_size, major, minor )
+            # The frame is decoded in place from the underlying buffer (the memoryviews given by the receivers
+            # always start at the beginning of their buffer, so the offsets are the same)
+            end = len( data )
+            if isinstance( data, memoryview ):
+                data = data.obj
+            plan = self.__decode_plan
+            if self.profiler is not None and self.profiler.active:
+                plan = self.__get_profiled_plan()
+            return self.__unpack_mocap_data( data, offset, end, plan )
         elif message_id == self.NAT_MODELDEF :
+            self.__data_descriptions_packet = bytes( data )
             self.__unpack_data_descriptions( data[offset:], packet_size, major, minor)
         elif message_id == self.NAT_SERVERINFO :
+            self.__server_info_packet = bytes( data )
             self.__unpack_server_info( data[offset:], packet_size, major, minor)
         
         # By default return an empty dictionary
         return {}
 
+    def process_packet( self, data : bytes):
+        """ Decode a packet like the data thread does. Return the frame sent to the websocket ({} for the other packets) """
+        return self.__process_message( data )
+
+    def decode_packet( self, data : bytes):
+        """ Decode a packet outside of the streaming threads (e.g. read from a capture). Return the MoCapData of a frame, None for the other packets """
+        if self.get_message_id(data) != self.NAT_FRAMEOFDATA:
+            self.__process_message( data )
+            return None
+        return self.__unpack_mocap_frame( data, 4, len( data ), self.__decode_plan )
+
     def send_request( self, in_socket, command, command_str, address ):
         # Compose the message in our known message format
         packet_size = 0
@@ -1426,8 +2176,58 @@ class NatNetClient:
     def get_server_version(self):
         return self.__server_version
 
+    def get_high_res_clock_frequency(self):
+        return self.__high_res_clock_frequency
+
+    def get_latency_tracer(self):
+        return self.latency_tracer
+
+    def get_frame_sequence_tracker(self):
+        return self.frame_sequence_tracker
+
+    def get_metrics(self):
+        return self.metrics
+
+    def get_profiler(self):
+        return self.profiler
+
+    def dump_profile(self, path=None):
+        """ Write the time of the stages in the collapsed stack format (flame graph) in path (PROFILE_PATH if None) """
+        if self.profiler is None:
+            return
+        if path is None:
+            path = PROFILE_PATH
+        try:
+            self.profiler.dump_collapsed_stacks(path)
+        except OSError as e:
+            self.logger.error("ERROR: could not write the profile: " + str(e))
+            return
+        self.logger.info(self.profiler.format_summary())
+        self.logger.debug("Profile written in " + path)
+
+    # Replay a capture instead of the live stream (no socket is opened)
+    def __start_replay( self ):
+        try:
+            self.replay.open()
+        except (OSError, ValueError) as e:
+            self.logger.error("Could not open the capture: " + str(e))
+            return False
+
+        # Server info and data descriptions received when the capture was recorded
+        for data in self.replay.get_setup_packets():
+            self.__process_message( data )
+
+        self.__is_locked = True
+        self.stop_threads = False
+        self.data_thread = Thread( target = self.__data_thread_function_wrap, args = (None, lambda : self.stop_threads, ))
+        self.data_thread.start()
+        return True
+
     # Run the streaming client
     def __start( self ):
+        if self.replay is not None:
+            return self.__start_replay()
+
         # Create the data socket
         self.data_socket = self.__create_data_socket( self.data_port )
         if self.data_socket is None :
@@ -1459,6 +2259,14 @@ class NatNetClient:
 
     def start(self):
         try:
+            # Record the raw packets if requested
+            if RECORDING_PATH is not None:
+                self.start_recording(RECORDING_PATH)
+
+            # The profile can be written at any time with "kill -USR1 <pid>"
+            if self.profiler is not None and hasattr(signal, "SIGUSR1"):
+                signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump_profile())
+
             # Start up the streaming client
             is_running = self.__start()
             if not is_running:
@@ -1516,14 +2324,207 @@ class NatNetClient:
         # Update the shared variable to stop the threads
         self.stop_threads = True
         
-        # Closing sockets causes blocking recvfrom to throw an exception and break the loop
-        self.command_socket.close()
-        self.data_socket.close()
+        # Closing the command socket causes the blocking recvfrom to throw an exception and break the loop
+        if self.command_socket is not None:
+            self.command_socket.close()
 
         # Join the threads to make sure that they are closed at the end of the program
-        self.command_thread.join()
-        self.data_thread.join()
+        # (the data socket is owned by the event loop of the data thread and it's closed only once the loop is done)
+        if self.command_thread is not None:
+            self.command_thread.join()
+        if self.data_thread is not None:
+            self.data_thread.join()
+        if self.data_socket is not None:
+            self.data_socket.close()
+        if self.replay is not None:
+            self.replay.close()
+
+        # Write the packets still waiting to be recorded
+        self.stop_recording()
+
+        # Write the profile of the session
+        self.dump_profile()
 
         # Log that the shutdown is complete
         self.logger.info("Shutdown complete.")
-        
\ No newline at end of file
+        
+
+
+# Regression tests of the frame decoding
+#
+# The test frames are written field by field with struct, following the layout of each NatNet version, without
+# DecodePlan nor the FramePacker of the simulator. The decoded frames and the websocket items are those of the
+# original decoder of the bridge, except the IDs and sizes of the rigid body markers (which it stored in the wrong
+# attributes) and the valid flag of the rigid bodies (which it didn't send).
+
+TEST_VERSIONS = ((2, 5), (2, 9), (2, 11), (3, 0), (4, 1))
+TEST_RIGID_BODY_FILTER = [{"id": 100, "name": "Holder"}, {"id_range": [3, 3]}]
+
+def pack_test_rigid_body(major, minor, rigid_body_id, base):
+    packet = struct.pack('<I', rigid_body_id)
+    packet += struct.pack('<3f', base + 0.5, base + 1.25, base - 2.0)
+    packet += struct.pack('<4f', 0.0, 0.6, 0.0, 0.8)
+
+    # Marker positions, IDs and sizes (before 3.0)
+    if major < 3:
+        packet += struct.pack('<I', 2)
+        packet += struct.pack('<3f', base + 0.125, base, base) + struct.pack('<3f', base, base + 0.25, base)
+        if major >= 2:
+            packet += struct.pack('<II', 1, 2)
+            packet += struct.pack('<ff', 0.015, 0.0125)
+    if major >= 2:
+        packet += struct.pack('<f', 0.0005)
+
+    # Tracking valid flag (2.6 and later)
+    if ( major == 2 and minor >= 6 ) or major > 2:
+        packet += struct.pack('<h', 0 if rigid_body_id == 3 else 1)
+    return packet
+
+def generate_test_frame_packet(major, minor, frame_number=1234):
+    """ NAT_FRAMEOFDATA packet with every section of the frame in the layout of the NatNet version """
+    packet = struct.pack('<I', frame_number)
+
+    # Marker sets: model name, marker count and positions, then the unlabeled markers
+    packet += struct.pack('<I', 2)
+    for model_name, marker_count in ((b'Holder', 3), (b'all', 2)):
+        packet += model_name + b'\0' + struct.pack('<I', marker_count)
+        for i in range(marker_count):
+            packet += struct.pack('<3f', i + 0.5, -i - 0.25, 2.0)
+    packet += struct.pack('<I', 1) + struct.pack('<3f', 9.0, 8.0, 7.0)
+
+    # Rigid bodies
+    packet += struct.pack('<I', 3)
+    for rigid_body_id, base in ((100, 1.0), (2, 3.0), (3, -1.0)):
+        packet += pack_test_rigid_body(major, minor, rigid_body_id, base)
+
+    # Skeletons (2.1 and later): ID and rigid bodies of each skeleton
+    if ( major == 2 and minor > 0 ) or major > 2:
+        packet += struct.pack('<III', 1, 1, 2)
+        for rigid_body_id, base in (((1 << 16) | 1, 5.0), ((1 << 16) | 2, 6.0)):
+            packet += pack_test_rigid_body(major, minor, rigid_body_id, base)
+
+    # Labeled markers (2.4 and later): ID, position, size, param (2.6 and later) and residual (3.0 and later)
+    if ( major == 2 and minor > 3 ) or major > 2:
+        packet += struct.pack('<I', 2)
+        for marker_id, base in (((100 << 16) | 1, 1.0), ((7 << 16) | 3, 4.0)):
+            packet += struct.pack('<I3ff', marker_id, base, base + 0.5, base + 1.0, 0.014)
+            if ( major == 2 and minor >= 6 ) or major > 2:
+                packet += struct.pack('<h', 0x04)
+            if major >= 3:
+                packet += struct.pack('<f', 0.0002)
+
+    # Force plates (2.9 and later): ID and frames of each channel
+    if ( major == 2 and minor >= 9 ) or major > 2:
+        packet += struct.pack('<I', 1) + struct.pack('<II', 11, 2)
+        for channel in range(2):
+            packet += struct.pack('<I', 2) + struct.pack('<2f', channel + 0.5, channel + 1.5)
+
+    # Devices (2.11 and later): ID and frames of each channel
+    if ( major == 2 and minor >= 11 ) or major > 2:
+        packet += struct.pack('<I', 1) + struct.pack('<II', 21, 2)
+        for channel in range(2):
+            packet += struct.pack('<I', 1) + struct.pack('<f', channel - 0.5)
+
+    # Suffix: timecode, timestamp (double in 2.7 and later), high resolution timestamps (3.0 and later) and params
+    packet += struct.pack('<II', 0x01020304, 5)
+    if ( major == 2 and minor >= 7 ) or major > 2:
+        packet += struct.pack('<d', 10.28125)
+    else:
+        packet += struct.pack('<f', 10.28125)
+    if major >= 3:
+        packet += struct.pack('<QQQ', 1000000, 1000500, 1001000)
+    packet += struct.pack('<h', 0x03)
+    return struct.pack('<HH', NatNetClient.NAT_FRAMEOFDATA, len(packet)) + packet
+
+def generate_test_server_info_packet(major, minor):
+    """ NAT_SERVERINFO packet of Motive 3.1 streaming the NatNet version """
+    packet = b'Motive'.ljust(256, b'\0') + bytes((3, 1, 0, 0)) + bytes((major, minor, 0, 0))
+    return struct.pack('<HH', NatNetClient.NAT_SERVERINFO, len(packet)) + packet
+
+def create_test_client(major, minor, rigid_body_filter=None, selective=False, decode_mode="objects"):
+    """ Offline client configured by a server info packet, decoding the whole frame unless selective """
+    client = NatNetClient(verify_connection=False, log_path=None)
+    client.set_decode_mode(decode_mode, compile_plan=False)
+    client.set_rigid_body_filter(rigid_body_filter)
+    if rigid_body_filter is not None and selective:
+        client.set_decode_selection(DecodeSelection(
+            sections = ("marker_sets", "rigid_bodies"),
+            marker_set_names = client.rigid_body_filter.name_lookup,
+            rigid_body_ids = client.rigid_body_filter.id_lookup))
+    else:
+        client.set_decode_selection(None)
+    client.process_packet(generate_test_server_info_packet(major, minor))
+    return client
+
+def get_test_items_as_string(processed_data):
+    """ Frame number, timestamp and websocket items of a processed frame as a string (numpy values as Python values) """
+    items = [{key: value.item() if hasattr(value, "item") else value for key, value in item.items()} for item in processed_data["mocap_data"]]
+    return json.dumps([processed_data["frame_number"], processed_data["timestamp"], items], sort_keys=True)
+
+def decode_test_recording(client, packet):
+    """ Record packet with client (already configured), then decode the capture with a new client configured by its setup packets """
+    with tempfile.TemporaryDirectory() as directory:
+        client.start_recording(os.path.join(directory, "session"))
+        client.packet_recorder.record(packet)
+        capture_path = client.packet_recorder.capture_path
+        client.stop_recording()
+
+        replay = PacketReplay(capture_path)
+        replay.open()
+        try:
+            replay_client = NatNetClient(verify_connection=False, log_path=None)
+            replay_client.set_rigid_body_filter(None)
+            replay_client.set_decode_selection(None)
+            for data in replay.get_setup_packets():
+                replay_client.process_packet(bytes(data))
+            record, offset = replay.reader.read_record(replay.reader.get_frame_offset(0))
+            return replay_client.decode_packet(bytes(record.data))
+        finally:
+            replay.close()
+
+def test_all(run_test=True):
+    totals=[0,0,0]
+    if run_test is True:
+        # [version, hash of the packet, hash of the decoded frame, hash of the websocket items]
+        test_cases=[[(2, 5),  "eab7833c00fd673a8f557e30cb047f69d5201210", "066a356f972761e1a75c17ddf67e59bbaf28f8d1", "142e65247b5aa2e65be4eb0e8bc9c9f293086489"],
+                    [(2, 9),  "fc6bf5539853ee563049af51215af480be203dd9", "050470b0fbb34c5695db742b26c935ba4b81b533", "c52ef5cdbe268222fa92960ced7ab07d3bcd74e7"],
+                    [(2, 11), "9263f7455114a476991a525b4910e47cffc2ac3a", "18012047579b7c616a97b962bb7278c54b9245ea", "c52ef5cdbe268222fa92960ced7ab07d3bcd74e7"],
+                    [(3, 0),  "63f62b2671e2f39172164b9007e03dc3071da49e", "d4be18142b79c448d88e217508f9eda255107c4e", "c52ef5cdbe268222fa92960ced7ab07d3bcd74e7"],
+                    [(4, 1),  "63f62b2671e2f39172164b9007e03dc3071da49e", "d4be18142b79c448d88e217508f9eda255107c4e", "c52ef5cdbe268222fa92960ced7ab07d3bcd74e7"]
+                    ]
+        for (major, minor), packet_hash, frame_hash, items_hash in test_cases:
+            version_str = "%d.%d"%(major, minor)
+            packet = generate_test_frame_packet(major, minor)
+            totals = MoCapData.add_lists(totals, MoCapData.test_value("Test Frame Packet " + version_str, packet_hash, hashlib.sha1(packet).hexdigest()))
+
+            # Whole frame
+            client = create_test_client(major, minor)
+            totals = MoCapData.add_lists(totals, MoCapData.test_value("Test Version " + version_str, (major, minor), (client.get_major(), client.get_minor())))
+            totals = MoCapData.add_lists(totals, MoCapData.test_hash2("Test Decoded Frame " + version_str, frame_hash, client.decode_packet(packet)))
+
+            # Websocket items, with the whole frame decoded and with only the filtered models decoded
+            items_str = get_test_items_as_string(create_test_client(major, minor, TEST_RIGID_BODY_FILTER).process_packet(packet))
+            totals = MoCapData.add_lists(totals, MoCapData.test_value("Test Websocket Items " + version_str, items_hash, hashlib.sha1(items_str.encode()).hexdigest()))
+            selective_items_str = get_test_items_as_string(create_test_client(major, minor, TEST_RIGID_BODY_FILTER, selective=True).process_packet(packet))
+            totals = MoCapData.add_lists(totals, MoCapData.test_value("Test Selective Decoding " + version_str, items_str, selective_items_str))
+
+            # Column arrays (3.0 and later, requires numpy)
+            run_numpy_test = ColumnarData.is_available() and major >= 3
+            numpy_items_str = None
+            if run_numpy_test:
+                numpy_items_str = get_test_items_as_string(create_test_client(major, minor, TEST_RIGID_BODY_FILTER, selective=True, decode_mode="numpy").process_packet(packet))
+            totals = MoCapData.add_lists(totals, MoCapData.test_value("Test Numpy Decoding " + version_str, items_str, numpy_items_str, run_numpy_test))
+
+            # Recording started after the connection: the capture begins with the server info packet, so the
+            # frames are decoded with the version of the session when the capture is replayed
+            totals = MoCapData.add_lists(totals, MoCapData.test_hash2("Test Recording After Connect " + version_str, frame_hash, decode_test_recording(client, packet)))
+
+    print("--------------------")
+    print("[PASS] Count = %3.1d"%totals[0])
+    print("[FAIL] Count = %3.1d"%totals[1])
+    print("[SKIP] Count = %3.1d"%totals[2])
+
+    return totals
+
+if __name__ == "__main__":
+    test_all(True)
@@ -0,0 +1,429 @@
+# NatNet server simulator (stand-in for Motive for the load tests)
+#
+# The simulator answers the commands of the clients like Motive does:
+#   NAT_CONNECT              NAT_SERVERINFO (application name, server version and NatNet version)
+#   NAT_REQUEST_MODELDEF     NAT_MODELDEF (marker sets and rigid bodies)
+#   NAT_REQUEST_FRAMEOFDATA  the last frame sent
+#   NAT_REQUEST              NAT_RESPONSE (every command succeeds)
+# and sends NAT_FRAMEOFDATA packets at a fixed rate to the multicast group (multicast mode) or to the
+# clients which connected and to the data addresses given (unicast mode).
+# The frames are made with the MoCapData/DataDescriptions generate_* functions: the number of rigid bodies,
+# of markers for each rigid body and the NatNet version of the packets can be chosen. The rigid bodies move
+# along circles. The frames of one period of the motion are packed when the simulator starts, so sending a
+# frame only writes its frame number and its timestamps: the simulator keeps up with 1000 Hz and hundreds of
+# rigid bodies on a laptop (the frames must fit in a UDP packet: about 500 rigid bodies with 3 markers each).
+#
+# Usage: python -m modules.NatNetServer --rate 1000 --rigid-bodies 300 --multicast
+
+import argparse
+import math
+import socket
+import struct
+import time
+from threading import Thread
+
+import modules.DataDescriptions as DataDescriptions
+import modules.MoCapData as MoCapData
+from modules.NatNetClient import DecodePlan, NatNetClient
+
+MAX_PACKET_SIZE = 65507 # Largest UDP payload
+PacketHeader = struct.Struct('<HH')
+Vector3 = struct.Struct('<fff')
+NNIntValue = struct.Struct('<I')
+NNIntPair = struct.Struct('<II')
+
+def pack_string(value):
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return value + b'\0'
+
+def pack_packet(message_id, payload):
+    if len(payload) + PacketHeader.size > MAX_PACKET_SIZE:
+        raise ValueError("Packet too large (%d bytes): reduce the number of rigid bodies or markers" % len(payload))
+    return PacketHeader.pack(message_id, len(payload) & 0xffff) + payload
+
+def pack_server_info(application_name, server_version, nat_net_version, clock_frequency, data_port, multicast_address):
+    """ NAT_SERVERINFO packet (multicast_address is None in unicast mode) """
+    payload = bytearray(pack_string(application_name).ljust(256, b'\0')[:256])
+    payload += bytes(server_version) + bytes(nat_net_version)
+    payload += struct.pack('<QH?', clock_frequency, data_port, multicast_address is not None)
+    payload += socket.inet_aton(multicast_address or "0.0.0.0")
+    return pack_packet(NatNetClient.NAT_SERVERINFO, bytes(payload))
+
+class FramePacker:
+    """ Pack MoCapData frames in the layout of a NatNet version (the inverse of the NatNetClient decoding) """
+    def __init__(self, major, minor, max_packet_size=MAX_PACKET_SIZE):
+        self.plan = DecodePlan(major, minor)
+        self.max_packet_size = max_packet_size # None for the frames which are not sent over UDP (e.g. benchmarks)
+
+        # Offsets (in the packet) of the fields updated for each frame, set by pack
+        self.frame_number_offset = PacketHeader.size
+        self.rigid_body_offsets = []
+        self.frame_suffix_offset = None
+
+    def __pack_rigid_body(self, rigid_body, packet):
+        plan = self.plan
+        params = 0x01 if rigid_body.tracking_valid else 0x00
+        tail = ( rigid_body.error, params )[:2 - len(plan.rigid_body_padding)] # Error and params are missing in the older versions
+        self.rigid_body_offsets.append(len(packet))
+        if not plan.rigid_body_has_markers:
+            packet += plan.rigid_body_record.pack(rigid_body.id_num, *rigid_body.pos, *rigid_body.rot, *tail)
+            return
+        packet += plan.rigid_body_head.pack(rigid_body.id_num, *rigid_body.pos, *rigid_body.rot)
+        markers = rigid_body.rb_marker_list
+        packet += NNIntValue.pack(len(markers))
+        for marker in markers:
+            packet += Vector3.pack(*marker.pos)
+        if plan.rigid_body_has_marker_ids:
+            packet += struct.pack('<%dI' % len(markers), *[marker.id_num for marker in markers])
+            packet += struct.pack('<%df' % len(markers), *[marker.size for marker in markers])
+        packet += plan.rigid_body_tail.pack(*tail)
+
+    def pack(self, mocap_data):
+        """ Return the NAT_FRAMEOFDATA packet of the frame (bytearray) """
+        plan = self.plan
+        self.rigid_body_offsets = []
+        packet = bytearray(PacketHeader.size)
+        packet += NNIntValue.pack(mocap_data.prefix_data.frame_number)
+
+        # Marker sets and unlabeled markers
+        marker_data_list = mocap_data.marker_set_data.marker_data_list
+        packet += NNIntValue.pack(len(marker_data_list))
+        for marker_data in marker_data_list:
+            packet += pack_string(marker_data.model_name)
+            packet += NNIntValue.pack(len(marker_data.marker_pos_list))
+            for pos in marker_data.marker_pos_list:
+                packet += Vector3.pack(*pos)
+        unlabeled_markers = mocap_data.marker_set_data.unlabeled_markers.marker_pos_list
+        packet += NNIntValue.pack(len(unlabeled_markers))
+        for pos in unlabeled_markers:
+            packet += Vector3.pack(*pos)
+
+        # Rigid bodies
+        rigid_bodies = mocap_data.rigid_body_data.rigid_body_list
+        packet += NNIntValue.pack(len(rigid_bodies))
+        for rigid_body in rigid_bodies:
+            self.__pack_rigid_body(rigid_body, packet)
+        rigid_body_offsets = self.rigid_body_offsets
+
+        # Skeletons (their rigid bodies are not moved by the simulator)
+        if plan.has_skeletons:
+            skeletons = mocap_data.skeleton_data.skeleton_list
+            packet += NNIntValue.pack(len(skeletons))
+            for skeleton in skeletons:
+                packet += NNIntPair.pack(skeleton.id_num, len(skeleton.rigid_body_list))
+                for rigid_body in skeleton.rigid_body_list:
+                    self.__pack_rigid_body(rigid_body, packet)
+        self.rigid_body_offsets = rigid_body_offsets[:len(rigid_bodies)]
+
+        # Labeled markers
+        if plan.has_labeled_markers:
+            labeled_markers = mocap_data.labeled_marker_data.labeled_marker_list
+            record = plan.labeled_marker_record
+            value_count = 7 - len(plan.labeled_marker_padding) # Param and residual are missing in the older versions
+            packet += NNIntValue.pack(len(labeled_markers))
+            for labeled_marker in labeled_markers:
+                values = ( labeled_marker.id_num, *labeled_marker.pos, labeled_marker.size, labeled_marker.param, labeled_marker.residual )
+                packet += record.pack(*values[:value_count])
+
+        # Force plates and devices
+        for has_section, items in ((plan.has_force_plates, mocap_data.force_plate_data.force_plate_list),
+                                   (plan.has_devices, mocap_data.device_data.device_list)):
+            if not has_section:
+                continue
+            packet += NNIntValue.pack(len(items))
+            for item in items:
+                packet += NNIntPair.pack(item.id_num, len(item.channel_data_list))
+                for channel_data in item.channel_data_list:
+                    packet += NNIntValue.pack(len(channel_data.frame_list))
+                    packet += struct.pack('<%df' % len(channel_data.frame_list), *channel_data.frame_list)
+
+        # Frame suffix
+        self.frame_suffix_offset = len(packet)
+        suffix_data = mocap_data.suffix_data
+        packet += plan.frame_suffix_record.pack(*[getattr(suffix_data, name) for name in plan.frame_suffix_fields])
+
+        if self.max_packet_size is not None and len(packet) > self.max_packet_size:
+            raise ValueError("Frame too large (%d bytes): reduce the number of rigid bodies or markers" % len(packet))
+        PacketHeader.pack_into(packet, 0, NatNetClient.NAT_FRAMEOFDATA, (len(packet) - PacketHeader.size) & 0xffff)
+        return packet
+
+    def pack_data_descriptions(self, data_descriptions):
+        """ Return the NAT_MODELDEF packet of the marker set and rigid body descriptions """
+        major = self.plan.major
+        payload = bytearray()
+        descriptions = [(0, description) for description in data_descriptions.marker_set_list]
+        descriptions += [(1, description) for description in data_descriptions.rigid_body_list]
+        payload += NNIntValue.pack(len(descriptions))
+        for data_type, description in descriptions:
+            payload += NNIntValue.pack(data_type)
+            if data_type == 0:
+                payload += pack_string(description.marker_set_name)
+                payload += NNIntValue.pack(len(description.marker_names_list))
+                for marker_name in description.marker_names_list:
+                    payload += pack_string(marker_name)
+                continue
+            if major >= 2:
+                payload += pack_string(description.sz_name)
+            payload += struct.pack('<Ii3f', description.id_num, description.parent_id, *description.pos)
+            if major >= 3:
+                markers = description.rb_marker_list
+                payload += NNIntValue.pack(len(markers))
+                for marker in markers:
+                    payload += Vector3.pack(*marker.pos)
+                for marker in markers:
+                    payload += NNIntValue.pack(marker.active_label)
+                if major >= 4:
+                    for marker in markers:
+                        payload += pack_string(marker.marker_name)
+        return pack_packet(NatNetClient.NAT_MODELDEF, bytes(payload))
+
+class FrameGenerator:
+    """ Frames of rigid_body_count rigid bodies with markers_per_rigid_body markers each (labeled and in the marker sets) """
+    def __init__(self, major=4, minor=1, rate=240, rigid_body_count=10, markers_per_rigid_body=3, first_rigid_body_id=1, period=1.0, label_base="RigidBody"):
+        self.rate = rate
+        self.rigid_body_count = rigid_body_count
+        self.markers_per_rigid_body = markers_per_rigid_body
+        self.first_rigid_body_id = first_rigid_body_id
+        self.label_base = label_base
+        self.packer = FramePacker(major, minor)
+
+        # The frame is packed once, then the poses of the rigid bodies are written for each frame of one period of the motion
+        mocap_data = self.__generate_frame()
+        packet = self.packer.pack(mocap_data)
+        self.frame_number_offset = self.packer.frame_number_offset
+        self.frame_suffix_offset = self.packer.frame_suffix_offset
+        self.frame_count = max(1, int(round(period * rate)))
+        self.packets = []
+        head = self.packer.plan.rigid_body_head
+        rigid_bodies = list(zip(mocap_data.rigid_body_data.rigid_body_list, self.packer.rigid_body_offsets))
+        for frame_num in range(self.frame_count):
+            frame_packet = bytearray(packet)
+            angle = 2 * math.pi * frame_num / self.frame_count
+            for rigid_body, offset in rigid_bodies:
+                # Each rigid body turns around its initial position (with a different phase) and around the vertical axis
+                phase = angle + rigid_body.id_num
+                x, y, z = rigid_body.pos
+                head.pack_into(frame_packet, offset, rigid_body.id_num, x + math.cos(phase), y, z + math.sin(phase), 0.0, math.sin(phase / 2), 0.0, math.cos(phase / 2))
+            self.packets.append(frame_packet)
+
+    def get_rigid_body_ids(self):
+        return list(range(self.first_rigid_body_id, self.first_rigid_body_id + self.rigid_body_count))
+
+    def __generate_frame(self):
+        mocap_data = MoCapData.MoCapData()
+        mocap_data.set_prefix_data(MoCapData.generate_prefix_data(0))
+
+        # The objects are added directly to the lists (the add_* functions would deep copy them)
+        marker_set_data = MoCapData.MarkerSetData()
+        rigid_body_data = MoCapData.RigidBodyData()
+        labeled_marker_data = MoCapData.LabeledMarkerData()
+        for rigid_body_id in self.get_rigid_body_ids():
+            marker_set_data.marker_data_list.append(MoCapData.generate_marker_data(self.label_base, rigid_body_id, self.markers_per_rigid_body))
+
+            rigid_body = MoCapData.generate_rigid_body(rigid_body_id, 0)
+            rigid_body.tracking_valid = True
+            rigid_body_data.rigid_body_list.append(rigid_body)
+
+            for marker_num in range(self.markers_per_rigid_body):
+                labeled_marker = MoCapData.generate_labeled_marker(0, marker_num)
+                labeled_marker.id_num = ( rigid_body_id << 16 ) | ( marker_num + 1 )
+                labeled_marker_data.labeled_marker_list.append(labeled_marker)
+
+        mocap_data.set_marker_set_data(marker_set_data)
+        mocap_data.set_rigid_body_data(rigid_body_data)
+        mocap_data.set_skeleton_data(MoCapData.SkeletonData())
+        mocap_data.set_labeled_marker_data(labeled_marker_data)
+        mocap_data.set_force_plate_data(MoCapData.ForcePlateData())
+        mocap_data.set_device_data(MoCapData.DeviceData())
+        mocap_data.set_suffix_data(MoCapData.generate_suffix_data(0))
+        return mocap_data
+
+    def generate_data_descriptions(self):
+        data_descriptions = DataDescriptions.DataDescriptions()
+        for rigid_body_id in self.get_rigid_body_ids():
+            name = MoCapData.generate_label(self.label_base, rigid_body_id)
+            marker_set_description = DataDescriptions.generate_marker_set_description(rigid_body_id)
+            marker_set_description.set_name(name)
+            data_descriptions.add_data(marker_set_description)
+            rigid_body_description = DataDescriptions.generate_rigid_body_description(rigid_body_id)
+            rigid_body_description.set_name(name)
+            rigid_body_description.set_id(rigid_body_id)
+            rigid_body_description.set_parent_id(-1)
+            data_descriptions.add_data(rigid_body_description)
+        return data_descriptions
+
+    def get_frame(self, frame_number, timestamp, stamp):
+        """ Return the packet of the frame (it's reused: it must be sent before the next call) """
+        packet = self.packets[frame_number % self.frame_count]
+        NNIntValue.pack_into(packet, self.frame_number_offset, frame_number)
+        plan = self.packer.plan
+        values = dict(timecode=0, timecode_sub=0, timestamp=timestamp, stamp_camera_mid_exposure=stamp, stamp_data_received=stamp, stamp_transmit=stamp, param=0)
+        plan.frame_suffix_record.pack_into(packet, self.frame_suffix_offset, *[values[name] for name in plan.frame_suffix_fields])
+        return packet
+
+class NatNetServer:
+    def __init__(self, frame_generator, host="127.0.0.1", command_port=1510, data_port=1511, multicast_address="239.255.42.99", use_multicast=True, data_addresses=None, send_to_clients=True, application_name="NatNetServer", server_version=(3, 1, 0, 0), logger=None):
+        self.frame_generator = frame_generator
+        self.host = host
+        self.command_port = command_port
+        self.data_port = data_port
+        self.multicast_address = multicast_address
+        self.use_multicast = use_multicast
+        self.application_name = application_name
+        self.server_version = server_version
+        self.logger = logger
+        self.nat_net_version = (frame_generator.packer.plan.major, frame_generator.packer.plan.minor, 0, 0)
+
+        # Unicast destinations of the frames: the clients which connected (unless send_to_clients is False) and the addresses given
+        self.clients = set()
+        self.data_addresses = set(data_addresses or [])
+        self.send_to_clients = send_to_clients
+
+        self.command_socket = None
+        self.data_socket = None
+        self.__threads = []
+        self.__stop = False
+        self.__last_frame = None
+
+        # Time (time.perf_counter) of the first frame: the timestamp of a frame is the time at which it was sent since start_time
+        self.start_time = None
+
+        # Statistics
+        self.frames_sent = 0
+        self.frames_late = 0 # Frames sent after their time (the sender is not able to keep up with the rate)
+        self.send_errors = 0
+
+    def __log(self, message):
+        if self.logger is not None:
+            self.logger.debug(message)
+
+    def start(self):
+        self.command_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.command_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.command_socket.bind((self.host, self.command_port))
+        self.command_socket.settimeout(0.5)
+
+        self.data_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.use_multicast:
+            self.data_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+            self.data_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            self.data_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.host))
+
+        self.__stop = False
+        self.__threads = [Thread(target=self.__command_thread_function, name="NatNetServerCommands"),
+                          Thread(target=self.__data_thread_function, name="NatNetServerData")]
+        for thread in self.__threads:
+            thread.start()
+        self.__log("NatNet server simulator on %s:%d (%s, %d Hz, %d rigid bodies)" % (self.host, self.command_port, "multicast" if self.use_multicast else "unicast", self.frame_generator.rate, self.frame_generator.rigid_body_count))
+
+    def stop(self):
+        self.__stop = True
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+        self.command_socket.close()
+        self.data_socket.close()
+
+    def __send_command_response(self, message_id, data, address):
+        if message_id == NatNetClient.NAT_CONNECT:
+            self.clients.add(address)
+            multicast_address = self.multicast_address if self.use_multicast else None
+            self.command_socket.sendto(pack_server_info(self.application_name, self.server_version, self.nat_net_version, 1000000000, self.data_port, multicast_address), address)
+        elif message_id == NatNetClient.NAT_REQUEST_MODELDEF:
+            self.command_socket.sendto(self.frame_generator.packer.pack_data_descriptions(self.frame_generator.generate_data_descriptions()), address)
+        elif message_id == NatNetClient.NAT_REQUEST_FRAMEOFDATA:
+            if self.__last_frame is not None:
+                self.command_socket.sendto(self.__last_frame, address)
+        elif message_id == NatNetClient.NAT_REQUEST:
+            self.command_socket.sendto(pack_packet(NatNetClient.NAT_RESPONSE, NNIntValue.pack(0)), address)
+        elif message_id == NatNetClient.NAT_DISCONNECT:
+            self.clients.discard(address)
+        elif message_id == NatNetClient.NAT_KEEPALIVE:
+            self.clients.add(address)
+
+    def __command_thread_function(self):
+        while not self.__stop:
+            try:
+                data, address = self.command_socket.recvfrom(64*1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if len(data) < PacketHeader.size:
+                continue
+            message_id, packet_size = PacketHeader.unpack_from(data)
+            try:
+                self.__send_command_response(message_id, data, address)
+            except OSError as e:
+                self.__log("Could not answer %s: %s" % (str(address), str(e)))
+
+    def __get_destinations(self):
+        if self.use_multicast:
+            return [(self.multicast_address, self.data_port)]
+        if not self.send_to_clients:
+            return list(self.data_addresses)
+        return list(self.clients | self.data_addresses)
+
+    def __data_thread_function(self):
+        period = 1.0 / self.frame_generator.rate
+        start_time = time.perf_counter()
+        self.start_time = start_time
+        next_time = start_time
+        frame_number = 0
+        while not self.__stop:
+            now = time.perf_counter()
+            packet = self.frame_generator.get_frame(frame_number, now - start_time, time.perf_counter_ns())
+            for destination in self.__get_destinations():
+                try:
+                    self.data_socket.sendto(packet, destination)
+                except OSError:
+                    self.send_errors += 1
+            self.__last_frame = bytes(packet)
+            self.frames_sent += 1
+            frame_number += 1
+
+            # The frames are sent on a fixed schedule. If the sender is late the schedule restarts from now (no burst)
+            next_time += period
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -period:
+                self.frames_late += 1
+                next_time = time.perf_counter()
+
+def main():
+    parser = argparse.ArgumentParser(description="NatNet server simulator")
+    parser.add_argument("--host", default="127.0.0.1", help="address of the command socket and interface of the multicast")
+    parser.add_argument("--command-port", type=int, default=1510)
+    parser.add_argument("--data-port", type=int, default=1511)
+    parser.add_argument("--multicast", action="store_true", help="send the frames to the multicast group (unicast otherwise)")
+    parser.add_argument("--multicast-address", default="239.255.42.99")
+    parser.add_argument("--data-address", action="append", default=[], help="host:port which receives the frames in unicast mode (can be repeated)")
+    parser.add_argument("--rate", type=float, default=240, help="frames per second")
+    parser.add_argument("--rigid-bodies", type=int, default=10)
+    parser.add_argument("--markers", type=int, default=3, help="markers for each rigid body")
+    parser.add_argument("--first-id", type=int, default=1, help="id of the first rigid body")
+    parser.add_argument("--version", default="4.1", help="NatNet version of the packets (major.minor)")
+    args = parser.parse_args()
+
+    major, minor = [int(value) for value in args.version.split(".")]
+    data_addresses = []
+    for data_address in args.data_address:
+        host, port = data_address.rsplit(":", 1)
+        data_addresses.append((host, int(port)))
+    frame_generator = FrameGenerator(major, minor, rate=args.rate, rigid_body_count=args.rigid_bodies, markers_per_rigid_body=args.markers, first_rigid_body_id=args.first_id)
+    server = NatNetServer(frame_generator, host=args.host, command_port=args.command_port, data_port=args.data_port, multicast_address=args.multicast_address, use_multicast=args.multicast, data_addresses=data_addresses)
+    server.start()
+    print("NatNet server simulator running (%d bytes per frame). Press Ctrl+C to stop." % len(frame_generator.packets[0]))
+    try:
+        while True:
+            time.sleep(1.0)
+            print("Frames sent: %d, late: %d, clients: %d" % (server.frames_sent, server.frames_late, len(server.clients)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+# Capture files of the raw NatNet packets
+#
+# A capture is made of two append-only files:
+#   <name>.nncap   the packets received on the data and command sockets, each one preceded by a record header
+#   <name>.nnidx   the index of the frames (NAT_FRAMEOFDATA packets): frame number, receive time and file offset
+#
+# Capture file: FILE_HEADER (magic and version) followed by the records
+#   receive_time      uint64   monotonic time of reception (nanoseconds)
+#   message_id        uint16   NatNet message id
+#   source            uint8    SOURCE_DATA or SOURCE_COMMAND
+#   reserved          uint8
+#   frame_number      uint32   frame number of the NAT_FRAMEOFDATA packets (NO_FRAME_NUMBER otherwise)
+#   size              uint32   size of the packet
+#   packet            size bytes
+# Index file: INDEX_HEADER followed by one fixed size entry for each frame
+#   frame_number      uint32
+#   receive_time      uint64
+#   offset            uint64   offset of the record in the capture file
+#
+# The packets are written by PacketRecorder in a separate thread (the receiving threads only copy the packet
+# and put it in a queue) so the recording doesn't add latency to the live stream. The queue is bounded: if the
+# disk can't keep up the packets which don't fit are dropped (and counted), and if the writer fails the
+# recording stops.
+# A recording never continues an existing capture (the receive times and frame numbers of a new session would
+# break the order the searches in the index rely on): the packets go to the first free name among <name>,
+# <name>-1, <name>-2, ...
+
+import mmap
+import os
+import queue
+import struct
+import tempfile
+import time
+from threading import Thread
+
+import modules.MoCapData as MoCapData
+
+CAPTURE_EXTENSION = ".nncap"
+INDEX_EXTENSION = ".nnidx"
+FILE_HEADER = b"NNCAP\x00\x01\x00"
+INDEX_HEADER = b"NNIDX\x00\x01\x00"
+
+SOURCE_DATA = 0
+SOURCE_COMMAND = 1
+NO_FRAME_NUMBER = 0xffffffff
+NAT_FRAMEOFDATA = 7
+
+RecordHeader = struct.Struct('<QHBBII')
+IndexEntry = struct.Struct('<IQQ')
+
+def get_capture_paths(path):
+    """ Return the paths of the capture file and of the index file (path can have the capture extension or not) """
+    if path.endswith(CAPTURE_EXTENSION):
+        path = path[:-len(CAPTURE_EXTENSION)]
+    return path + CAPTURE_EXTENSION, path + INDEX_EXTENSION
+
+class PacketRecorder:
+    def __init__(self, path, buffer_size=1024*1024, max_queued_packets=8192, logger=None):
+        self.capture_path, self.index_path = get_capture_paths(path)
+        self.buffer_size = buffer_size
+        self.logger = logger
+        self.__queue = queue.Queue(maxsize=max_queued_packets)
+        self.__thread = None
+
+        # True once the writer thread stopped on an error (the packets are not queued anymore)
+        self.failed = False
+
+        # Statistics
+        self.packets_recorded = 0
+        self.bytes_recorded = 0
+        self.packets_dropped = 0    # Packets not recorded because the queue was full or the writer failed
+
+    def start(self):
+        base_path = self.capture_path[:-len(CAPTURE_EXTENSION)]
+        suffix = 0
+        while True:
+            capture_path, index_path = get_capture_paths(base_path if suffix == 0 else "%s-%d" % (base_path, suffix))
+            if not os.path.exists(capture_path) and not os.path.exists(index_path):
+                break
+            suffix += 1
+        self.capture_path, self.index_path = capture_path, index_path
+        self.__capture_file = open(capture_path, "xb", buffering=self.buffer_size)
+        self.__index_file = open(index_path, "xb", buffering=self.buffer_size)
+        self.__capture_file.write(FILE_HEADER)
+        self.__index_file.write(INDEX_HEADER)
+        self.__offset = len(FILE_HEADER)
+        self.__thread = Thread(target=self.__writer_thread_function, name="PacketRecorder")
+        self.__thread.start()
+
+    def stop(self):
+        """ Write the packets still in the queue and close the files """
+        if self.__thread is None:
+            return
+        if not self.failed:
+            self.__queue.put(None)
+        self.__thread.join()
+        self.__thread = None
+
+    def is_recording(self):
+        return self.__thread is not None and not self.failed
+
+    def record(self, data, source=SOURCE_DATA):
+        """ Queue a packet for the writer thread (the packet is copied, the receive buffers are reused). Never waits """
+        if self.failed:
+            self.packets_dropped += 1
+            return
+        try:
+            self.__queue.put_nowait((time.monotonic_ns(), source, bytes(data)))
+        except queue.Full:
+            self.packets_dropped += 1
+
+    def __writer_thread_function(self):
+        capture_file = self.__capture_file
+        index_file = self.__index_file
+        get = self.__queue.get
+        try:
+            while True:
+                item = get()
+                if item is None:
+                    break
+                receive_time, source, data = item
+                message_id = int.from_bytes(data[0:2], byteorder='little') if len(data) >= 2 else 0
+                frame_number = NO_FRAME_NUMBER
+                if message_id == NAT_FRAMEOFDATA and len(data) >= 8:
+                    frame_number = int.from_bytes(data[4:8], byteorder='little')
+                    index_file.write(IndexEntry.pack(frame_number, receive_time, self.__offset))
+                capture_file.write(RecordHeader.pack(receive_time, message_id, source, 0, frame_number, len(data)))
+                capture_file.write(data)
+                self.__offset += RecordHeader.size + len(data)
+                self.packets_recorded += 1
+                self.bytes_recorded += len(data)
+        except Exception as e:
+            # The packets are not queued anymore: the packet being written and the ones waiting are lost
+            self.failed = True
+            self.packets_dropped += 1
+            if self.logger is not None:
+                self.logger.error("ERROR: packet recorder stopped: " + str(e))
+            try:
+                while True:
+                    if self.__queue.get_nowait() is not None:
+                        self.packets_dropped += 1
+            except queue.Empty:
+                pass
+        finally:
+            for recorded_file in (capture_file, index_file):
+                try:
+                    recorded_file.close()
+                except OSError:
+                    pass
+
+def rebuild_index(path):
+    """ Write the index of a capture (e.g. if the recording was interrupted before the index was written) """
+    capture_path, index_path = get_capture_paths(path)
+    with open(capture_path, "rb") as capture_file, open(index_path, "wb") as index_file:
+        if capture_file.read(len(FILE_HEADER)) != FILE_HEADER:
+            raise ValueError("Not a NatNet capture file: " + capture_path)
+        index_file.write(INDEX_HEADER)
+        offset = len(FILE_HEADER)
+        while True:
+            header = capture_file.read(RecordHeader.size)
+            if len(header) < RecordHeader.size:
+                break
+            receive_time, message_id, source, reserved, frame_number, size = RecordHeader.unpack(header)
+            if frame_number != NO_FRAME_NUMBER:
+                index_file.write(IndexEntry.pack(frame_number, receive_time, offset))
+            capture_file.seek(size, os.SEEK_CUR)
+            offset += RecordHeader.size + size
+
+class CaptureRecord:
+    __slots__ = ("receive_time", "message_id", "source", "frame_number", "data", "offset")
+
+    def __init__(self, receive_time, message_id, source, frame_number, data, offset):
+        self.receive_time = receive_time
+        self.message_id = message_id
+        self.source = source
+        self.frame_number = frame_number
+        self.data = data
+        self.offset = offset
+
+def _map_file(path, header):
+    """ Map a whole file in memory (read only) after checking its header """
+    with open(path, "rb") as map_file:
+        if map_file.read(len(header)) != header:
+            raise ValueError("Not a NatNet capture file: " + path)
+        if os.fstat(map_file.fileno()).st_size == len(header):
+            return header
+        return mmap.mmap(map_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+class CaptureReader:
+    """ Read a capture. The capture and its index are memory mapped, so any size of capture can be opened """
+    def __init__(self, path):
+        self.capture_path, self.index_path = get_capture_paths(path)
+        self.data = _map_file(self.capture_path, FILE_HEADER)
+        if not os.path.exists(self.index_path):
+            rebuild_index(self.capture_path)
+        self.index = _map_file(self.index_path, INDEX_HEADER)
+        self.__frame_count = (len(self.index) - len(INDEX_HEADER)) // IndexEntry.size
+
+    def close(self):
+        for mapped_file in (self.data, self.index):
+            if isinstance(mapped_file, mmap.mmap):
+                mapped_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_frame_count(self):
+        return self.__frame_count
+
+    def get_index_entry(self, position):
+        """ Return the frame number, the receive time and the offset of the frame at position in the index """
+        return IndexEntry.unpack_from(self.index, len(INDEX_HEADER) + position*IndexEntry.size)
+
+    def get_frame_number(self, position):
+        return self.get_index_entry(position)[0]
+
+    def get_frame_time(self, position):
+        return self.get_index_entry(position)[1]
+
+    def get_frame_offset(self, position):
+        return self.get_index_entry(position)[2]
+
+    def get_start_time(self):
+        """ Receive time (nanoseconds) of the first frame """
+        return self.get_frame_time(0) if self.__frame_count > 0 else None
+
+    def read_record(self, offset):
+        """ Read the record at offset. Return the record and the offset of the next one """
+        receive_time, message_id, source, reserved, frame_number, size = RecordHeader.unpack_from(self.data, offset)
+        start = offset + RecordHeader.size
+        end = start + size
+        if end > len(self.data):
+            raise EOFError("Truncated record at offset %d" % offset)
+        return CaptureRecord(receive_time, message_id, source, frame_number, self.data[start:end], offset), end
+
+    def records(self, offset=None):
+        """ Iterate over the records starting at offset (the first record if None). A truncated last record is ignored """
+        if offset is None:
+            offset = len(FILE_HEADER)
+        end = len(self.data)
+        while offset + RecordHeader.size <= end:
+            try:
+                record, offset = self.read_record(offset)
+            except EOFError:
+                return
+            yield record
+
+    def __bisect(self, value, field):
+        """ First position whose field (0: frame number, 1: time) is >= value (the frame numbers are sorted unless the server was restarted) """
+        low = 0
+        high = self.__frame_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_index_entry(middle)[field] < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find_frame(self, frame_number):
+        """ Return the position in the index of the first frame with a frame number >= frame_number (None if there isn't) """
+        if self.__frame_count == 0:
+            return None
+
+        # The frame numbers are usually consecutive: the position is computed directly, otherwise it's searched
+        position = frame_number - self.get_frame_number(0)
+        if 0 <= position < self.__frame_count and self.get_frame_number(position) == frame_number:
+            return position
+        position = self.__bisect(frame_number, 0)
+        return position if position < self.__frame_count else None
+
+    def find_time(self, seconds):
+        """ Return the position in the index of the first frame received at least seconds after the first frame (None if there isn't) """
+        if self.__frame_count == 0:
+            return None
+        position = self.__bisect(self.get_start_time() + int(seconds*1e9), 1)
+        return position if position < self.__frame_count else None
+
+def generate_test_packet(message_id, frame_number=None, size=16):
+    """ Packet with a NatNet header, the frame number (if not None) and size bytes of payload """
+    payload = b"" if frame_number is None else struct.pack('<I', frame_number)
+    payload += bytes(range(size))
+    return struct.pack('<HH', message_id, len(payload)) + payload
+
+def record_test_capture(path, packets):
+    """ Record packets ((packet, source) pairs) in a new capture. Return the recorder """
+    recorder = PacketRecorder(path)
+    recorder.start()
+    for data, source in packets:
+        recorder.record(data, source)
+    recorder.stop()
+    return recorder
+
+def test_all(run_test=True):
+    totals=[0,0,0]
+    if run_test is True:
+        frame_numbers = [10, 11, 12, 14, 15]
+        packets = [(generate_test_packet(1), SOURCE_COMMAND)]
+        packets += [(generate_test_packet(NAT_FRAMEOFDATA, frame_number, frame_number), SOURCE_DATA) for frame_number in frame_numbers]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "session")
+            recorder = record_test_capture(path, packets)
+            totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Record",
+                (len(packets), sum(len(data) for data, source in packets), 0, False), (recorder.packets_recorded, recorder.bytes_recorded, recorder.packets_dropped, recorder.is_recording())))
+
+            with CaptureReader(path) as reader:
+                records = list(reader.records())
+                totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Read Records", packets, [(bytes(record.data), record.source) for record in records]))
+                totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Read Frame Numbers",
+                    [NO_FRAME_NUMBER] + frame_numbers, [record.frame_number for record in records]))
+                totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Read Index",
+                    [(record.frame_number, record.receive_time, record.offset) for record in records[1:]], [reader.get_index_entry(position) for position in range(reader.get_frame_count())]))
+
+                # Consecutive frame, frame after a gap, missing frame (next one), frames out of the capture
+                totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Find Frame",
+                    [2, 4, 3, 0, None], [reader.find_frame(frame_number) for frame_number in (12, 15, 13, 5, 16)]))
+                totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Find Time", [0, None], [reader.find_time(0), reader.find_time(3600)]))
+                with open(reader.index_path, "rb") as index_file:
+                    index = index_file.read()
+
+            # The index is rebuilt from the capture file
+            rebuild_index(path)
+            with open(path + INDEX_EXTENSION, "rb") as index_file:
+                totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Rebuild Index", index, index_file.read()))
+
+            # A new recording with the same path doesn't continue the capture
+            recorder = record_test_capture(path, packets[:2])
+            with CaptureReader(path) as reader, CaptureReader(recorder.capture_path) as new_reader:
+                totals=MoCapData.add_lists(totals, MoCapData.test_value("Test New Session",
+                    (os.path.join(directory, "session-1" + CAPTURE_EXTENSION), len(frame_numbers), 1), (recorder.capture_path, reader.get_frame_count(), new_reader.get_frame_count())))
+
+            # A truncated last record is ignored
+            with open(path + CAPTURE_EXTENSION, "ab") as capture_file:
+                capture_file.write(RecordHeader.pack(0, NAT_FRAMEOFDATA, SOURCE_DATA, 0, 16, 100) + bytes(10))
+            with CaptureReader(path) as reader:
+                totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Truncated Record", len(packets), len(list(reader.records()))))
+
+    print("--------------------")
+    print("[PASS] Count = %3.1d"%totals[0])
+    print("[FAIL] Count = %3.1d"%totals[1])
+    print("[SKIP] Count = %3.1d"%totals[2])
+
+    return totals
+
+if __name__ == "__main__":
+    test_all(True)
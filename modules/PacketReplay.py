@@ -0,0 +1,201 @@
+# Replay of a capture (see PacketCapture) in place of the live NatNet stream
+#
+# The recorded packets are given back to the client in the order they were received: the data packets in
+# batches, like the ones read from the data socket, and the command packets (server info, data descriptions)
+# one by one, like the command thread does. The packets received before the first frame (the answers to the
+# connection request) are returned by get_setup_packets so the client can be configured before the replay.
+# The pace of the replay is given by the receive times of the packets:
+#   speed = 1.0     real time
+#   speed = N       N times faster than real time
+#   speed = None    as fast as possible (the event loop is given back after each batch)
+# The replay can start at any frame, seek to another frame while it runs and loop from the start frame
+# when the end of the capture is reached.
+
+import asyncio
+import os
+import tempfile
+import time
+
+import modules.MoCapData as MoCapData
+from modules.PacketCapture import CaptureReader, SOURCE_COMMAND, SOURCE_DATA, NO_FRAME_NUMBER, NAT_FRAMEOFDATA, generate_test_packet, record_test_capture
+
+class PacketReplay:
+    def __init__(self, path, speed=1.0, start_frame=None, loop=False, batch_size=32, logger=None):
+        if speed is not None and speed <= 0:
+            speed = None
+        self.path = path
+        self.speed = speed
+        self.start_frame = start_frame
+        self.loop = loop
+        self.batch_size = batch_size
+        self.logger = logger
+        self.reader = None
+        self.__start_offset = None
+        self.__seek_offset = None
+
+        # Statistics
+        self.packets_replayed = 0
+        self.frames_replayed = 0
+        self.loops = 0
+
+    def open(self):
+        self.reader = CaptureReader(self.path)
+        if self.reader.get_frame_count() == 0:
+            raise ValueError("The capture doesn't contain any frame: " + self.reader.capture_path)
+        self.__start_offset = self.__get_frame_offset(self.start_frame)
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def __get_frame_offset(self, frame_number):
+        position = 0
+        if frame_number is not None:
+            position = self.reader.find_frame(frame_number)
+            if position is None:
+                raise ValueError("Frame %d is not in the capture" % frame_number)
+        return self.reader.get_frame_offset(position)
+
+    def seek(self, frame_number):
+        """ Continue the replay from frame_number (or from the first frame after it). It can be called while the replay runs """
+        self.__seek_offset = self.__get_frame_offset(frame_number)
+
+    def get_setup_packets(self):
+        """ Return the packets received before the first frame (server info and data descriptions) """
+        end = self.reader.get_frame_offset(0)
+        packets = []
+        for record in self.reader.records():
+            if record.offset >= end:
+                break
+            packets.append(record.data)
+        return packets
+
+    async def run(self, on_data_packets, on_command_packet, stop):
+        """ Replay the capture until its end (forever with loop) or until stop() returns True """
+        while not stop():
+            is_finished = await self.__replay(self.__start_offset, on_data_packets, on_command_packet, stop)
+            if not is_finished or not self.loop:
+                break
+            self.loops += 1
+
+    async def __replay(self, offset, on_data_packets, on_command_packet, stop):
+        """ Replay the packets from offset. Return True if the end of the capture was reached """
+        reader = self.reader
+        batch_size = self.batch_size
+        speed = self.speed
+        batch = []
+
+        # Receive time of the first packet replayed (nanoseconds) and time at which it was replayed (seconds)
+        first_time = None
+        start_time = time.monotonic()
+
+        records = reader.records(offset)
+        while True:
+            if stop():
+                return False
+            if self.__seek_offset is not None:
+                if batch:
+                    on_data_packets(batch)
+                    batch = []
+                records = reader.records(self.__seek_offset)
+                self.__seek_offset = None
+                first_time = None
+                start_time = time.monotonic()
+
+            record = next(records, None)
+            if record is None:
+                break
+
+            if speed is not None:
+                if first_time is None:
+                    first_time = record.receive_time
+                delay = start_time + (record.receive_time - first_time) / 1e9 / speed - time.monotonic()
+                if delay > 0:
+                    # The packets which are due are given together, as the data socket does when packets are waiting
+                    if batch:
+                        on_data_packets(batch)
+                        batch = []
+                    await asyncio.sleep(delay)
+
+            self.packets_replayed += 1
+            if record.source == SOURCE_COMMAND:
+                # The packets are kept in order: the data packets received before are given first
+                if batch:
+                    on_data_packets(batch)
+                    batch = []
+                on_command_packet(record.data)
+                continue
+            if record.frame_number != NO_FRAME_NUMBER:
+                self.frames_replayed += 1
+            batch.append(record.data)
+            if len(batch) >= batch_size:
+                on_data_packets(batch)
+                batch = []
+                if speed is None:
+                    await asyncio.sleep(0)
+
+        if batch:
+            on_data_packets(batch)
+        return True
+
+def replay_test_capture(path, start_frame=None, seek_frame=None, loops=0):
+    """ Replay a capture as fast as possible. Return the setup packets, the replayed packets ((packet, source) pairs), the sizes of the batches and the statistics """
+    replay = PacketReplay(path, speed=None, start_frame=start_frame, loop=loops > 0, batch_size=2)
+    packets = []
+    batch_sizes = []
+    def on_data_packets(batch):
+        packets.extend((bytes(data), SOURCE_DATA) for data in batch)
+        batch_sizes.append(len(batch))
+        if seek_frame is not None and len(batch_sizes) == 1:
+            replay.seek(seek_frame)
+    def on_command_packet(data):
+        packets.append((bytes(data), SOURCE_COMMAND))
+    replay.open()
+    try:
+        setup_packets = [bytes(data) for data in replay.get_setup_packets()]
+        asyncio.run(replay.run(on_data_packets, on_command_packet, lambda: replay.loops > loops))
+    finally:
+        replay.close()
+    return setup_packets, packets, batch_sizes, (replay.packets_replayed, replay.frames_replayed, replay.loops)
+
+def test_all(run_test=True):
+    totals=[0,0,0]
+    if run_test is True:
+        # Connection answers, frames with a data description update in the middle
+        setup_packets = [(generate_test_packet(1), SOURCE_COMMAND), (generate_test_packet(5), SOURCE_COMMAND)]
+        frame_packets = [(generate_test_packet(NAT_FRAMEOFDATA, frame_number, 4), SOURCE_DATA) for frame_number in range(10, 16)]
+        packets = setup_packets + frame_packets[:3] + [(generate_test_packet(5, size=8), SOURCE_COMMAND)] + frame_packets[3:]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "session")
+            record_test_capture(path, packets)
+
+            replayed_setup_packets, replayed_packets, batch_sizes, stats = replay_test_capture(path)
+            totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Setup Packets", [data for data, source in setup_packets], replayed_setup_packets))
+            totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Replay", packets[2:], replayed_packets))
+            # The data packets are given in batches of at most batch_size, the command packet ends the batch before it
+            totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Replay Batches", [2, 1, 2, 1], batch_sizes))
+            totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Replay Stats", (len(packets) - 2, len(frame_packets), 0), stats))
+
+            # Replay from a start frame
+            replayed_setup_packets, replayed_packets, batch_sizes, stats = replay_test_capture(path, start_frame=13)
+            totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Start Frame",
+                ([data for data, source in setup_packets], frame_packets[3:]), (replayed_setup_packets, replayed_packets)))
+
+            # Seek to an earlier frame after the first batch
+            replayed_setup_packets, replayed_packets, batch_sizes, stats = replay_test_capture(path, start_frame=13, seek_frame=11)
+            totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Seek", frame_packets[3:5] + packets[3:], replayed_packets))
+
+            # Loop from the start frame
+            replayed_setup_packets, replayed_packets, batch_sizes, stats = replay_test_capture(path, start_frame=14, loops=2)
+            totals=MoCapData.add_lists(totals, MoCapData.test_value("Test Loop", (3*frame_packets[4:], (6, 6, 3)), (replayed_packets, stats)))
+
+    print("--------------------")
+    print("[PASS] Count = %3.1d"%totals[0])
+    print("[FAIL] Count = %3.1d"%totals[1])
+    print("[SKIP] Count = %3.1d"%totals[2])
+
+    return totals
+
+if __name__ == "__main__":
+    test_all(True)
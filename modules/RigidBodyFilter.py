@@ -0,0 +1,83 @@
+# Filter on the rigid bodies streamed to the websocket
+#
+# The filter is built once from the RIGIDBODY_FILTER list of the settings. Each entry can be:
+#   {"id": 100, "name": "Holder"}   a rigid body (selected by id) and its marker set (selected by name)
+#   {"id_range": [200, 299]}        all the rigid bodies with an id between 200 and 299 (included)
+#   {"name_prefix": "Headset"}      all the marker sets whose name starts with "Headset"
+# The exact entries are stored in frozensets. If there are patterns, the result of each lookup is
+# cached, so the cost of a lookup doesn't depend on the number of entries in both cases.
+
+class PatternLookup:
+    """ Membership test on exact values and patterns, with the result of each test cached """
+    def __init__(self, values, match_pattern):
+        self.values = values
+        self.match_pattern = match_pattern
+        self.cache = {}
+
+    def __contains__(self, value):
+        try:
+            return self.cache[value]
+        except KeyError:
+            result = value in self.values or self.match_pattern(value)
+            self.cache[value] = result
+            return result
+
+class RigidBodyFilter:
+    def __init__(self, entries):
+        ids = set()
+        names = set()
+        self.id_to_name = {}
+        self.name_to_id = {}
+        self.id_ranges = []
+        self.name_prefixes = []
+
+        for entry in entries:
+            if "id_range" in entry:
+                first_id, last_id = entry["id_range"]
+                self.id_ranges.append((first_id, last_id))
+            if "name_prefix" in entry:
+                self.name_prefixes.append(entry["name_prefix"].encode('utf-8'))
+            if "id" in entry:
+                ids.add(entry["id"])
+            if "name" in entry:
+                names.add(entry["name"].encode('utf-8'))
+            if "id" in entry and "name" in entry:
+                self.id_to_name[entry["id"]] = entry["name"]
+                self.name_to_id[entry["name"]] = entry["id"]
+
+        self.ids = frozenset(ids)
+        self.names = frozenset(names)
+        self.id_ranges = tuple(self.id_ranges)
+        self.name_prefixes = tuple(self.name_prefixes)
+
+        # Lookups used for each frame (the marker set names are the raw bytes read from the packet)
+        self.id_lookup = self.ids
+        if self.id_ranges:
+            self.id_lookup = PatternLookup(self.ids, self.__match_id_range)
+        self.name_lookup = self.names
+        if self.name_prefixes:
+            self.name_lookup = PatternLookup(self.names, self.__match_name_prefix)
+
+    def __match_id_range(self, rigid_body_id):
+        for first_id, last_id in self.id_ranges:
+            if first_id <= rigid_body_id <= last_id:
+                return True
+        return False
+
+    def __match_name_prefix(self, name):
+        return name.startswith(self.name_prefixes)
+
+    def has_patterns(self):
+        return len(self.id_ranges) > 0 or len(self.name_prefixes) > 0
+
+    def contains_id(self, rigid_body_id):
+        return rigid_body_id in self.id_lookup
+
+    def contains_name(self, name):
+        if isinstance(name, str):
+            name = name.encode('utf-8')
+        return name in self.name_lookup
+
+    def get_name(self, rigid_body_id):
+        """ Return the name of the rigid body (None if it's not in the exact entries of the filter) """
+        return self.id_to_name.get(rigid_body_id)
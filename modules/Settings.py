@@ -2,9 +2,14 @@
 CLIENT_ADDRESS = "10.99.2.243" # Client Address ( it should be the address given by ZeroTier )
 OPTITRACK_ADDRESS = "10.99.2.4" # Optitrack Address ( it should be the address given by ZeroTier )
 USE_MULTICAST = True # Optitrack uses multicast to send data. If you are not using multicast, set this to False
+RECEIVE_BATCH_SIZE = 32 # Maximum number of packets read from the data socket with a single system call (the websocket sender runs between two batches)
+DATA_SOCKET_RECEIVE_BUFFER_SIZE = 4*1024*1024 # Size (in bytes) of the kernel receive buffer of the data socket (the OS might limit it)
+DECODE_MODE = "objects" # "objects" decodes every record in a MoCapData object, "numpy" maps rigid bodies and labeled markers as column arrays (requires numpy and NatNet 3.0 or later)
 
 # Select the rigidbodies to stream (if RIGIDBODY_FILTER_ON is True, only the rigidbodies in the RIGIDBODY_FILTER list will be streamed)
+# Other than {"id": ..., "name": ...} the entries of RIGIDBODY_FILTER can select groups of rigid bodies with {"id_range": [first_id, last_id]} or {"name_prefix": "..."}
 RIGIDBODY_FILTER_ON = True
+SELECTIVE_DECODING = True # If True (and RIGIDBODY_FILTER_ON is True), only the marker sets and rigid bodies in RIGIDBODY_FILTER are decoded, everything else is skipped
 RIGIDBODY_FILTER = [
     {
         "id": 100, 
@@ -19,9 +24,62 @@ RIGIDBODY_FILTER = [
 ]
 
 # Websocket settings
+WEBSOCKET_MODE = "client" # "client" connects to WEBSOCKET_SERVER_ADDRESS, "server" accepts the websocket clients directly on WEBSOCKET_LISTEN_HOST:WEBSOCKET_LISTEN_PORT
+WEBSOCKET_LISTEN_HOST = "0.0.0.0" # Address on which the websocket clients are accepted (server mode)
+WEBSOCKET_LISTEN_PORT = 8765 # Port on which the websocket clients are accepted (server mode)
+WEBSOCKET_COMPRESSION = True # If True, the messages are compressed (permessage-deflate) when the websocket peer supports it
+WEBSOCKET_COMPRESSION_LEVEL = 1 # zlib compression level (1 is the fastest, 9 the smallest)
+WEBSOCKET_COMPRESSION_MEMORY_LEVEL = 5 # zlib memory level (1 to 9)
+WEBSOCKET_COMPRESSION_WINDOW_BITS = 12 # Size of the compression window (from 9 to 15, 2**bits bytes)
+WEBSOCKET_UNCOMPRESSED_NETWORKS = ["127.0.0.0/8", "::1/128"] # Peers in these networks don't use the compression (add the LAN networks where the bandwidth is not a problem)
+CLIENT_SEND_BUFFER_SIZE = 8 # Maximum number of messages waiting to be sent to each websocket connection (the oldest are dropped when it's full; with DATA_QUEUE_POLICY "keep_latest" only the batches of the coalescing wait there)
+# Rate (Hz, None for every frame), fields, delta mode and coalescing of the frames sent to the websocket server in client mode. In server mode each client declares them in the query string of the url (e.g. ws://<bridge address>:8765/?rate=30&fields=position&markers=0&ids=100,101)
+WEBSOCKET_SUBSCRIPTION = {
+    "rate": None,
+    "fields": ["position", "orientation"],
+    "markers": True,
+    "ids": None,
+    "distance": None, # Delta mode: a rigid body is sent only if it moved more than distance (meters) or rotated more than angle (degrees)
+    "angle": None,
+    "keyframe": 1.0, # Delta mode: interval (seconds) between the frames with all the rigid bodies
+    "batch": None, # Coalescing: maximum number of frames sent in a single message
+    "window": None # Coalescing: maximum time (seconds) a frame waits for the next ones before the message is sent
+}
 WEBSOCKET_SERVER_ADDRESS = "virtualenv.epfl.ch/ws" # Address of the websocket server
 IS_WEBSOCKET_ADDRESS_DNS = True # If True, the websocket address will be resolved using DNS. If False, the websocket address will be resolved using the IP address
 MAX_ATTEMPTS_TO_CONNECT = 5 # If the websocket client fails to connect to the server, it will try again MAX_ATTEMPTS_TO_CONNECT times
+JSON_DATA_AS_STRING = False # If True, the frame is sent as a JSON string inside the message ({"type": "optitrack-data", "data": "{...}"}) as in the first versions of the bridge
+WEBSOCKET_BINARY_FORMAT = False # If True, the binary format (see modules/BinaryFrameFormat.py) is offered to the websocket server, which selects it with the "optitrack.binary.v1" subprotocol
+DATA_QUEUE_SIZE = 8 # Maximum number of decoded frames waiting to be sent to the websocket (the oldest frames are dropped when it's full). The buffer holds at least RECEIVE_BATCH_SIZE frames: the frames of a batch are decoded before the sender runs, so a smaller buffer would drop frames of every burst
+DATA_QUEUE_POLICY = "drop_oldest" # "drop_oldest" keeps up to DATA_QUEUE_SIZE frames (CLIENT_SEND_BUFFER_SIZE messages for each websocket connection), "keep_latest" sends only the latest pose of each rigid body (the frames not sent yet to a connection are merged)
+DATA_QUEUE_TIMEOUT = 0.5 # Maximum time (in seconds) the sender waits for a new frame before checking if the program should stop
+FRAME_SEQUENCE_TRACKING = True # If True, the frame numbers are checked to count the lost, duplicated and reordered frames and to estimate the capture rate
+DROP_LATE_FRAMES = False # If True, the frames arriving after a newer frame (reordered or duplicated by the network) are dropped before being decoded
+FRAME_SEQUENCE_MAX_GAP = 1000 # Jumps of the frame number larger than this are considered as a restart of the stream (not as lost frames)
+
+# Recording settings
+RECORDING_PATH = None # If not None (e.g. "captures/session"), every packet received from Motive is recorded in RECORDING_PATH.nncap (index in RECORDING_PATH.nnidx). If the capture exists, a new one is created (RECORDING_PATH-1, RECORDING_PATH-2, ...)
+
+# Replay settings
+REPLAY_PATH = None # If not None, the capture REPLAY_PATH is replayed instead of connecting to Motive
+REPLAY_SPEED = 1.0 # Speed of the replay (1.0 is real time, 2.0 is twice as fast, None is as fast as possible)
+REPLAY_START_FRAME = None # Frame number from which the replay starts (None to start from the first frame)
+REPLAY_LOOP = False # If True, the replay restarts from REPLAY_START_FRAME at the end of the capture
+
+# Latency tracing settings
+LATENCY_TRACING = False # If True, the time spent by each frame in each stage (camera, network, decoding, buffer, encoding, sending) is measured
+LATENCY_WINDOW = 1000 # Number of frames over which the percentiles of the latency are computed
+LATENCY_LOG_INTERVAL = 10 # Interval (in seconds) between two summaries of the latency in the logs
+
+# Metrics settings
+METRICS_ON = False # If True, the metrics of the bridge (throughput, drops, queue depth, decoding and encoding time) are served in the Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_HOST = "127.0.0.1" # Address of the metrics endpoint ("0.0.0.0" to scrape it from another computer)
+METRICS_PORT = 9108 # Port of the metrics endpoint
+
+# Profiling settings
+PROFILING_ON = False # If True, the time of each stage of the pipeline (dispatch, sections of the frame, conversion, encoding, sending) is measured on one frame out of PROFILING_SAMPLE_INTERVAL
+PROFILING_SAMPLE_INTERVAL = 100 # One frame out of PROFILING_SAMPLE_INTERVAL is measured
+PROFILE_PATH = "profile.folded" # File where the profile is written (collapsed stacks for flame graphs) on shutdown and on SIGUSR1
 
 # Logging settings
 LOGGING_ON_STDOUT = True # If True, the logs will be printed on the console
@@ -0,0 +1,100 @@
+# Sampled profiling of the stages of the frame pipeline
+#
+# One frame (or message) out of sample_interval is timed stage by stage, the others go through the pipeline
+# without any measurement. A stage is identified by its stack, the tuple of the names of the stages which
+# contain it, e.g. ("receive", "process_message", "unpack_mocap_frame", "rigid_bodies"), and the profiler keeps
+# the number of samples, the total and the maximum time of each stack.
+# The times can be dumped in the collapsed stack format ("receive;process_message;... <microseconds>", the time
+# spent in the stage itself without its sub stages), which is read by flamegraph.pl, speedscope or inferno.
+# Hooks (function(stack, duration_ns)) can be added to forward every measurement somewhere else.
+# The stages are measured by the thread of the event loop; the statistics can be read from any thread.
+
+import time
+
+class StageProfiler:
+    def __init__(self, sample_interval=100):
+        self.sample_interval = max(1, int(sample_interval))
+        self.hooks = []
+        self.__counters = {}
+
+        # Stack -> [samples, total time (nanoseconds), maximum time (nanoseconds)]
+        self.stats = {}
+
+        # True while the current frame is sampled (the stages inside it are measured)
+        self.active = False
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def sample(self, name="receive"):
+        """ Return True once every sample_interval calls with the same name (the caller then measures its stages) """
+        counter = self.__counters.get(name, 0) + 1
+        if counter >= self.sample_interval:
+            counter = 0
+        self.__counters[name] = counter
+        return counter == 0
+
+    def record(self, stack, duration_ns):
+        stats = self.stats.get(stack)
+        if stats is None:
+            self.stats[stack] = [1, duration_ns, duration_ns]
+        else:
+            stats[0] += 1
+            stats[1] += duration_ns
+            if duration_ns > stats[2]:
+                stats[2] = duration_ns
+        for hook in self.hooks:
+            hook(stack, duration_ns)
+
+    def wrap(self, function, stack):
+        """ Return function measured as the stage stack """
+        def measured(*args):
+            start = time.perf_counter_ns()
+            try:
+                return function(*args)
+            finally:
+                self.record(stack, time.perf_counter_ns() - start)
+        return measured
+
+    def reset(self):
+        self.stats = {}
+
+    def get_stats(self):
+        """ Return the statistics of each stage ({"receive;process_message": {"samples": ..., "mean_ms": ..., "max_ms": ..., "total_ms": ...}}) """
+        summary = {}
+        for stack, (samples, total, maximum) in sorted(list(self.stats.items())):
+            summary[";".join(stack)] = {
+                "samples": samples,
+                "mean_ms": total / samples / 1e6,
+                "max_ms": maximum / 1e6,
+                "total_ms": total / 1e6
+            }
+        return summary
+
+    def get_collapsed_stacks(self):
+        """ Return the time spent in each stage without its sub stages, in the collapsed stack format (microseconds) """
+        totals = {stack: stats[1] for stack, stats in list(self.stats.items())}
+        self_times = dict(totals)
+        for stack, total in totals.items():
+            parent = stack[:-1]
+            if parent in self_times:
+                self_times[parent] -= total
+        lines = []
+        for stack in sorted(self_times):
+            microseconds = self_times[stack] // 1000
+            if microseconds > 0:
+                lines.append("%s %d" % (";".join(stack), microseconds))
+        return "\n".join(lines) + "\n"
+
+    def dump_collapsed_stacks(self, path):
+        with open(path, "w") as profile_file:
+            profile_file.write(self.get_collapsed_stacks())
+
+    def format_summary(self):
+        lines = ["Stage                                                        samples   mean ms    max ms"]
+        for stage, values in self.get_stats().items():
+            lines.append("  %-58s %8d  %8.3f  %8.3f" % (stage, values["samples"], values["mean_ms"], values["max_ms"]))
+        return "\n".join(lines)
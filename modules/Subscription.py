@@ -0,0 +1,157 @@
+# Subscriptions of the websocket clients (and of the websocket sink in client mode)
+#
+# A subscription declares the maximum rate of the frames (in Hz, None for every frame) and a projection:
+# the fields of the rigid bodies (position and/or orientation), whether the markers are sent and which
+# rigid bodies are sent (None for all of them).
+# The websocket clients of the server mode declare their subscription in the query string of the url:
+#   ws://<bridge address>:8765/?rate=30&fields=position&markers=0&ids=100,101
+# The rate is applied on the frame timestamps: the subscribers with the same rate receive the same frames,
+# so the subscribers with the same rate and projection share the same encoded message.
+# A subscription can also ask for the delta mode (see DeltaFilter) with a distance (meters) and/or an angle
+# (degrees) threshold and the interval between the keyframes (seconds):
+#   ws://<bridge address>:8765/?distance=0.001&angle=0.5&keyframe=1
+# The frames can be coalesced in a single message (see FrameCoalescer) with at most batch frames and/or
+# waiting at most window seconds (useful for the consumers that need throughput more than latency):
+#   ws://<bridge address>:8765/?batch=10&window=0.002
+
+from collections import namedtuple
+from urllib.parse import urlsplit, parse_qs
+
+from modules.DeltaFilter import DeltaFilter
+
+FIELDS = ("position", "orientation")
+
+# Part of the frame sent to a subscriber (hashable, it's used as key of the encoding cache)
+Projection = namedtuple("Projection", ["position", "orientation", "markers", "rigid_body_ids"])
+FULL_PROJECTION = Projection(True, True, True, None)
+
+POSITION_KEYS = ('x', 'y', 'z')
+ORIENTATION_KEYS = ('qx', 'qy', 'qz', 'qw')
+
+class Subscription:
+    def __init__(self, rate=None, fields=FIELDS, markers=True, rigid_body_ids=None, distance=None, angle=None, keyframe_interval=1.0, batch=None, window=None):
+        for field in fields:
+            if field not in FIELDS:
+                raise ValueError("Unknown subscription field " + str(field))
+        if rate is not None and rate <= 0:
+            raise ValueError("The subscription rate must be positive")
+        for threshold in (distance, angle, keyframe_interval):
+            if threshold is not None and threshold < 0:
+                raise ValueError("The delta thresholds and the keyframe interval can't be negative")
+        if batch is not None and batch < 1:
+            raise ValueError("The batch size must be at least 1")
+        if window is not None and window <= 0:
+            raise ValueError("The batch window must be positive")
+        self.rate = rate
+        self.projection = Projection(
+            "position" in fields,
+            "orientation" in fields,
+            markers,
+            None if rigid_body_ids is None else frozenset(rigid_body_ids))
+
+        # Delta mode (None if every rigid body is sent in every frame)
+        self.deadband = None
+        if distance is not None or angle is not None:
+            self.deadband = (distance, angle, keyframe_interval)
+
+        # Coalescing of the frames (None if each frame is sent in its own message)
+        self.batching = None
+        if batch is not None or window is not None:
+            self.batching = (batch, window)
+
+        # Slot (timestamp * rate) of the last frame sent
+        self.__last_slot = None
+
+    @classmethod
+    def from_dict(cls, subscription):
+        """ Create a subscription from a dictionary with the keys "rate", "fields", "markers", "ids", "distance", "angle", "keyframe", "batch" and "window" (all optional) """
+        if subscription is None:
+            return cls()
+        return cls(
+            rate = subscription.get("rate"),
+            fields = subscription.get("fields", FIELDS),
+            markers = subscription.get("markers", True),
+            rigid_body_ids = subscription.get("ids"),
+            distance = subscription.get("distance"),
+            angle = subscription.get("angle"),
+            keyframe_interval = subscription.get("keyframe", 1.0),
+            batch = subscription.get("batch"),
+            window = subscription.get("window"))
+
+    @classmethod
+    def from_path(cls, path):
+        """ Create a subscription from the query string of a websocket url (e.g. "/?rate=30&fields=position") """
+        query = parse_qs(urlsplit(path or "").query)
+        subscription = {}
+        if "rate" in query:
+            subscription["rate"] = float(query["rate"][-1])
+        if "fields" in query:
+            subscription["fields"] = [field for field in query["fields"][-1].split(",") if field]
+        if "markers" in query:
+            subscription["markers"] = query["markers"][-1].lower() not in ("0", "false", "no", "off")
+        if "ids" in query:
+            subscription["ids"] = [int(rigid_body_id) for rigid_body_id in query["ids"][-1].split(",") if rigid_body_id]
+        for key in ("distance", "angle", "keyframe"):
+            if key in query:
+                subscription[key] = float(query[key][-1])
+        if "batch" in query:
+            subscription["batch"] = int(query["batch"][-1])
+        if "window" in query:
+            subscription["window"] = float(query["window"][-1])
+        return cls.from_dict(subscription)
+
+    def get_key(self):
+        """ Subscriptions with the same key receive the same messages """
+        return (self.rate, self.projection, self.deadband, self.batching)
+
+    def create_delta_filter(self):
+        """ Return the delta filter of the subscription (None if the delta mode is not used) """
+        if self.deadband is None:
+            return None
+        distance, angle, keyframe_interval = self.deadband
+        return DeltaFilter(distance, angle, keyframe_interval)
+
+    def is_due(self, timestamp):
+        """ Return True if the frame with this timestamp has to be sent (at most rate frames per second) """
+        if self.rate is None:
+            return True
+        slot = int(timestamp * self.rate)
+        if slot == self.__last_slot:
+            return False
+        self.__last_slot = slot
+        return True
+
+def project(processed_data, projection, marker_set_ids=None):
+    """ Return the frame with only the items and the fields selected by projection """
+    mocap_data = processed_data["mocap_data"]
+    if projection == FULL_PROJECTION or not isinstance(mocap_data, list):
+        return processed_data
+
+    # Keys removed from the rigid bodies
+    removed_keys = ()
+    if not projection.position:
+        removed_keys += POSITION_KEYS
+    if not projection.orientation:
+        removed_keys += ORIENTATION_KEYS
+
+    # The markers are selected with the id of the rigid body of their marker set (marker_set_ids: name -> id)
+    rigid_body_ids = projection.rigid_body_ids
+    if marker_set_ids is None:
+        marker_set_ids = {}
+
+    projected_data = []
+    for item in mocap_data:
+        if item['type'] == 'marker':
+            if not projection.markers:
+                continue
+            if rigid_body_ids is not None and marker_set_ids.get(item['rigidBody']) not in rigid_body_ids:
+                continue
+            projected_data.append(item)
+        else:
+            if rigid_body_ids is not None and item['ID'] not in rigid_body_ids:
+                continue
+            if removed_keys:
+                item = {key: value for key, value in item.items() if key not in removed_keys}
+            projected_data.append(item)
+
+    return {"frame_number": processed_data["frame_number"], "timestamp": processed_data["timestamp"], "mocap_data": projected_data}
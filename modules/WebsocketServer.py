@@ -0,0 +1,326 @@
+# Distribution of the frames to the websocket connections
+#
+# The broadcaster is used in both modes of the bridge: in server mode every client connected to the bridge
+# is a subscriber, in client mode the connection to the websocket server is the only subscriber.
+# Each connection declares its subscription (rate and projection, see Subscription): in server mode in the
+# query string of the url, in client mode with WEBSOCKET_SUBSCRIPTION.
+# Each frame is encoded once for each subscription and format in use (JSON and/or binary, negotiated per
+# connection with the websocket subprotocols) and the same message is queued to all the matching connections.
+# The connections receiving the same messages form a group, which shares the rate slot (the subscription of
+# its first connection), the delta state (reset when a connection joins, so that the new connection receives
+# a keyframe immediately) and the frame coalescer.
+# Each connection has its own queue and its own sender task, so a slow client never holds up the data socket
+# or the other clients. The queue follows the policy of the frame buffer (see FrameBuffer):
+#   "drop_oldest"   the encoded messages wait in a bounded queue, a slow client loses the oldest ones
+#   "keep_latest"   the frames not sent yet are merged (latest pose of each rigid body) and the result is encoded
+#                   when the connection is ready to send it; the connections which are not late share the message
+# The batches of the coalescer are always queued as messages (drop_oldest).
+# With a latency tracer (see LatencyTracer) the messages keep the number of their frame, so the time at
+# which the frame is encoded and sent can be traced. With metrics (see Metrics) the connections, the messages
+# sent and dropped and the encoding time are counted. With a profiler (see StageProfiler) one frame and one message
+# out of its sample interval are measured stage by stage.
+
+import asyncio
+import time
+from collections import deque
+
+import websockets
+
+import modules.BinaryFrameFormat as BinaryFrameFormat
+from modules.FrameBuffer import FrameBuffer, POLICIES
+from modules.FrameCoalescer import FrameCoalescer
+from modules.Subscription import Subscription, project
+
+# Stages measured by the profiler (the time of broadcast without encode is the projection and the delta filter)
+BROADCAST_STAGE = ("send", "broadcast")
+ENCODE_STAGE = BROADCAST_STAGE + ("encode",)
+SEND_STAGE = ("send", "websocket_send")
+
+class WebsocketSubscriber:
+    def __init__(self, websocket, subscription, buffer_size=8, metrics=None, policy="drop_oldest", encode=None):
+        self.websocket = websocket
+        self.metrics = metrics
+        self.subscription = subscription
+        self.is_binary = websocket.subprotocol == BinaryFrameFormat.SUBPROTOCOL
+        self.group_key = (subscription.get_key(), self.is_binary)
+        self.messages = deque(maxlen=buffer_size)
+        self.__ready = asyncio.Event()
+
+        # keep_latest: frames merged until the sender takes them, encoded with encode(processed_data) at that time
+        self.frames = FrameBuffer("keep_latest") if policy == "keep_latest" else None
+        self.encode = encode
+
+        # True while a message is being sent
+        self.is_sending = False
+
+        # Statistics
+        self.messages_sent = 0
+        self.messages_dropped = 0
+
+    def __len__(self):
+        if self.frames is None:
+            return len(self.messages)
+        return len(self.messages) + len(self.frames)
+
+    def put(self, message, frame_number=None):
+        if len(self.messages) == self.messages.maxlen:
+            self.messages_dropped += 1
+            if self.metrics is not None:
+                self.metrics.messages_dropped += 1
+        self.messages.append((message, frame_number))
+        self.__ready.set()
+
+    def put_frame(self, processed_data):
+        """ keep_latest: add a frame, merged with the frame waiting to be sent if there is one """
+        if self.metrics is not None and len(self.frames) > 0:
+            self.metrics.frames_conflated += 1
+        self.frames.put(processed_data)
+        self.__ready.set()
+
+    def get_frames_conflated(self):
+        return 0 if self.frames is None else self.frames.frames_conflated
+
+    async def get(self, timeout):
+        """ Wait (at most timeout seconds) for the next message and the number of its frame. Return None if no message arrived """
+        if len(self) == 0:
+            self.__ready.clear()
+            try:
+                await asyncio.wait_for(self.__ready.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                return None
+        if self.messages:
+            return self.messages.popleft()
+        processed_data = self.frames.get_nowait()
+        return self.encode(processed_data), processed_data["frame_number"]
+
+class WebsocketBroadcaster:
+    def __init__(self, frame_encoder, binary_frame_encoder, buffer_size=8, timeout=0.5, logger=None, latency_tracer=None, metrics=None, profiler=None, policy="drop_oldest"):
+        if policy not in POLICIES:
+            raise ValueError("Unknown frame buffer policy " + str(policy))
+        self.frame_encoder = frame_encoder
+        self.binary_frame_encoder = binary_frame_encoder
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.timeout = timeout
+        self.logger = logger
+        self.latency_tracer = latency_tracer
+        self.metrics = metrics
+        self.profiler = profiler
+        self.subscribers = set()
+
+        # True while the frame being broadcast is measured by the profiler
+        self.__is_profiled = False
+
+        # State of the groups of subscribers receiving the same messages (key: subscription key and format)
+        self.group_subscriptions = {}
+        self.delta_filters = {}
+        self.coalescers = {}
+
+        # keep_latest: last frame encoded for each group and its message (group key -> (processed_data, message))
+        self.latest_messages = {}
+
+    def get_subscriber_count(self):
+        return len(self.subscribers)
+
+    def serve(self, host, port, binary_format=False, extensions=None, create_protocol=None):
+        """ Return the websocket server (to be used with async with). extensions are the compression extensions (see Compression) """
+        subprotocols = [BinaryFrameFormat.JSON_SUBPROTOCOL]
+        if binary_format:
+            subprotocols = [BinaryFrameFormat.SUBPROTOCOL, BinaryFrameFormat.JSON_SUBPROTOCOL]
+        return websockets.serve(self.handle_client, host, port, subprotocols=subprotocols, compression=None, extensions=extensions, create_protocol=create_protocol)
+
+    def add_subscriber(self, websocket, subscription):
+        subscriber = WebsocketSubscriber(websocket, subscription, self.buffer_size, self.metrics, self.policy)
+        subscriber.encode = lambda processed_data: self.__encode_latest(processed_data, subscriber.group_key)
+        self.group_subscriptions.setdefault(subscriber.group_key, subscription)
+        self.delta_filters.pop(subscriber.group_key, None)
+        self.subscribers.add(subscriber)
+        if self.metrics is not None:
+            self.metrics.websocket_connections += 1
+        if self.logger is not None:
+            self.logger.debug("Websocket connected: %s (%s format)" % (str(websocket.remote_address), "binary" if subscriber.is_binary else "JSON"))
+        return subscriber
+
+    def remove_subscriber(self, subscriber):
+        if subscriber not in self.subscribers:
+            return
+        self.subscribers.discard(subscriber)
+        if self.metrics is not None:
+            self.metrics.websocket_disconnections += 1
+        group_key = subscriber.group_key
+        if not any(other.group_key == group_key for other in self.subscribers):
+            self.group_subscriptions.pop(group_key, None)
+            self.delta_filters.pop(group_key, None)
+            self.latest_messages.pop(group_key, None)
+            coalescer = self.coalescers.pop(group_key, None)
+            if coalescer is not None:
+                coalescer.close()
+        if self.logger is not None:
+            self.logger.debug("Websocket disconnected: %s (messages sent: %d, dropped: %d, frames conflated: %d)" % (str(subscriber.websocket.remote_address), subscriber.messages_sent, subscriber.messages_dropped, subscriber.get_frames_conflated()))
+
+    async def send_messages(self, subscriber):
+        """ Send the messages queued to the subscriber until the connection is closed """
+        websocket = subscriber.websocket
+        metrics = self.metrics
+        profiler = self.profiler
+        while not websocket.closed:
+            # The timeout allows to notice that the connection has been closed while no frame arrives
+            item = await subscriber.get(self.timeout)
+            if item is None:
+                continue
+            message, frame_number = item
+            subscriber.is_sending = True
+            try:
+                if profiler is not None and profiler.sample(SEND_STAGE):
+                    start = time.perf_counter_ns()
+                    await websocket.send(message)
+                    profiler.record(SEND_STAGE, time.perf_counter_ns() - start)
+                else:
+                    await websocket.send(message)
+            finally:
+                subscriber.is_sending = False
+            subscriber.messages_sent += 1
+            if metrics is not None:
+                metrics.messages_sent += 1
+                metrics.bytes_sent += len(message)
+            if self.latency_tracer is not None:
+                self.latency_tracer.on_sent(frame_number, time.perf_counter_ns())
+
+    def flush(self):
+        """ Queue the frames waiting in the coalescers without waiting for the batches to be complete """
+        for coalescer in list(self.coalescers.values()):
+            coalescer.flush()
+
+    def get_pending_count(self):
+        """ Return the number of messages (or merged frames) queued or being sent to the connections """
+        return sum(len(subscriber) + subscriber.is_sending for subscriber in self.subscribers)
+
+    async def handle_client(self, websocket, path=None):
+        try:
+            subscription = Subscription.from_path(websocket.path)
+        except ValueError as e:
+            await websocket.close(code=1008, reason="Invalid subscription: " + str(e))
+            return
+        subscriber = self.add_subscriber(websocket, subscription)
+        try:
+            await self.send_messages(subscriber)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.remove_subscriber(subscriber)
+
+    def __encode(self, processed_data, is_binary):
+        if self.__is_profiled:
+            start = time.perf_counter_ns()
+        if is_binary:
+            # The binary encoder reuses its buffer: the clients need their own copy
+            message = bytes(self.binary_frame_encoder.encode(processed_data))
+        else:
+            message = self.frame_encoder.encode(processed_data)
+        if self.__is_profiled:
+            self.profiler.record(ENCODE_STAGE, time.perf_counter_ns() - start)
+        return message
+
+    def __encode_latest(self, processed_data, group_key):
+        """ keep_latest: encode the frame taken by the sender of a subscriber of the group (the frames which were not merged are encoded once for the group) """
+        latest = self.latest_messages.get(group_key)
+        if latest is not None and latest[0] is processed_data:
+            return latest[1]
+        message = self.__encode(processed_data, group_key[1])
+        self.latest_messages[group_key] = (processed_data, message)
+        return message
+
+    def __send_batch(self, group_key, frames):
+        if self.__is_profiled:
+            start = time.perf_counter_ns()
+        if group_key[1]:
+            message = self.binary_frame_encoder.encode_batch(frames)
+        else:
+            message = self.frame_encoder.encode_batch(frames)
+        if self.__is_profiled:
+            self.profiler.record(ENCODE_STAGE, time.perf_counter_ns() - start)
+        # The messages are traced with the last frame of the batch
+        frame_number = frames[-1]["frame_number"]
+        for subscriber in self.subscribers:
+            if subscriber.group_key == group_key:
+                subscriber.put(message, frame_number)
+
+    def __get_coalescer(self, subscriber):
+        group_key = subscriber.group_key
+        coalescer = self.coalescers.get(group_key)
+        if coalescer is None:
+            max_frames, window = subscriber.subscription.batching
+            coalescer = FrameCoalescer(lambda frames: self.__send_batch(group_key, frames), max_frames, window)
+            self.coalescers[group_key] = coalescer
+        return coalescer
+
+    def __process(self, processed_data, subscriber):
+        """ Prepare the frame for the group of the subscriber. Return the frame to queue now (None if there is nothing to queue now) """
+        subscription = subscriber.subscription
+        processed_data = project(processed_data, subscription.projection, self.binary_frame_encoder.rigid_body_ids)
+        if subscription.deadband is not None:
+            delta_filter = self.delta_filters.get(subscriber.group_key)
+            if delta_filter is None:
+                delta_filter = subscription.create_delta_filter()
+                self.delta_filters[subscriber.group_key] = delta_filter
+            processed_data = delta_filter.apply(processed_data)
+            # In delta mode there is nothing to send if no rigid body moved
+            if processed_data is None:
+                return None
+        if subscription.batching is not None:
+            # The message is queued by the coalescer when the batch is complete
+            self.__get_coalescer(subscriber).add(processed_data)
+            return None
+        return processed_data
+
+    def broadcast(self, processed_data):
+        """ Encode the frame once for each subscription and format in use and queue it to the subscribers """
+        if self.profiler is not None and self.profiler.sample(BROADCAST_STAGE):
+            self.__is_profiled = True
+            start = time.perf_counter_ns()
+            try:
+                self.__broadcast(processed_data)
+            finally:
+                self.__is_profiled = False
+                self.profiler.record(BROADCAST_STAGE, time.perf_counter_ns() - start)
+        else:
+            self.__broadcast(processed_data)
+
+    def __broadcast(self, processed_data):
+        timestamp = processed_data["timestamp"]
+        frame_number = processed_data["frame_number"]
+        latency_tracer = self.latency_tracer
+        metrics = self.metrics
+        if latency_tracer is not None or metrics is not None:
+            start_time = time.perf_counter_ns()
+            if latency_tracer is not None:
+                latency_tracer.on_dequeued(frame_number, start_time)
+        # With keep_latest the frames are queued and encoded when they are sent
+        keep_latest = self.policy == "keep_latest"
+        messages = {}
+        for subscriber in self.subscribers:
+            group_key = subscriber.group_key
+            if group_key in messages:
+                message = messages[group_key]
+            else:
+                # The rate is applied once for the group, so the delta filter and the coalescer of the group see
+                # the frames sent to all its subscribers
+                message = None
+                if self.group_subscriptions[group_key].is_due(timestamp):
+                    message = self.__process(processed_data, subscriber)
+                    if message is not None and not keep_latest:
+                        message = self.__encode(message, subscriber.is_binary)
+                messages[group_key] = message
+            if message is None:
+                continue
+            if keep_latest:
+                subscriber.put_frame(message)
+            else:
+                subscriber.put(message, frame_number)
+        if latency_tracer is not None or metrics is not None:
+            end_time = time.perf_counter_ns()
+            if latency_tracer is not None:
+                latency_tracer.on_encoded(frame_number, end_time)
+            if metrics is not None:
+                metrics.frames_encoded += 1
+                metrics.encode_time.observe((end_time - start_time) / 1e9)
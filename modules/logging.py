@@ -13,16 +13,17 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 class logger:
-    def __init__(self, log_on_stout = False):
+    def __init__(self, log_on_stout = False, log_path = 'logs.log'):
         self.log_on_stout = log_on_stout
 
         self.logger = logging.getLogger('OptitrackBridge')
         self.logger.setLevel(logging.DEBUG)
 
-        # Create file handler
-        handler = logging.FileHandler('logs.log')
-        handler.setLevel(logging.INFO)
-        self.logger.addHandler(handler)
+        # Create file handler (no log file if log_path is None)
+        if log_path is not None:
+            handler = logging.FileHandler(log_path)
+            handler.setLevel(logging.INFO)
+            self.logger.addHandler(handler)
 
         # Create output handler
         if log_on_stout is True: